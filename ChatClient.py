@@ -10,99 +10,188 @@ yellow_font = Fore.YELLOW
 blue_font = Fore.BLUE
 white_font = Fore.WHITE
 
-from protocol import sendObject, receiveObject, WrappedSocket  # gets these modules from protocol.py for sending and receiving messages
-import socket  # brings in the socket module so that the client can communicate over the network
+from clientlib import ChatClientSession  # the headless client library that does all of the talking to the server
+from protocol import ENCODINGS, COMPRESSIONS  # the frame encodings and stream compressions offered to the server
 import threading  # threading module will allow for multiple tasks to be run at once while over the same process
-from email.mime.text import MIMEText  # formatting for the text to be used with messages being sent and received
+import collections  # collections module for the messages waiting to be drawn and the scrollback
+import time  # time module to wait for a burst of messages to collect before drawing them
 
+# info messages from the server that mean the connection is over
+DISCONNECT_INFOS = ("Server is shutting down.", "You have disconnected from the server.")
+RENDER_INTERVAL = 0.05  # seconds a burst of messages collects for before it is drawn with one terminal write
+PENDING_LIMIT = 5000  # messages waiting to be drawn before the oldest are skipped, so a flood cannot grow memory
+SCROLLBACK_LINES = 1000  # lines kept for /scrollback
+COLLAPSE_AFTER = 3  # more joins and leaves than this for one channel in one burst are drawn as a single line
+NAMES_SHOWN = 5  # nicknames listed in a collapsed line before the rest are only counted
+PROMPT = "enter a command: "
+PRESENCE = {"a user joined a channel": "joined", "a user left the channel": "left"}  # events that can be collapsed
 
-# start the ChatClient
+
+def presenceOf(msg):  # (channel, change, nickname) for a join or leave event or a /watch change, None for anything else
+    if not isinstance(msg, dict) or msg.get("type") != "event":
+        return None
+    if msg.get("event") in PRESENCE:
+        return msg.get("channel"), PRESENCE[msg["event"]], msg.get("user")
+    if msg.get("event") == "presence" and msg.get("change") in ("joined", "left"):
+        return msg.get("channel"), msg["change"], msg.get("user")
+    return None
+
+
+class MessageRenderer:
+    """Draws the messages from the server on a thread of its own.
+
+    push only appends to a queue, so the thread reading the socket never waits on the terminal. The
+    drawing thread wakes up, lets the burst collect for interval seconds and then writes all of it
+    with one write and one prompt redraw. Joins and leaves of one channel in the same burst become a
+    single line when there are many of them. When the terminal cannot keep up the oldest waiting
+    messages are skipped and counted, and only the last scrollback drawn lines are kept.
+    """
+
+    def __init__(self, lock, interval=RENDER_INTERVAL, pendingLimit=PENDING_LIMIT, scrollback=SCROLLBACK_LINES):
+        self.lock = lock  # held while writing, so replies printed by the input loop do not interleave
+        self.interval = interval
+        self.pendingLimit = pendingLimit
+        self.scrollback = collections.deque(maxlen=scrollback)
+        self.skipped = 0  # messages dropped because too many were waiting
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def push(self, line):  # queues a message, or a line of text, to be drawn
+        if len(self._pending) >= self.pendingLimit:
+            self._pending.popleft()
+            self.skipped += 1
+        self._pending.append(line)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)  # lets the rest of a burst arrive so it is drawn in one write
+            self._wake.clear()
+            self.drain()
+
+    def drain(self):  # draws everything that is waiting
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        if not batch and not self.skipped:
+            return
+        lines = self.format(batch)
+        if self.skipped:
+            lines.insert(0, yellow_font + f"... {self.skipped} messages were skipped because the terminal fell behind")
+            self.skipped = 0
+        self.scrollback.extend(lines)
+        with self.lock:
+            sys.stdout.write("\r\033[K" + "\n".join(lines) + "\n" + white_font + PROMPT)  # clears the prompt line first
+            sys.stdout.flush()
+
+    def format(self, batch):  # the lines for a burst of messages, with busy channels' joins and leaves collapsed
+        presence = collections.defaultdict(list)
+        for msg in batch:
+            change = presenceOf(msg)
+            if change is not None:
+                presence[change[0]].append(change[1:])
+        lines = []
+        collapsed = set()
+        for msg in batch:
+            change = presenceOf(msg)
+            if change is not None and len(presence[change[0]]) > COLLAPSE_AFTER:
+                if change[0] not in collapsed:  # the whole burst goes where its first event was
+                    collapsed.add(change[0])
+                    lines.append(Fore.CYAN + collapseLine(change[0], presence[change[0]]))
+                continue
+            lines.append(msg if isinstance(msg, str) else Fore.CYAN + str(msg))
+        return lines
+
+
+def collapseLine(channel, changes):  # one line for many joins and leaves of a channel
+    parts = []
+    for kind in ("joined", "left"):
+        names = [name for change, name in changes if change == kind]
+        if names:
+            shown = ", ".join(str(name) for name in names[:NAMES_SHOWN])
+            more = f" and {len(names) - NAMES_SHOWN} more" if len(names) > NAMES_SHOWN else ""
+            parts.append(f"{len(names)} {kind} ({shown}{more})")
+    return f"{channel}: " + ", ".join(parts)
+
+
+# start the ChatClient, a terminal shell over the client library
 class ChatClient:
-    def __init__(self):
-        self.sock = None  # initialize with None because there is no connection over a network yet
+    def __init__(self, encodings=ENCODINGS, compressions=COMPRESSIONS):
+        self.session = None  # initialize with None because there is no connection over a network yet
+        self.encodings = encodings  # the frame encodings offered to the server, most preferred first
+        self.compressions = compressions  # the stream compressions offered, the server may turn them down
         self.nickname = None  # initialize with None because the user has not set a nickname yet
-        self.io_lock = threading.Lock()
+        self.print_lock = threading.Lock()  # keeps replies and inbound messages from printing over each other
+        self.renderer = MessageRenderer(self.print_lock)  # draws inbound messages away from the socket thread
         self.exit = False
+        self.quitting = False  # True while a /quit is waiting for the server to close the connection
 
     # begin connection to server
     def clientConnect(self, host,
                       port):  # connect function that will take the instance of the class, the server address, and the server port number
-        if self.sock is not None:  # for when there is already a connection over the network
+        if self.session is not None:  # for when there is already a connection over the network
             print(yellow_font + "You are already connected to a server. Try /quit first.")
             return
+        session = ChatClientSession(self.encodings, onMessage=self.showMessage, onClose=self.serverClosed,
+                                    compressions=self.compressions)
         try:  # for when the user is not already connected to a server and a new connection can be made
-            raw_sock = socket.socket(socket.AF_INET,
-                                      socket.SOCK_STREAM)  # create socket object at specific IPv4 address and TCP connection for socket type
-            raw_sock.connect((host, port))  # connect to the server using the retrieved host and port
-            new_sock = WrappedSocket(raw_sock)
+            encoding = session.connect(host, port)  # agrees on a frame encoding, failing if the server does not answer
+            compressed = f", {session.compression} compressed" if session.compression else ""
             print(
-                green_font + f"Connected to {host}:{port}")  # print confirmation the you are now connected to the server at a specific host and port
-
-            self.sock = new_sock
-
-            self.listener_thread = threading.Thread(target=self.listenerOnLoop)
-            self.listener_thread.start()  # create new thread object that will be continuously listening for any and all incoming messages from the server
+                green_font + f"Connected to {host}:{port} ({encoding} frames{compressed})")  # print confirmation the you are now connected to the server at a specific host and port
+            self.session = session
         except Exception as e:  # if the connection fails for any reason, an error message will be printed
             print(red_font + "The connection failed:", e)
-            self.sock = None  # will reset the socket to None since the connection was not successful
-
-    # threaded listener function for incoming messages from the server to the client
-    def listenerOnLoop(self):
-        while True:  # while the thread is looping to listen for incoming messages
-            try:
-                with self.io_lock:
-                    msg = receiveObject(self.sock)  # receives an object from the server over the network socket
-                if msg is None:  # if there is no message received, the server has disconnected
-                    print(red_font + "The server has disconnected.")
-                    self.sock.close()  # close the socket connection
-                    self.sock = None  # will reset the socket to None since there is no longer a connection
-                    break  # thread breaks out of the listening loop
-                # print("\n" + Fore.CYAN + str(msg) + "\n")#print the received message to the console for the user to see
-
-                # Handle info messages
-                if isinstance(msg, dict) and msg.get("type") == "info":
-                    info_message = msg.get("info", "Server message")
-                    if info_message == "Server is shutting down." or \
-                            info_message == "You have disconnected from the server." or \
-                            "You have been disconnected from the server due to inactivity" in info_message:
-                        sys.stdout.write("\r\033[K")
-                        print(red_font + msg.get("info", "Server message"))
-                        self.sock.close()
-                        self.sock = None
-                        print(red_font + "You have disconnected from the server.")
-                        self.exit = True
-                        break
-
-                else:
-                    # CLEAR current input line
-                    sys.stdout.write("\r\033[K")
-
-                    # Print the message
-                    print(Fore.CYAN + str(msg))
-
-                    # Reprint prompt fresh
-                    sys.stdout.write(white_font + "enter a command: ")
-                    sys.stdout.flush()
-
-            except Exception as e:  # if there is an error receiving the message, an error message will be printed
-                print(red_font + "There was an error trying to receive your message", e)
-                break  # thread breaks out of the listening loop
+            session.close()  # stops the session's background loop since the connection was not successful
+
+    # called by the client library with every message from the server that is not a reply to a command,
+    # on the thread that reads the socket, so it only hands the message to the renderer
+    def showMessage(self, msg):
+        info = msg.get("info", "") if isinstance(msg, dict) and msg.get("type") == "info" else None
+        if info is not None and (info in DISCONNECT_INFOS or
+                                 "You have been disconnected from the server due to inactivity" in info):
+            self.renderer.push(red_font + info)
+            self.exit = not self.quitting  # the input loop stops on the next command, /quit stops it itself
+            return
+        self.renderer.push(msg)
+
+    # called by the client library once the connection has closed
+    def serverClosed(self):
+        self.session = None  # will reset the session to None since there is no longer a connection
+        self.renderer.drain()  # the last messages are drawn before the disconnect is reported
+        if not self.quitting:
+            with self.print_lock:
+                print(red_font + "The server has disconnected.")
+
+    # sends a command and prints the replies the server sent back to it
+    def runCommand(self, command, *args):
+        try:
+            replies = self.session.request(command, *args)
+        except Exception as e:  # for when the connection closed or the server did not answer in time
+            print(red_font + "There was an error trying to send your command", e)
+            return
+        with self.print_lock:
+            for reply in replies:
+                print(Fore.CYAN + str(reply))
+
+    # sends the quit command and waits for the server's final message and the disconnect
+    def disconnect(self):
+        session = self.session
+        if session is None:
+            return
+        self.quitting = True
+        try:
+            session.quit()
+        except Exception:  # for when there is an error, drop the connection and proceed
+            session.close()
+        self.session = None  # resets the session to None and disconnects from the server
 
     # possible user input commands that are sent to the server
     def goodbye(self):  # function to have a more uniform disconnect when ctrl-c is used
-        if self.sock:
-            try:
-                sendObject(self.sock, {"type": "command",
-                                       "command": "quit"})  # sends the quit command to the server as a command object to disconnect from the server
-            except:
-                pass  # proceed when error
-            try:
-                self.sock.close()  # close the socket connection
-            except:
-                pass  # whenever there is an error, proceed
-            self.sock = None  # reset the socket to None and disconnect from the server
-        if hasattr(self, "listener_thread"):
-            self.listener_thread.join(timeout=1)
+        self.disconnect()
         print(
             green_font + "The client chat has been successfully disconnected.")  # the user knows that they have disconnected from the server
 
@@ -111,7 +200,7 @@ class ChatClient:
             while not self.exit:  # continuously loops to wait for user input
                 try:
                     text = input(
-                        white_font + "enter a command: ").strip()  # has > to prompt the user for input and .strip() to remove any whitespaces before or after the input
+                        white_font + PROMPT).strip()  # has > to prompt the user for input and .strip() to remove any whitespaces before or after the input
                 except KeyboardInterrupt:
                     print(
                         green_font + "\nYou are now exiting the chat client.")  # after using ctrl-c, lets the user know they are exiting the chat client
@@ -134,7 +223,7 @@ class ChatClient:
                     self.clientConnect(host, port)  # attempts to connect to the server using the provided host and port
 
                 elif text.startswith("/nick"):  # for when the user inputs the /nick command to set their nickname
-                    if self.sock is None:  # for when there is no connection to a server yet
+                    if self.session is None:  # for when there is no connection to a server yet
                         print(
                             yellow_font + "To set a nickname, you must /connect to a server first.")  # lets the user know that they must connect to a server before setting a nickname
                         continue  # continues to prompt the user for input
@@ -145,20 +234,20 @@ class ChatClient:
                             yellow_font + "Use this format: /nick <nickname>")  # provides user with correct format for the command
                         continue  # continues to prompt the user for input
                     self.nickname = parts[1]  # retrieves the nickname from the input
-                    sendObject(self.sock, {"type": "command", "command": "nick", "args": [
-                        self.nickname]})  # sends the nickname to the server as a command object to set the user's nickname
+                    self.runCommand("nick",
+                                    self.nickname)  # sends the nickname to the server as a command to set the user's nickname
 
                 elif text.startswith(
                         "/list"):  # for when the user inputs the /list command to request a list of available channels and the number of users in each channel
-                    if self.sock is None:  # for when there is no connection to a server yet
+                    if self.session is None:  # for when there is no connection to a server yet
                         print(
                             yellow_font + "To see a list of available channels and the # of users for each channel, you must /connect to a server first.")  # lets the user know that they must connect to a server before requesting a list
                         continue  # continues to prompt the user for input
-                    sendObject(self.sock, {"type": "command",
-                                           "command": "list"})  # sends the list command to the server as a command object to request the list of channels and # of users per channel
+                    self.runCommand(
+                        "list")  # sends the list command to the server to request the list of channels and # of users per channel
 
                 elif text.startswith("/who"):
-                    if self.sock is None:
+                    if self.session is None:
                         print(yellow_font + "You must /connect to a server first.")
                         continue
                     parts = text.split(maxsplit=1)
@@ -166,25 +255,23 @@ class ChatClient:
                         print(yellow_font + "Use this format: /who <channel>")
                         continue
                     channel = parts[1]
-                    sendObject(self.sock, {"type": "command", "command": "who", "args": [channel]})
+                    self.runCommand("who", channel)
 
                 elif text.startswith("/join"):  # for when the user inputs the /join command to join a specific channel
-                    if self.sock is None:  # for when there is no connection to a server yet
+                    if self.session is None:  # for when there is no connection to a server yet
                         print(
                             yellow_font + "To join a channel, you must /connect to a server first.")  # lets the user know that they must connect to a server before joining a channel
                         continue  # continues to prompt the user for input
-                    parts = text.split(
-                        maxsplit=1)  # splits the input text into parts based on whitespace, command entered and channel name
+                    parts = text.split()  # splits the input text into parts based on whitespace, command entered, channel name and replay count
                     if len(parts) < 2:  # for when the user forgets to include a channel name
                         print(
-                            yellow_font + "Use this format: /join <channel>")  # provides user with correct format for the command
+                            yellow_font + "Use this format: /join <channel> [n]")  # provides user with correct format for the command
                         continue  # continues to prompt the user for input
-                    channel = parts[1]  # retrieves the channel name from the input
-                    sendObject(self.sock, {"type": "command", "command": "join", "args": [
-                        channel]})  # sends the join command to the server as a command object to join the specified channel
+                    self.runCommand("join",
+                                    *parts[1:3])  # sends the join command to the server as a command to join the specified channel
 
                 elif text.startswith("/say"):
-                    if self.sock is None:
+                    if self.session is None:
                         print(yellow_font + "You must /connect to a server first.")
                         continue
                     parts = text.split(maxsplit=2)
@@ -192,12 +279,10 @@ class ChatClient:
                         print(yellow_font + "Use this format: /say <channel> <text>")
                         continue
                     channel, message = parts[1], parts[2]
-                    sendObject(self.sock, {"type": "command", "command": "say", "args": [
-                        channel, message
-                    ]})
+                    self.runCommand("say", channel, message)
 
                 elif text.startswith("/msg"):
-                    if self.sock is None:
+                    if self.session is None:
                         print(yellow_font + "You must /connect to a server first.")
                         continue
                     parts = text.split(maxsplit=2)
@@ -205,39 +290,49 @@ class ChatClient:
                         print(yellow_font + "Use this format: /msg <nickname> <text>")
                         continue
                     recipient, message = parts[1], parts[2]
-                    sendObject(self.sock, {"type": "command", "command": "msg", "args": [
-                        recipient, message
-                    ]})
+                    self.runCommand("msg", recipient, message)
 
                 elif text.startswith("/leave"):  # for when the user inputs the /leave command to leave a channel
-                    if self.sock is None:  # for when there is no connection to a server yet
+                    if self.session is None:  # for when there is no connection to a server yet
                         print(
                             yellow_font + "To leave a channel, you must /connect to a server first.")  # lets the user know that they must connect to a server before leaving a channel
                         continue  # continues to prompt the user for input
                     parts = text.split(
                         maxsplit=1)  # splits the input text into parts based on whitespace, command entered and channel name
                     args = [parts[1]] if len(parts) > 1 else []  # retrieves the channel name if provided
-                    sendObject(self.sock, {"type": "command", "command": "leave",
-                                           "args": args})  # sends the leave command to the server as a command object to leave the specified channel
+                    self.runCommand("leave",
+                                    *args)  # sends the leave command to the server as a command to leave the specified channel
+
+                elif text.startswith("/history"):  # for when the user wants to see what was said in a channel
+                    if self.session is None:
+                        print(yellow_font + "You must /connect to a server first.")
+                        continue
+                    parts = text.split()
+                    if len(parts) < 2:
+                        print(yellow_font + "Use this format: /history <channel> [n|since=<seq>]")
+                        continue
+                    self.runCommand("history", *parts[1:3])
+
+                elif text.startswith("/stats"):  # for when an admin asks for the server's metrics
+                    if self.session is None:
+                        print(yellow_font + "You must /connect to a server first.")
+                        continue
+                    parts = text.split(maxsplit=1)
+                    if len(parts) < 2:
+                        print(yellow_font + "Use this format: /stats <token>")
+                        continue
+                    self.runCommand("stats", parts[1])
+
+                elif text.startswith("/scrollback"):  # for when the user wants to see the messages drawn earlier again
+                    parts = text.split()
+                    count = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 50
+                    with self.print_lock:
+                        for line in list(self.renderer.scrollback)[-count:]:
+                            print(line)
 
                 elif text.startswith(
                         "/quit"):  # for when the user inputs the /quit command to disconnect from the server and exit the client
-                    sendObject(self.sock, {"type": "command",
-                                           "command": "quit"})  # sends the quit command to the server as a command object to disconnect from the server and leave the chat
-                    try:  # attempts to receive any final messages from the server before disconnecting
-                        obj = receiveObject(self.sock)  # receives an object from the server over the network socket
-                        if obj:  # if there is a message received from the server
-                            print(obj.get("info",
-                                          obj) + "\n")  # prints the received message to the console for the user to see
-                    except:  # for when there is an error receiving the message
-                        pass  # ignore the error and proceed to disconnect
-                    try:
-                        self.sock.close()  # closes the socket connection
-                        self.sock = None  # resets the socket to None and disconnects from the server
-                    except:
-                        pass
-                    if hasattr(self, "listener_thread"):
-                        self.listener_thread.join(timeout=1)
+                    self.disconnect()  # sends the quit command to the server and waits for it to disconnect
                     print(
                         red_font + "You have disconnected from the server.")  # lets the user know they have disconnected from the server
                     break  # breaks out of the input loop and exits the client
@@ -250,11 +345,14 @@ class ChatClient:
                         + green_font + "/connect <host> [port]" + blue_font + "- connect to a server\n"
                         + green_font + "/nick <nickname>" + blue_font + "- set your nickname\n"
                         + green_font + "/list" + blue_font + "- list channels and number of users\n"
-                        + green_font + "/join <channel>" + blue_font + "- join a channel\n"
+                        + green_font + "/join <channel> [n]" + blue_font + "- join a channel and see its last n messages\n"
+                        + green_font + "/history <channel> [n]" + blue_font + "- show recent messages of a channel\n"
                         + green_font + "/leave [<channel>]" + blue_font + "- leave a channel\n"
                         + green_font + "/say <channel> <text>" + blue_font + "- send message to a channel\n"
                         + green_font + "/msg <nickname> <text>" + blue_font + "- send private message\n"
                         + green_font + "/who <channel>" + blue_font + "- list users in a channel\n"
+                        + green_font + "/stats <token>" + blue_font + "- show server metrics (admins only)\n"
+                        + green_font + "/scrollback [n]" + blue_font + "- show the last n messages again\n"
                         + green_font + "/quit" + blue_font + "- disconnect from server\n"
                         + green_font + "/help" + blue_font + "- print this message\n"
                     )
@@ -5,29 +5,108 @@ from colorama import init, Fore
 
 init(autoreset=True)  # initialize colorama with auto reset to prevent color bleed in terminal
 
-from protocol import WrappedSocket, sendObject, \
-    receiveObject  # imports sendObject and receiveObject functions from protocol.py for sending and receiving messages
+from protocol import encodeObject, sendObject, sendFrame, acceptEncodings, binaryFrameObject, ENCODINGS, \
+    COMPRESSIONS, JSON_LINES, BINARY, receiveObject, collecting, BatchReplies  # imports sendObject and receiveObject functions from protocol.py for sending and receiving messages
+from timerwheel import TimerWheel  # imports the timer wheel that schedules client expiry and idle shutdown
+from workers import runWorkers, BusWait, BUS_TIMEOUT  # imports the multi-process worker mode
+from metrics import METRICS, serveMetrics  # imports the counters and histograms and their local endpoint
+from history import HistoryStore, HISTORY_COUNT, HISTORY_BYTES, HISTORY_MEMORY, \
+    HISTORY_PAGE  # imports the store of recent channel messages
+from messagelog import MessageLog, SEGMENT_BYTES, RETAIN_BYTES, \
+    RETAIN_SECONDS  # imports the on-disk log that keeps messages across restarts
+from eventlog import EventLog, parseSampling, LEVELS, DEBUG, INFO, WARNING, \
+    ERROR  # imports the log that writes server events from a background thread
+from directory import ChannelDirectory, CachedPage, parsePaging, sortChannels, sortKey, cursorKey, cursorOf, \
+    pageOf, listObject, whoObject, LIST_SORTS, WHO_SORTS, ALL, \
+    WATCH_LIMIT  # imports the cached /list and /who answers and the /watch subscriptions
+from ratelimit import RateLimits, classOf, parseLimit, POLICIES  # imports the per client command rate limits
+from connections import OutboundPolicy, ThreadedConnection, AsyncConnection, \
+    ClientRecord  # imports the queued connection objects used by the threaded and asyncio engines
+from capture import TrafficCapture  # imports the recorder of client traffic for benchmarks/replay.py
+from admission import Admission, acceptPending, BACKLOG, \
+    RETRY_AFTER  # imports the limits on new connections and the options of their sockets
 import socket  # import socket module for communication over the network
+import select  # import select module to wait for new connections on the listening socket
 import threading  # import threading module to allow multiple tasks to be run at once while over the same process
+import asyncio  # import asyncio module to serve many clients over non-blocking sockets in a single thread
 import argparse  # import argparse module to handle command line arguments
+import os  # import os module to check that the system can fork worker processes
+import sys  # import sys module to intern nicknames and channel names
+import hmac  # import hmac module to check the admin token in constant time
+import functools  # import functools module to hand each request to the broker the client it is asked for
+import signal  # import signal module to shut down cleanly on SIGTERM as well as Ctrl-C
 import \
     time  # import time module to handle the time out after 3 minutes of inactivity and the period of server rest/idle time
 
 MAX_THREADS = 4  # sets the maximum number of threads allowed to 4
+ENGINES = ("threads", "asyncio")  # the serving engines that can be picked from the command line
+MAX_BATCH_COMMANDS = 256  # the most commands a client may send in one batch frame
+SERVER_IDLE_SECONDS = 180  # the server shuts down after 3 minutes without any commands
+EXPIRY_TICK = 1.0  # how often in seconds the expiry scheduler looks for due timers
+IDLE_SHUTDOWN = "idle shutdown"  # the timer wheel key of the server wide idle shutdown timer
+DRAIN_SECONDS = 5.0  # how long a shutdown waits for commands in progress and queued writes before dropping clients
+DRAIN_POLL = 0.05  # how often in seconds a shutdown checks whether every client has been written out
+DRAIN_JOIN = 1.0  # how long the client threads get to exit once every connection has been closed
+SHUTDOWN_INFO = {"type": "info", "info": "Server is shutting down."}
+PRIVATE_PREFIX = "@"  # channel names may not start with it, older message logs kept private messages under it
+PRIVATE_LOG_FOLDER = "private"  # the subfolder of the message log that keeps private messages, by nickname
 
 # starts the ChatServer communication over the network
 class ChatServer:
     def __init__(self, port,
-                 debug, clientTimeout):  # ChatServer initialization function that takes the instance of the class, the port number, and the debug level
+                 debug, clientTimeout, engine="threads",
+                 outboundPolicy=None, encodings=ENCODINGS, adminToken=None, metricsPort=None, rateLimits=None,
+                 history=None, historyReplay=0, messageLog=None, eventLog=None, compressions=COMPRESSIONS,
+                 drainSeconds=DRAIN_SECONDS, admission=None, capture=None):  # ChatServer initialization function that takes the instance of the class, the port number, and the debug level
         self.port = port  # sets the port number for the server
+        self.engine = engine  # which engine serves the clients, a thread per client or the asyncio event loop
+        self.outboundPolicy = outboundPolicy or OutboundPolicy()  # the limits for each client's outbound queue
+        self.admission = admission or Admission()  # the limits on new connections and the options of their sockets
+        self.encodings = encodings  # the frame encodings a client may pick during its hello handshake
+        self.compressions = compressions  # the stream compressions a client may ask for during its hello handshake
+        self.rateLimits = rateLimits  # the command rate limits of every client, None for no limits
+        self.history = history  # the HistoryStore of recent channel messages, None to keep no history
+        self.historyReplay = historyReplay  # how many recent messages a client gets when it joins a channel
+        self.messageLog = messageLog  # the MessageLog that keeps messages on disk, None to keep them only in memory
+        self.privateLog = None  # the MessageLog of private messages, apart from the channels so history never reads it
         self.debug = debug  # sets the debug level for the server
-        self.clients = {}  # creates an empty dictionary to hold the connected clients
-        self.nicknames = set()  # creates an empty set to hold the nicknames of connected users
-        self.channels = {}  # creates an empty dictionary to hold the channels and which users are in them
-        self.lock = threading.Lock()  # creates a threading lock to prevent data crashes from handling of multiple clients accessing the same resources
+        # the EventLog the server's log lines go to, by default only printed at debug level 1
+        self.eventLog = eventLog or EventLog(DEBUG, console=debug == 1)
+        self.capture = capture  # the TrafficCapture that records what clients send, None to record nothing
+        self.adminToken = adminToken  # the token a client must give to /stats, None turns the command off
+        self.metricsPort = metricsPort  # the localhost port that serves the metrics to a scraper, None for no endpoint
+        if adminToken is not None or metricsPort is not None:  # nothing is recorded unless someone can read it
+            METRICS.enabled = True
+        self.closedBytesIn = 0  # the bytes moved by clients that have disconnected, the connected ones keep their own
+        self.closedBytesOut = 0
+        self.clients = {}  # creates an empty dictionary to hold the ClientRecord of each connected client socket
+        self.nicknames = {}  # creates an empty dictionary to find the client socket of each nickname in use
+        self.channels = {}  # creates an empty dictionary to hold the channels and the client sockets that are in them
+        # the shared state is split over several locks so a busy channel does not hold up the others:
+        #   registryLock  guards clients, nicknames, each user's nickname and the list of client threads
+        #   channelsLock  guards adding channels and their locks to channels and channelLocks
+        #   channelLocks  one lock per channel guards its set of members and that channel in each user's channels
+        # a thread that needs more than one takes them in that order, and never holds two channel locks at once.
+        # the history store has its own lock, which is only ever taken last, followed by the message log's queue,
+        # and so has the directory, which is changed under the channel lock whose membership changed
+        # channels are never removed, so looking one up without channelsLock is safe once it exists
+        self.registryLock = threading.Lock()
+        self.channelsLock = threading.Lock()
+        self.channelLocks = {}  # creates an empty dictionary to hold the lock of each channel
+        # the nicknames of each channel's members, kept ready for /list and /who and sending changes to /watch
+        self.directory = ChannelDirectory(self.sendPage)
         self.recentActivity = time.time()  # variable to store the current timestamp for idle shutdown
         self.clientTimeout = clientTimeout  # the amount of idle time by a client before disconnecting them (0 is disabled)
-        self.recentClientActivity = {}  # creates an empty dictionary to store the time of the last message from each client
+        self.timers = TimerWheel(EXPIRY_TICK)  # holds one inactivity timer per client plus the idle shutdown timer
+        self.timers.schedule(IDLE_SHUTDOWN, self.recentActivity + SERVER_IDLE_SECONDS)
+        self.stopping = threading.Event()  # set when the server should shut down
+        self.drainSeconds = drainSeconds  # how long a shutdown may take before the remaining clients are dropped
+        self.draining = False  # set once the clients have been told about the shutdown, later commands are ignored
+        self.inFlight = 0  # commands being handled by client threads right now, a shutdown waits for them
+        self.running = threading.Condition()  # guards inFlight and wakes a shutdown waiting for it to reach 0
+        self.bus = None  # the link to the channel broker when this server is one of several workers
+        self.reusePort = False  # lets several worker processes listen on the same port
+        self.loop = None  # the event loop of the asyncio engine while it is running
         self.thread_limit = threading.Semaphore(MAX_THREADS)
         self.threads = []
         self.commands = {  # Dictionary of commands and corresponding functions
@@ -39,94 +118,378 @@ class ChatServer:
             "msg": self.Msg,
             "leave": self.Leave,
             "quit": self.Quit,
-            "help": self.Help
+            "help": self.Help,
+            "history": self.History,
+            "stats": self.Stats,
+            "watch": self.Watch,
+            "unwatch": self.Unwatch
         }
 
-    def logging(self, msg):  # function to log messages when debug level is set to 1
-        if self.debug == 1:  # for when debug level is 1
-            print(Fore.BLUE + "server log: ", msg)  # prints the debug message out
+    # queues a log event, the template is only filled in with the fields by the event log's thread if it is written
+    def logging(self, event, template, level=DEBUG, **fields):
+        if level >= self.eventLog.threshold:  # a level that is not written costs nothing more than this comparison
+            self.eventLog.log(level, event, template, fields)
 
-    # start the chatserver listening for client connections
+    # start the chatserver listening for client connections with the chosen engine
     def startServer(self):
+        if self.bus is not None and self.eventLog.path is not None:
+            self.eventLog.path += f".{self.bus.workerId}"  # one file per worker so their rotations do not collide
+        self.eventLog.open()
+        if self.bus is not None:  # a worker only sees its own clients, so one going quiet says nothing about the others
+            self.timers.cancel(IDLE_SHUTDOWN)
+        if self.capture is not None:
+            if self.bus is not None:
+                self.capture.path += f".{self.bus.workerId}"  # one capture per worker
+            self.capture.open()
+        if threading.current_thread() is threading.main_thread():  # signal handlers can only be set from the main thread
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop("SIGTERM"))
+        if self.messageLog is not None:
+            self.openMessageLog()
+        try:
+            self.startEngine()
+        finally:
+            if self.messageLog is not None:
+                self.messageLog.close()  # writes the messages still waiting for the disk
+            if self.privateLog is not None:
+                self.privateLog.close()
+            if self.capture is not None:
+                self.capture.close()  # writes the records still waiting for the writer thread
+            self.eventLog.close()  # writes the log events still waiting for the writer thread
+
+    # starts a graceful shutdown, safe to call from a signal handler since the engines notice within one tick
+    def stop(self, reason):
+        if not self.stopping.is_set():
+            print(Fore.RED + f"\nThe server is shutting down from {reason}...")
+        self.stopping.set()
+
+    def startEngine(self):
+        if self.metricsPort is not None:
+            port = self.metricsPort + (self.bus.workerId if self.bus is not None else 0)  # one port per worker
+            serveMetrics(port, self.gauges)
+            print(Fore.GREEN + f"Metrics are served on http://127.0.0.1:{port}/metrics")
+        if self.engine == "asyncio":  # for when the event loop engine was picked on the command line
+            self.startAsyncServer()
+        else:
+            self.startThreadedServer()
+
+    # opens the message log, one folder per worker, and fills the channel history back in from it
+    def openMessageLog(self):
+        if self.bus is not None:
+            self.messageLog.folder = os.path.join(self.messageLog.folder, f"worker-{self.bus.workerId}")
+        self.messageLog.open()
+        log = self.messageLog
+        self.privateLog = MessageLog(os.path.join(log.folder, PRIVATE_LOG_FOLDER), log.segmentBytes, log.retainBytes,
+                                     log.retainSeconds, log.sync)
+        self.privateLog.open()
+        if self.history is None:
+            return
+        for channel in self.messageLog.channels():
+            if isChannelName(channel):  # private messages logged by older versions are left alone
+                entries = self.messageLog.last(channel, self.history.maxCount)
+                self.history.restore(channel, entries, self.messageLog.lastSeq.get(channel, 0) + 1)
+        self.history.log = self.messageLog  # every message recorded from now on goes to disk as well
+        print(Fore.GREEN + f"Messages are logged to {self.messageLog.folder}")
+
+    # start the thread per client engine
+    def startThreadedServer(self):
         netSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # creates a TCP socket for the server
+        if self.reusePort:  # for when other worker processes listen on the same port
+            netSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         netSock.bind(("", self.port))  # binds the socket to all interfaces on the specified port
-        netSock.listen(5)  # starts listening for any and all incoming connections
+        netSock.listen(self.admission.backlog)  # starts listening for any and all incoming connections
         print(
             Fore.GREEN + f"ChatServer is listening on port {self.port}")  # prints out that the server is listening on the specified port
+        expiry = threading.Thread(target=self.expiryLoop, daemon=True)  # runs the timers away from the accept loop
+        expiry.start()
+        netSock.setblocking(False)  # the loop waits in select and then takes every connection that is waiting
         try:  # for handling keyboard interrupts to shut down the server cleanly
-            while True:  # while the server is currently running
-                if time.time() - self.recentActivity > 180:  # checks if the server has been idle for more than 3 minutes or 180 seconds
-                    print(
-                        Fore.YELLOW + "The server has been idle for 3 minutes. It is now shutting down.")  # prints out that the server is shutting down due to inactivity
-                    break  # breaks out of the loop to shut down the server
-
-
-                # Loops through clients and disconnects if a timeout is detected
-                if self.clientTimeout > 0:
-                    for client in list(self.recentClientActivity.keys()):
-                        if time.time() - self.recentClientActivity[client] > self.clientTimeout:
-                            sendObject(client, {
-                                "type": "info",
-                                "info": f"You have been disconnected from the server due to inactivity for {self.clientTimeout} seconds."
-                            })
-                            self.quitProcess(client)
-
-                netSock.settimeout(1)  # sets a timeout of 1 second for allowing the acceptance of new connections
-                try:  # tries to accept a new client connection
-                    chatClientSock, address = netSock.accept()  # successfully accepts a new client connection
-                    wrapped_socket = WrappedSocket(chatClientSock)
-                    self.logging(
-                        Fore.BLUE + f"Accepted connection from {address}")  # logs the accepted connection when debug level is set to 1
-                except socket.timeout:  # handles the exception for when the timeout period is reached without a new connection
-                    continue  # continues to the next iteration of the loop if no connection was made within the timeout period
-                self.thread_limit.acquire()  # gets the thread limit semaphore before starting a new thread
-
-                with self.lock:
-                    self.threads = [th for th in self.threads if th.is_alive()]  # cleanup dead threads
-                t = threading.Thread(target=self.clientConnections, args=(wrapped_socket,))
-                t.start()  # starts a new thread to handle the connected client
-                with self.lock:
-                    self.threads.append(t)  # append to thread list to keep track of it
+            while not self.stopping.is_set():  # while the server is currently running
+                # waits at most one tick so the loop notices when the server is stopping
+                ready, _, _ = select.select([netSock], [], [], EXPIRY_TICK)
+                if not ready:  # no connection was made within the timeout period
+                    continue
+                for chatClientSock, address in acceptPending(netSock):
+                    self.startClientThread(chatClientSock, address)
 
         except KeyboardInterrupt:  # handles the keyboard interrupt exception for clean shutdown with Ctrl-C
             print(Fore.RED + "\nThe server is shutting down from Ctrl-C...")
         finally:
-            # Notify all connected clients about server shutdown
-            for sock in list(self.clients.keys()):
-                try:
-                    sendObject(sock, {"type": "info", "info": "Server is shutting down."})
-                except Exception as e:
-                    self.logging(f"Failed to send shutdown message to a client: {e}")
-                finally:
-                    self.quitProcess(sock)  # clean up the client socket and internal data
+            self.stopping.set()  # stops the expiry thread
+            netSock.close()  # stops accepting connections before the clients are told
+            started = time.monotonic()
+            deadline = started + self.drainSeconds
+            clients = self.notifyShutdown()  # notify all connected clients about server shutdown
+            with self.running:  # the commands already being handled get until the deadline to finish
+                self.running.wait_for(lambda: self.inFlight == 0, max(0.0, deadline - time.monotonic()))
+            self.closeClients(clients)  # every connection's writer thread writes out its queue at the same time
+            while time.monotonic() < deadline and any(sock.queuedBytes for sock in clients):
+                time.sleep(DRAIN_POLL)
+            self.finishDrain(clients, started)
+            joinBy = time.monotonic() + DRAIN_JOIN  # the dropped sockets wake their threads, so this is short
+            with self.registryLock:
+                threads = list(self.threads)
+            for t in threads:
+                t.join(timeout=max(0.0, joinBy - time.monotonic()))
+
+    # starts the thread of a client accepted by the threaded engine, or turns it away when the server is full
+    def startClientThread(self, chatClientSock, address):
+        with self.registryLock:
+            self.threads = [th for th in self.threads if th.is_alive()]  # cleanup dead threads
+            connected = len(self.threads)
+        if not self.admitConnection(connected, address, MAX_THREADS):  # every client needs a thread of its own
+            self.admission.refuse(chatClientSock)
+            return
+        self.admission.tune(chatClientSock)
+        wrapped_socket = ThreadedConnection(chatClientSock, self.outboundPolicy)
+        self.logging("accept", "Accepted connection from {address}",
+                     address=address)  # logs the accepted connection when debug level is set to 1
+        self.thread_limit.acquire()  # gets the thread limit semaphore before starting a new thread
+        t = threading.Thread(target=self.clientConnections, args=(wrapped_socket,))
+        t.start()  # starts a new thread to handle the connected client
+        with self.registryLock:
+            self.threads.append(t)  # append to thread list to keep track of it
+
+    # checks whether one more client fits, used by both engines, a client that does not is logged and counted
+    def admitConnection(self, connected, address, limit=None):
+        if self.admission.admit(connected, limit):
+            return True
+        self.logging("refuse", "Turned away a connection from {address}, {connected} clients are connected",
+                     address=address, connected=connected)
+        if METRICS.enabled:
+            METRICS.count("connections.refused")
+        return False
+
+    # logs how fast connections are being admitted and refused, at most once every few seconds
+    def reportAdmission(self):
+        report = self.admission.report()
+        if report is not None:
+            admitted, refused, seconds = report
+            self.logging("admission", "Admitted {admitted} connections ({rate:.1f}/s) and refused {refused} "
+                                      "in the last {seconds:.0f}s", INFO,
+                         admitted=admitted, refused=refused, seconds=seconds, rate=admitted / seconds)
+
+    # start the asyncio engine that serves every client from one event loop over non-blocking sockets
+    def startAsyncServer(self):
+        raiseFileLimit()  # lets the process hold as many sockets as the system allows
+        try:
+            asyncio.run(self.serveAsync())
+        except KeyboardInterrupt:  # handles the keyboard interrupt exception for clean shutdown with Ctrl-C
+            print(Fore.RED + "\nThe server is shutting down from Ctrl-C...")
+
+    async def serveAsync(self):
+        self.loop = asyncio.get_running_loop()
+        for signum, reason in ((signal.SIGINT, "Ctrl-C"), (signal.SIGTERM, "SIGTERM")):
+            try:  # the loop drains the clients itself instead of being interrupted
+                self.loop.add_signal_handler(signum, self.stop, reason)
+            except (NotImplementedError, RuntimeError):  # not available on Windows or outside the main thread
+                pass
+        netServer = await self.loop.create_server(lambda: AsyncConnection(self, self.outboundPolicy), "", self.port,
+                                                  backlog=self.admission.backlog,
+                                                  reuse_port=self.reusePort or None)  # listens for connections on all interfaces
+        print(Fore.GREEN + f"ChatServer is listening on port {self.port} (asyncio engine)")
+        try:
+            while not self.stopping.is_set():  # runs until the server has been idle for 3 minutes
+                await asyncio.sleep(EXPIRY_TICK)  # the command handlers run between the expiry ticks as data arrives
+                self.runExpiry()
+        finally:
+            netServer.close()  # stops accepting new connections
+            started = time.monotonic()
+            deadline = started + self.drainSeconds
+            clients = self.notifyShutdown()  # notify all connected clients about server shutdown
+            # commands run on this loop, so none is halfway through here and the clients can be closed right away
+            self.closeClients(clients)
+            while time.monotonic() < deadline and any(sock.queuedBytes for sock in clients):
+                await asyncio.sleep(DRAIN_POLL)  # the transports write out their buffers in the meantime
+            self.finishDrain(clients, started)
+
+    # the expiry thread of the threaded engine, it runs the due timers once per tick until the server stops
+    def expiryLoop(self):
+        while not self.stopping.wait(EXPIRY_TICK):
+            try:
+                self.runExpiry()
+            except Exception as e:  # keeps the timers running if one expiry fails
+                self.logging("expiry error", "There is an expiry error: {error}", ERROR, error=e)
+
+    # handles the timers that are due, the activity times are only read here so recording activity stays O(1)
+    def runExpiry(self):
+        now = time.time()
+        for key in self.timers.advance(now):
+            if key == IDLE_SHUTDOWN:
+                self.checkServerIdle(now)
+            else:
+                self.checkClientIdle(key, now)
+        self.dropSlowClients()  # disconnects any clients that are not reading what is sent to them
+        self.reportAdmission()
+
+    # checks if the server has been idle for more than 3 minutes or 180 seconds
+    def checkServerIdle(self, now):
+        if now - self.recentActivity >= SERVER_IDLE_SECONDS:
+            print(
+                Fore.YELLOW + "The server has been idle for 3 minutes. It is now shutting down.")  # prints out that the server is shutting down due to inactivity
+            self.stopping.set()
+        else:  # there was activity since the timer was set, so it is moved to the new deadline
+            self.timers.schedule(IDLE_SHUTDOWN, self.recentActivity + SERVER_IDLE_SECONDS)
 
-            netSock.close()  # finally closes the server socket when the server is shutting down
-            for t in self.threads:
-                t.join(timeout=1)
+    # disconnects a client whose inactivity timer is due, unless it has been active since the timer was set
+    def checkClientIdle(self, client, now):
+        user = self.clients.get(client)
+        if user is None:  # the client has already disconnected
+            return
+        lastActivity = user.lastActivity
+        if now - lastActivity >= self.clientTimeout:
+            sendObject(client, {
+                "type": "info",
+                "info": f"You have been disconnected from the server due to inactivity for {self.clientTimeout} seconds."
+            })
+            self.quitProcess(client)
+        else:
+            self.timers.schedule(client, lastActivity + self.clientTimeout)
+
+    # disconnects clients whose outbound queue has stayed over the limits of the outbound policy
+    def dropSlowClients(self):
+        now = time.time()
+        with self.registryLock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.isSlow(now):
+                self.logging("slow client", "Dropping a slow client with {queued} bytes queued", WARNING,
+                             queued=client.queuedBytes)
+                if METRICS.enabled:
+                    METRICS.count("connections.slow")
+                client.abort()  # the client is removed from the dictionaries once its connection closes
+
+    # Notify all connected clients about server shutdown, returns the clients that were told
+    def notifyShutdown(self):
+        self.draining = True  # commands that arrive from now on are ignored
+        with self.registryLock:
+            clients = list(self.clients)
+        frames = {}  # the notice is encoded once per encoding, and only queued, so no client waits for another
+        for sock in clients:
+            try:
+                frame = frames.get(sock.encoding)
+                if frame is None:
+                    frame = frames[sock.encoding] = encodeObject(SHUTDOWN_INFO, sock.encoding)
+                sendFrame(sock, frame)
+            except Exception as e:
+                self.logging("shutdown error", "Failed to send shutdown message to a client: {error}", WARNING,
+                             error=e)
+        return clients
+
+    # cleans up every client and closes its connection once what is queued for it has been written
+    def closeClients(self, clients):
+        for sock in clients:
+            self.quitProcess(sock)
+
+    # drops the clients whose queues were not written out by the deadline and logs how the shutdown went
+    def finishDrain(self, clients, started):
+        stuck = [sock for sock in clients if sock.queuedBytes]
+        for sock in stuck:
+            sock.abort()
+        self.logging("drain", "Shut down {clients} clients in {seconds:.2f}s, {dropped} were dropped with data queued",
+                     INFO, clients=len(clients), dropped=len(stuck), seconds=time.monotonic() - started)
 
     # function to handle the individual client connections
     def clientConnections(self, sock):
-        user = {"nickname": None,
-                "channels": set()}  # initializes a user dictionary to hold the nickname and channels for the connected client
-        self.clients[sock] = user  # adds the connected client socket and user info to the clients dictionary
-        self.recentClientActivity[sock] = time.time()  # set initial inactivity timer for new client
+        user = self.registerClient(sock)  # adds the connected client to the server's dictionaries
         try:  # attempts to handle communication with the connected client
             while True:  # while the client is connected
                 obj = receiveObject(sock)  # receives an object from the client socket
                 if obj is None:  # if no object is received
                     break  # the loop is broken and the client is disconnected
-                if not isinstance(obj, dict):  # if the message is empty
-                    continue  # continues to the next iteration of the loop because there is no message to process
-                if obj.get("type") != "command":  # if the object is not a valid command
-                    continue  # continues to the next iteration of the loop because the command was invalid
-                self.recentClientActivity[sock] = time.time()
-                self.takingCommands(sock, user, obj)  # process the valid command received from the client
+                if self.capture is not None:
+                    self.capture.record(sock, obj)
+                with self.running:  # counted so a shutdown can wait for the command to finish
+                    self.inFlight += 1
+                try:
+                    delay = self.handleIncoming(sock, user, obj)  # process the object received from the client
+                finally:
+                    with self.running:
+                        self.inFlight -= 1
+                        self.running.notify_all()
+                while delay:  # the command was held back by the rate limits, nothing more is read until it runs
+                    time.sleep(delay)
+                    delay = self.handleIncoming(sock, user, obj)
         except Exception as e:  # handles any errors that occur during client communication
-            self.logging(f"There is a client error: {e}")  # logs the client error
+            self.logging("client error", "There is a client error: {error}", WARNING, error=e)  # logs the client error
         finally:
             self.quitProcess(sock)  # finally cleans up the client connection when done
             self.thread_limit.release()  # releases the thread limit semaphore when done handling the client
 
+    # registers a newly connected client, used by both engines
+    def registerClient(self, sock):
+        # initializes a user record to hold the nickname, channels, rate limits and last activity of the connected client
+        user = ClientRecord(self.rateLimits.newLimiter() if self.rateLimits is not None else None, time.time())
+        with self.registryLock:
+            self.clients[sock] = user  # adds the connected client socket and user info to the clients dictionary
+        if self.capture is not None:
+            self.capture.opened(sock)
+        if METRICS.enabled:
+            METRICS.count("connections.accepted")
+        if self.clientTimeout > 0:  # set initial inactivity timer for new client
+            self.timers.schedule(sock, user.lastActivity + self.clientTimeout)
+        return user
+
+    # checks an object received from a client and runs it if it is a valid command, used by both engines,
+    # returns the seconds to wait before handing the same object in again when the rate limits held it back,
+    # or on the asyncio engine the future to wait for when the command is waiting for the channel broker
+    def handleIncoming(self, sock, user, obj):
+        if not isinstance(obj, dict) or self.draining:  # if the message is empty or the server is shutting down
+            return  # there is no message to process
+        if obj.get("type") == "hello":  # the client is offering frame encodings before it sends any commands
+            if not sock.handshaking:  # only the first frame can switch the encoding, the bytes behind it wait for it
+                return
+            encoding = acceptEncodings(sock, obj, self.encodings, self.compressions)
+            if sock.compression is not None and METRICS.enabled:
+                METRICS.count(f"connections.compressed.{sock.compression}")
+            self.logging("hello", "Client agreed on {encoding} frames and {compression} compression",
+                         encoding=encoding, compression=sock.compression)
+            return
+        if obj.get("type") == "batch":  # the client sent several commands in one frame
+            user.lastActivity = time.time()
+            return self.takingBatch(sock, user, obj)
+        if obj.get("type") != "command":  # if the object is not a valid command
+            return  # the command was invalid
+        user.lastActivity = time.time()
+        return self.takingCommands(sock, user, obj)  # process the valid command received from the client
+
+    # runs the commands of a batch frame in order and answers with one batch frame holding every command's replies
+    def takingBatch(self, sock, user, obj):
+        commands = obj.get("commands")
+        if not isinstance(commands, list) or len(commands) > MAX_BATCH_COMMANDS:
+            sendObject(sock, {
+                "type": "error",
+                "error": f"A batch must be a list of at most {MAX_BATCH_COMMANDS} commands."
+            })
+            return
+        # a batch held back by the rate limits or the broker is handed in again, the same object, and carries on
+        # after the commands it already ran; what it ran is kept on the server so a client cannot make it up
+        if user.batch is not None and user.batch[0] is obj:
+            results = user.batch[1]
+        else:
+            results = []
+            user.batch = (obj, results)
+        quitting = None
+        for entry in commands[len(results):]:
+            if isinstance(entry, dict) and entry.get("command") == "quit":  # quit closes the connection, so it runs last
+                quitting = entry
+                break
+            replies = BatchReplies()  # every reply the handler sends to this client is collected here instead of being sent
+            sock.replies = replies
+            try:
+                if isinstance(entry, dict) and "command" in entry:
+                    delay = self.takingCommands(sock, user, entry)
+                    if delay:  # waits for the rate limits or the broker, the command runs again from the start
+                        return delay
+                else:
+                    sendObject(sock, {"type": "error", "error": "Unknown command"})
+            finally:
+                sock.replies = None
+            results.append({"id": entry.get("id") if isinstance(entry, dict) else None, "replies": replies})
+        user.batch = None
+        sendObject(sock, {"type": "batch", "results": results})
+        if quitting is not None:
+            self.takingCommands(sock, user, quitting)
+
     # function to process valid commands
     def takingCommands(self, sock, user, obj):  # processes the command received from the client
         command = obj["command"]  # retrieves the valid command from the received object
@@ -135,13 +498,73 @@ class ChatServer:
 
         self.recentActivity = time.time()  # updates the last activity timestamp to the current time
 
+        limiter = user.limiter
+        if limiter is not None and user.awaiting is None:  # a command run again for the broker's answer was charged already
+            delay = limiter.check(command, self.recentActivity)
+            if delay:
+                return self.throttle(sock, command, delay)
+
         # Execute command if it exists, respond with an error if not
         handler = self.commands.get(command)
         if handler:
-            handler(sock, user, args)
+            start = time.perf_counter() if METRICS.enabled else None  # times the handler, including its replies and broadcasts
+            try:
+                handler(sock, user, args)
+            except BusWait as wait:  # the connection runs the command again once the broker has answered
+                return wait.future
+            finally:
+                if user.awaiting is not None and user.awaiting.done():  # an answer the handler did not ask for again
+                    user.awaiting = None
+            if start is not None:
+                METRICS.observe(f"command.{command}.seconds", time.perf_counter() - start)
         else:
+            if METRICS.enabled:
+                METRICS.count("command.unknown")
             sendObject(sock, {"type": "error", "error": "Unknown command"})
 
+    # sends msg to the channel broker and returns its answer, None if it did not answer in time. The threaded engine
+    # waits for it on the client's own thread. The asyncio engine must not block the event loop, so the handler is
+    # stopped with BusWait and the command is run again once the answer is in, when this returns it straight away
+    def askBus(self, user, msg):
+        if self.loop is None:
+            return self.bus.wait(msg)
+        waiting = user.awaiting
+        if waiting is not None and waiting.done():
+            user.awaiting = None
+            return waiting.result()
+        loop = self.loop
+        future = user.awaiting = loop.create_future()
+        user.request = msg
+
+        def answer(reply):  # called on the event loop with the broker's answer, or None once the time is up
+            if not future.done():
+                future.set_result(reply)
+                timeout.cancel()
+                self.bus.forget(requestId)
+        timeout = loop.call_later(BUS_TIMEOUT, answer, None)
+        requestId = self.bus.request(msg, lambda reply: loop.call_soon_threadsafe(answer, reply))
+        raise BusWait(future)
+
+    # undoes what a request to the broker did for a command that will not run again because its client has gone
+    def abandonRequest(self, msg, reply):
+        if msg["op"] == "claim" and reply is not None and reply["ok"]:  # the old nickname has been released already
+            self.bus.unclaim(msg["nick"], None)
+
+    # handles a command that is over the client's rate limits according to the rate limit policy
+    def throttle(self, sock, command, delay):
+        if METRICS.enabled:
+            METRICS.count(f"throttled.{classOf(command)}")
+        policy = self.rateLimits.policy
+        if policy == "queue":  # the connection hands the command in again after delay
+            return delay
+        if policy == "drop":
+            return None
+        sendObject(sock, {
+            "type": "error",
+            "error": f"You are sending commands too fast. Try again in {delay:.1f} seconds."
+        })
+        return None
+
     # nickname command server-side function
     def Nicknames(self, sock, user, args):  # function to handle the /nick command from the client
         if len(args) < 1:  # for when no nickname argument is provided
@@ -150,40 +573,59 @@ class ChatServer:
                 "error": "There was no nickname provided."
             })  # send an error message back to the client that no nickname was provided
             return  # exit the function early since there is no nickname to process
-        newName = args[0]  # retrieves the new nickname from the command arguments
-        with self.lock:  # uses a threading lock to prevent data corruption when accessing shared resources
+        newName = internName(args[0])  # retrieves the new nickname from the command arguments
+        if self.bus is not None and not self.bus.claim(newName, user.nickname, functools.partial(self.askBus, user)):  # the broker checks every worker
+            sendObject(sock, {
+                "type": "error",
+                "error": "This nickname is already taken."
+            })
+            return
+        with self.registryLock:  # the nickname index is shared by every client
+            if self.clients.get(sock) is not user:  # the client disconnected while the command was running
+                if self.bus is not None:  # its old nickname has already been released, so only the new one is left
+                    self.bus.unclaim(newName, None)
+                return
             if newName in self.nicknames:  # checks if the new nickname is already being used by another client
+                if self.bus is not None:  # the broker gave it out, so it goes back and the client keeps its old one
+                    self.bus.unclaim(newName, user.nickname)
                 sendObject(sock, {
                     "type": "error",
                     "error": "This nickname is already taken."
                 })  # if the nickname is already being used, send an error message back to the client
                 return  # exit the function early since the nickname is already being used
-            oldName = user["nickname"]  # retrieves the old nickname of the client
-            if oldName in self.nicknames:  # for when the old nickname exists in the set of nicknames
-                self.nicknames.remove(oldName)  # remove the old nickname from the list of nicknames
-            user["nickname"] = newName  # lets the user pick a new nickname by setting it in the user dictionary
-            self.nicknames.add(newName)  # adds the new nickname to the list of nicknames
+            oldName = user.nickname  # retrieves the old nickname of the client
+            if oldName in self.nicknames:  # for when the old nickname exists in the nickname index
+                del self.nicknames[oldName]  # remove the old nickname from the nickname index
+            user.nickname = newName  # lets the user pick a new nickname by setting it in the user record
+            self.nicknames[newName] = sock  # maps the new nickname to the client socket
+            for channel in list(user.channels):  # renames the user in the directory of each channel they are in
+                with self.channelLocks[channel]:
+                    self.directory.rename(channel, oldName, newName)
         sendObject(sock, {
             "type": "event",
             "event": "your name was changed",
             "nickname": newName
         })  # sends an event object back to the client confirming that the user has changed their nickname
-        self.logging(f"User set nickname to {newName}")  # sends a log message that the user has set their nickname
+        self.logging("nick", "User set nickname to {nickname}", INFO, nickname=newName)  # sends a log message that the user has set their nickname
 
     # list command server-side function
     def List(self, sock, user, args):  # function to handle the /list command from the client
-        with self.lock:  # uses a threading lock to prevent data corruption when accessing shared resources
-            NamesAndNumbers = {
-                # creates a dictionary comprehension to store the channel names and the number of users in each channel
-                channel: len(users)  # for each channel, get the length of the users set to count the number of users
-                for channel, users in self.channels.items()
-                # iterates through each channel and its associated users in the channels dictionary
-            }
-        sendObject(sock, {
-            "type": "event",
-            "event": "list of channels",
-            "channels": NamesAndNumbers
-        })  # sends an event object back to the client with the list of channels and the number of users in each channel
+        try:
+            sort, after, limit = parsePaging(args, LIST_SORTS)
+            if self.bus is not None:  # the broker knows the channels of every worker, so there is nothing cached
+                items = sortChannels(self.bus.listChannels(functools.partial(self.askBus, user)), sort)
+                channels, more = pageOf(items, [sortKey(sort, item) for item in items], cursorKey(sort, after), limit)
+                page = CachedPage(None, listObject(dict(channels), None, len(items),
+                                                   cursorOf(sort, channels[-1]) if more else None))
+            else:
+                page = self.directory.listPage(sort, after, limit)
+        except ValueError:
+            sendObject(sock, {
+                "type": "error",
+                "error": "Usage: /list [sort=name|size] [after=<cursor>] [limit=<n>]"
+            })
+            return
+        self.sendPage(sock, page)  # sends the list of channels and the number of users in each channel
 
     # list nicknames of clients in channel
     def Who(self, sock, user, args):
@@ -195,23 +637,69 @@ class ChatServer:
             return
 
         channel = args[0]  # get the requested channel name
-        with self.lock:  # thread-safe access to shared resources
-            if channel not in self.channels:  # channel does not exist
-                sendObject(sock, {
-                    "type": "error",
-                    "error": f"Channel '{channel}' does not exist."
-                })
-                return
+        try:
+            sort, after, limit = parsePaging(args[1:], WHO_SORTS)
+            if self.bus is not None:  # the broker knows the members on every worker
+                members = self.bus.who(channel, functools.partial(self.askBus, user))
+                page = None
+                if members is not None:
+                    items = sortChannels(members, sort)
+                    users, more = pageOf(items, [sortKey(sort, item) for item in items], cursorKey(sort, after), limit)
+                    page = CachedPage(None, whoObject(channel, [nickname for nickname, _ in users], None, len(items),
+                                                      cursorOf(sort, users[-1]) if more else None))
+            else:
+                page = self.directory.whoPage(channel, after, limit, sort)
+        except ValueError:
+            sendObject(sock, {
+                "type": "error",
+                "error": "Usage: /who <channel> [sort=joined|name] [after=<cursor>] [limit=<n>]"
+            })
+            return
+        if page is None:  # channel does not exist
+            sendObject(sock, {
+                "type": "error",
+                "error": f"Channel '{channel}' does not exist."
+            })
+            return
+        self.sendPage(sock, page)
 
-            users_in_channel = list(self.channels[channel])  # list of nicknames in the channel
+    # watch command server-side function, sends a snapshot of a channel or of every channel and then each change to it
+    def Watch(self, sock, user, args):
+        channel = args[0] if args else ALL
+        if self.bus is not None:  # the directory only knows the members on this worker
+            sendObject(sock, {
+                "type": "error",
+                "error": "/watch is not available while the server runs several workers."
+            })
+            return
+        try:
+            watched = self.directory.watch(sock, channel)
+        except ValueError:
+            sendObject(sock, {
+                "type": "error",
+                "error": f"You can watch at most {WATCH_LIMIT} channels at once."
+            })
+            return
+        if not watched:
+            sendObject(sock, {
+                "type": "error",
+                "error": f"Channel '{channel}' does not exist."
+            })
 
+    def Unwatch(self, sock, user, args):
+        stopped = self.directory.unwatch(sock, args[0] if args else None)
         sendObject(sock, {
-            "type": "event",
-            "event": "channel users",
-            "channel": channel,
-            "users": users_in_channel
+            "type": "info",
+            "info": f"Stopped watching {', '.join(sorted(stopped))}." if stopped else "You were not watching that."
         })
 
+    # sends a /list or /who answer or a /watch event, as the frame that was encoded when the page was cached when possible
+    def sendPage(self, sock, page):
+        if collecting(sock) is None:
+            sendFrame(sock, page.frame(sock.encoding))
+        else:  # batch replies need the object
+            sendObject(sock, page.obj)
+
     # join command server-side function
     def Join(self, sock, user, args):  # function to handle the /join command from the client
         if len(args) < 1:  # for when no channel argument is provided
@@ -220,20 +708,36 @@ class ChatServer:
                 "error": "No channel was specified."
             })  # send an error message back to the client that the user did not specify a channel that they wanted to join
             return  # exit the function early since there is no channel to process
-        channel = args[0]  # retrieves the channel name that the user would like to joinfrom the command arguments
-        with self.lock:  # uses a threading lock to prevent data corruption when accessing shared resources
-            if channel not in self.channels:  # for when the channel does not already exist
-                self.channels[channel] = set()  # creates a new set for the channel to hold the users that join it
-            nickname = user["nickname"]  # retrieves the nickname of the user from the user dictionary
-            if nickname is None:  # for when the user has not picked a nickname yet
-                sendObject(sock, {
-                    "type": "error",
-                    "error": "Set nickname first using /nick."
-                })  # lets the user know that they must pick a nickname first before joining a channel
-                return  # exit the function early since the user has not picked a nickname yet
+        channel = internName(args[0])  # retrieves the channel name that the user would like to joinfrom the command arguments
+        if not isChannelName(channel):
+            sendObject(sock, {
+                "type": "error",
+                "error": f"Channel names cannot start with '{PRIVATE_PREFIX}'."
+            })
+            return
+        channelLock = self.addChannel(channel)  # creates the channel if it does not already exist
+        nickname = user.nickname  # retrieves the nickname of the user from the user record
+        if nickname is None:  # for when the user has not picked a nickname yet
+            if self.bus is not None:
+                self.bus.join(channel, None)  # the channel is still created on every worker
+            sendObject(sock, {
+                "type": "error",
+                "error": "Set nickname first using /nick."
+            })  # lets the user know that they must pick a nickname first before joining a channel
+            return  # exit the function early since the user has not picked a nickname yet
+        with channelLock:  # only this channel is locked, joins and messages in other channels carry on
             self.channels[channel].add(
-                nickname)  # adds the user's nickname to the set of users in the specified channel
-            user["channels"].add(channel)  # adds the channel to the user's set of joined channels
+                sock)  # adds the user's client socket to the set of members of the specified channel
+            user.join(channel)  # adds the channel to the user's set of joined channels
+            # quitProcess removes the client from the registry before it reads the user's channels,
+            # so a client that is gone by now may have missed this channel and is taken out again here
+            if sock not in self.clients:
+                self.channels[channel].discard(sock)
+                user.leave(channel)
+                return
+            self.directory.join(channel, user.nickname)  # read again here in case /nick renamed the user meanwhile
+        if self.bus is not None:
+            self.bus.join(channel, nickname)  # tells the broker so the other workers see the membership
         sendObject(sock, {
             "type": "event",
             "event": "you joined a channel",
@@ -246,10 +750,19 @@ class ChatServer:
             "user": nickname
         },
                      except_sock=sock)  # broadcasts that the user joined the channel to all clients in the channel except for the client who has just joined
-        self.logging(f"{nickname} has joined {channel}")  # logs that the user has joined the specified channel
+        if self.history is not None:  # catches the user up on what was said before they joined
+            replay = self.historyReplay
+            asked = len(args) > 1 and args[1].isdigit()
+            if asked:  # the client asked for a number of messages
+                replay = min(int(args[1]), HISTORY_PAGE)
+            if replay > 0:
+                entries = self.recentHistory(channel, replay)
+                if entries or asked:  # a client that did not ask is not told that there is nothing to replay
+                    self.sendHistory(sock, channel, entries, False)
+        self.logging("join", "{user} has joined {channel}", INFO, user=nickname, channel=channel)  # logs that the user has joined the specified channel
 
     def Say(self, sock, user, args):
-        nickname = user["nickname"]
+        nickname = user.nickname
         if nickname is None:
             sendObject(sock, {
                 "type": "error",
@@ -267,25 +780,24 @@ class ChatServer:
         channel = args[0]
         message = " ".join(args[1:])
 
-        with self.lock:
-            if channel not in user["channels"]:
-                sendObject(sock, {
-                    "type": "error",
-                    "error": f"You are not in channel '{channel}'. Join it first using /join <channel>."
-                })
-                return
-
-            self.tellAll(channel, {
-                "type": "message",
-                "channel": channel,
-                "user": nickname,
-                "message": message
+        if channel not in user.channels:
+            sendObject(sock, {
+                "type": "error",
+                "error": f"You are not in channel '{channel}'. Join it first using /join <channel>."
             })
+            return
 
-        self.logging(f'{nickname} said in {channel}: "{message}"')
+        self.tellAll(channel, {  # no lock is held while the message is handed to the members
+            "type": "message",
+            "channel": channel,
+            "user": nickname,
+            "message": message
+        })
+
+        self.logging("say", '{user} said in {channel}: "{message}"', user=nickname, channel=channel, message=message)
 
     def Msg(self, sock, user, args):
-        sender = user["nickname"]
+        sender = user.nickname
         if sender is None:
             sendObject(sock, {
                 "type": "error",
@@ -304,26 +816,26 @@ class ChatServer:
         message = " ".join(args[1:])
 
         # Find the socket of the target nickname
-        target_sock = None
-        with self.lock:
-            for s, u in self.clients.items():
-                if u["nickname"] == target_nick:
-                    target_sock = s
-                    break
-
-        if target_sock is None:
+        with self.registryLock:
+            target_sock = self.nicknames.get(target_nick)
+        private = {
+            "type": "message",
+            "from": sender,
+            "message": message
+        }
+
+        if target_sock is None and (self.bus is None or not self.bus.direct(target_nick, private, functools.partial(self.askBus, user))):
             sendObject(sock, {
                 "type": "error",
                 "error": f"User '{target_nick}' not found."
             })
             return
 
-        # Send message to the target user
-        sendObject(target_sock, {
-            "type": "message",
-            "from": sender,
-            "message": message
-        })
+        # Send message to the target user, the broker has already passed it on when the target is on another worker
+        if target_sock is not None:
+            sendObject(target_sock, private)
+        if self.privateLog is not None:  # kept on disk under the nickname it was sent to, never in a channel's log
+            self.privateLog.append(target_nick, encodeObject(private, BINARY))
 
         # Optionally, confirm to the sender that the message was sent
         sendObject(sock, {
@@ -331,36 +843,39 @@ class ChatServer:
             "info": f"Message sent to {target_nick}."
         })
 
-        self.logging(f'{sender} -> {target_nick}: "{message}"')
+        self.logging("msg", '{user} -> {target}: "{message}"', user=sender, target=target_nick, message=message)
 
     # leave command server-side function
     def Leave(self, sock, user, args):  # function to handle the /leave command from the client
-        nickname = user["nickname"]  # retrieves the nickname of the user from the user dictionary
+        nickname = user.nickname  # retrieves the nickname of the user from the user record
         if nickname is None:  # for when the user has not picked a nickname yet
             sendObject(sock, {
                 "type": "error",
                 "error": "You need to pick a nickname first using /nick."
             })  # lets the user know that they must pick a nickname first before leaving a channel
             return  # exit the function early since the user has not picked a nickname yet
-        if not user["channels"]:  # for when the user is not currently in any channels
+        if not user.channels:  # for when the user is not currently in any channels
             sendObject(sock, {
                 "type": "info",
                 "info": "You are not currently a part of any channels."
             })  # lets the user know that they are not currently in any channels to leave
             return  # exit the function early since the user is not in any channels
         leavingChannels = [args[0]] if args else list(
-            user["channels"])  # determines if a user want to leave all or just one specific channel
+            user.channels)  # determines if a user want to leave all or just one specific channel
         for channel in leavingChannels:  # iterates through each channel that the user wants to leave
-            if channel not in user["channels"]:  # for when the user is not in the specified channel
+            if channel not in user.channels:  # for when the user is not in the specified channel
                 sendObject(sock, {
                     "type": "error",
                     "error": f"You are not currently in channel '{channel}'."
                 })  # lets the user know that they are not in the specified channel that they are trying to leave
                 continue  # continues to the next iteration of the loop since the user is not in the specified channel
-            with self.lock:  # uses a threading lock to prevent data corruption when accessing shared resources
+            with self.channelLocks[channel]:  # only the channel being left is locked
                 self.channels[channel].discard(
-                    nickname)  # removes the user's nickname from the set of users in the specified channel
-                user["channels"].remove(channel)  # removes the channel from the user's set of joined channels
+                    sock)  # removes the user's client socket from the set of members of the specified channel
+                user.leave(channel)  # removes the channel from the user's set of joined channels
+                self.directory.leave(channel, nickname)
+            if self.bus is not None:
+                self.bus.leave(channel, nickname)  # tells the broker so the other workers see the membership
             sendObject(sock, {
                 "type": "event",
                 "event": "you left a channel",
@@ -373,7 +888,7 @@ class ChatServer:
                 "user": nickname
             },
                          except_sock=sock)  # notifies all other clients in the channel that the user has left, except for the client who has just left
-            self.logging(f"{nickname} has left {channel}")  # logs that the user has left the specified channel
+            self.logging("leave", "{user} has left {channel}", INFO, user=nickname, channel=channel)  # logs that the user has left the specified channel
 
     def Quit(self, sock, user, args):
         sendObject(sock, {  # sends the object information to the client confirming disconnection
@@ -387,48 +902,258 @@ class ChatServer:
         helpMessage = (  # prints out the help message with available commands
             "Commands:\n"
             "/nick <nickname>         -pick your nickname\n"
-            "/list                    -list the channels and the number of users in each channel\n"
-            "/who <channel>           -list the nicknames of all users in the specified channel\n"
-            "/join <channel>          -join a channel\n"
+            "/list [sort=size|name]   -list the channels and the number of users in each channel\n"
+            "/who <channel> [sort=joined|name] -list the nicknames of all users in the specified channel, in join order by default\n"
+            "      /list and /who take limit=<n> for one page and after=<next> for the page after it\n"
+            "/join <channel> [n]      -join a channel and see its last n messages\n"
             "/say <channel> <text>    -send a message to the specified channel (must already be joined)\n"
             "/msg <nickname> <text>   -send a private message to a specified user\n"
             "/leave [<channel>]       -leave a channel or all channels\n"
+            "/watch [<channel>]       -get the users of a channel, or every channel, and then each change\n"
+            "/unwatch [<channel>]     -stop watching a channel, or everything\n"
+            "/history <channel> [n]   -show the last n messages of a channel, or since=<seq> for the ones after seq\n"
             "/quit                    -disconnect from the server and leave the chat\n"
-            "/help                    -show this message"
+            "/help                    -show this message\n"
+            "/stats <token>           -show the server metrics (admins only)"
         )
         sendObject(sock, {  # sends the help message to the client with the available commands
             "type": "info",
             "info": helpMessage
         })
 
+    # history command server-side function, sends the newest n messages of a channel or the ones after a sequence number
+    def History(self, sock, user, args):
+        if len(args) < 1:
+            sendObject(sock, {
+                "type": "error",
+                "error": "Usage: /history <channel> [n|since=<seq>]"
+            })
+            return
+        channel = args[0]
+        if channel not in user.channels:
+            sendObject(sock, {
+                "type": "error",
+                "error": f"You are not in channel '{channel}'. Join it first using /join <channel>."
+            })
+            return
+        if self.history is None:
+            sendObject(sock, {
+                "type": "error",
+                "error": "This server does not keep channel history."
+            })
+            return
+        page = args[1] if len(args) > 1 else str(HISTORY_PAGE)
+        if page.startswith("since=") and page[6:].isdigit():  # the messages after the last one the client has seen
+            entries, more = self.historySince(channel, int(page[6:]))
+        elif page.isdigit():
+            entries, more = self.recentHistory(channel, min(int(page), HISTORY_PAGE)), False
+        else:
+            sendObject(sock, {
+                "type": "error",
+                "error": "Usage: /history <channel> [n|since=<seq>]"
+            })
+            return
+        self.sendHistory(sock, channel, entries, more)
+
+    # the newest count messages of a channel, reading the older ones from the message log when memory has too few
+    def recentHistory(self, channel, count):
+        if not isChannelName(channel):  # anything else in the log is not a channel's history
+            return []
+        entries = self.history.last(channel, count)
+        if self.messageLog is None or len(entries) >= count:
+            return entries
+        if not entries:
+            return self.messageLog.last(channel, count)
+        missing = count - len(entries)
+        first = entries[0][0]
+        older, _ = self.messageLog.read(channel, max(1, first - missing), missing)
+        return [entry for entry in older if entry[0] < first] + entries
+
+    # a page of the messages after seq, from the message log when memory no longer has the ones right after it
+    def historySince(self, channel, seq):
+        if not isChannelName(channel):
+            return [], False
+        entries, more = self.history.since(channel, seq)
+        if self.messageLog is None or (entries and entries[0][0] == seq + 1):
+            return entries, more
+        logged, loggedMore = self.messageLog.read(channel, seq + 1, HISTORY_PAGE)
+        if not logged or (entries and logged[0][0] >= entries[0][0]):
+            return entries, more
+        # the log can be a commit behind memory, so there is more whenever memory has newer messages
+        return logged, loggedMore or bool(entries and entries[-1][0] > logged[-1][0])
+
+    # sends a channel history header followed by the messages, as the frames that were stored when possible
+    def sendHistory(self, sock, channel, entries, more):
+        sendObject(sock, {
+            "type": "event",
+            "event": "channel history",
+            "channel": channel,
+            "count": len(entries),
+            "first": entries[0][0] if entries else None,  # the sequence numbers, so the client can page on with since
+            "last": entries[-1][0] if entries else None,
+            "more": more
+        })
+        for seq, frame in entries:
+            if collecting(sock) is None and sock.encoding == BINARY:
+                sendFrame(sock, frame)
+            else:  # other encodings and batch replies need the message object
+                sendObject(sock, binaryFrameObject(frame))
+
+    # admin command that sends the server's counters, histogram summaries and gauges
+    def Stats(self, sock, user, args):
+        # compares in constant time, so how long the check takes tells nothing about how much of the token matched
+        if self.adminToken is None or not args or \
+                not hmac.compare_digest(str(args[0]).encode(), self.adminToken.encode()):
+            sendObject(sock, {
+                "type": "error",
+                "error": "The stats are only available to admins."
+            })
+            return
+        stats = METRICS.snapshot()
+        stats["gauges"] = self.gauges()
+        sendObject(sock, {
+            "type": "event",
+            "event": "server stats",
+            "stats": stats
+        })
+
+    # the current values that are read when the metrics are asked for rather than recorded as they change
+    def gauges(self):
+        with self.registryLock:
+            clients = list(self.clients)
+            bytesIn = self.closedBytesIn
+            bytesOut = self.closedBytesOut
+        queued = [client.queuedBytes for client in clients]
+        return {
+            "connections": len(clients),
+            "channels": len(self.channels),
+            "queued.bytes": sum(queued),
+            "queued.bytes_max": max(queued, default=0),
+            "bytes.in": bytesIn + sum(client.bytesIn for client in clients),
+            "bytes.out": bytesOut + sum(client.bytesOut for client in clients),
+            "timers": len(self.timers),
+            "history.bytes": self.history.totalBytes if self.history is not None else 0,
+            "history.channels": len(self.history) if self.history is not None else 0,
+            "log.bytes": self.messageLog.totalBytes() + self.privateLog.totalBytes() if self.privateLog is not None else 0,
+            "log.dropped": self.messageLog.dropped + self.privateLog.dropped if self.privateLog is not None else 0,
+            "events.dropped": self.eventLog.dropped,
+            "capture.dropped": self.capture.dropped if self.capture is not None else 0,
+            "events.sampled_out": self.eventLog.sampledOut,
+        }
+
     # cleans up the client connection when done executing
     def quitProcess(self, sock):  # function to clean up the client connection when done executing
-        with self.lock:  # uses a threading lock to prevent data corruption when accessing shared resources
-            if sock not in self.clients:  # for when the specified client cannot be found in the clients dictionary
+        with self.registryLock:  # takes the client out of the registry first so nothing new is added for it
+            user = self.clients.pop(sock, None)  # retrieves the user information for the specified client socket
+            if user is None:  # for when the specified client cannot be found in the clients dictionary
                 return  # exit the function early since there is no client to clean up
-            user = self.clients[sock]  # retrieves the user information for the specified client socket
-            nick = user.get("nickname")  # retrieves the nickname of the user
-            if nick in self.nicknames:  # for when the nickname exists in the set of nicknames
-                self.nicknames.remove(nick)  # removes the nickname from the set of nicknames
-            for channel in list(user.get("channels", [])):  # looks through each channel that the user is in
+            nick = user.nickname  # retrieves the nickname of the user
+            released = self.nicknames.get(nick) is sock  # for when the nickname in the index belongs to this client
+            if released:
+                del self.nicknames[nick]  # removes the nickname from the nickname index
+            self.closedBytesIn += sock.bytesIn  # keeps the client's traffic in the totals after it is gone
+            self.closedBytesOut += sock.bytesOut
+        self.directory.unwatch(sock)  # stops the presence events before the client leaves its channels
+        if self.capture is not None:
+            self.capture.closed(sock)
+        if METRICS.enabled:
+            METRICS.count("connections.closed")
+            METRICS.observe("connection.bytes_in", sock.bytesIn)
+            METRICS.observe("connection.bytes_out", sock.bytesOut)
+        if released and self.bus is not None:
+            self.bus.release(nick)  # frees the nickname and channel memberships on every worker
+        waiting, user.awaiting = user.awaiting, None
+        if waiting is not None:  # the command waiting for the broker's answer is never run again
+            request = user.request
+            waiting.add_done_callback(lambda future: self.abandonRequest(request, future.result()))
+        for channel in list(user.channels):  # looks through each channel that the user is in
+            with self.channelLocks[channel]:  # one channel lock at a time, following the lock order
                 self.channels[channel].discard(
-                    nick)  # removes the user's nickname from the channels that it was a part of
-                user["channels"].remove(channel)  # removes the channel from the user's set of joined channels
-            del self.recentClientActivity[sock]  # removes the client from the timeout dictionary
-            del self.clients[sock]  # removes the client from the clients dictionary
+                    sock)  # removes the user's client socket from the channels that it was a part of
+                user.leave(channel)  # removes the channel from the user's set of joined channels
+                self.directory.leave(channel, nick)
+        self.timers.cancel(sock)  # removes the client's inactivity timer
         try:  # attempts to close the client socket
             sock.close()  # closes the client socket connection
         except:  # for when there may be an error when trying to close the socket
             pass  # pass if there is an error when trying to close the socket
 
+    # returns the lock of a channel, creating the channel and its lock if they do not exist yet
+    def addChannel(self, channel):
+        with self.channelsLock:
+            channelLock = self.channelLocks.get(channel)
+            if channelLock is None:
+                self.channels[channel] = set()  # creates a new set for the channel to hold the client sockets that join it
+                channelLock = self.channelLocks[channel] = threading.Lock()
+                self.directory.addChannel(channel)
+        return channelLock
+
     def tellAll(self, channel, obj,
                 except_sock=None):  # function to broadcast messages to all clients in a specified channel
-        for sock, user in self.clients.items():  # looks at each connected client socket and its associated user information
+        self.tellLocal(channel, obj, except_sock)
+        if self.bus is not None:
+            self.bus.publish(channel, obj)  # the other workers send it to their members of the channel
+
+    def tellLocal(self, channel, obj,
+                  except_sock=None):  # function to broadcast messages to the clients of this process in a specified channel
+        channelLock = self.channelLocks.get(channel)
+        if channelLock is None:  # nobody on this process has joined the channel
+            return
+        with channelLock:  # copies the members so nothing is sent while the lock is held
+            members = list(self.channels[channel])
+        if METRICS.enabled:
+            start = time.perf_counter()
+        frames = {}  # encodes the message once per encoding and shares the same frame with every recipient
+        for sock in members:  # looks only at the client sockets that are members of the channel
             if sock == except_sock:  # for when the socket is the exception socket that should not receive the message
                 continue  # continues with looking at the next client socket
-            if user["nickname"] in self.channels.get(channel,
-                                                     []):  # for when the user's nickname is in the set of users for the specified channel
-                sendObject(sock, obj)  # sends the object message to the client socket in the specified channel
+            frame = frames.get(sock.encoding)
+            if frame is None:
+                frame = frames[sock.encoding] = encodeObject(obj, sock.encoding)
+            sendFrame(sock, frame)  # sends the encoded message to the client socket in the specified channel
+        if self.history is not None and obj.get("type") == "message":  # keeps the message for users who join later
+            self.history.record(channel, frames.get(BINARY) or encodeObject(obj, BINARY))
+        if METRICS.enabled:
+            METRICS.observe("fanout.recipients", len(members))
+            METRICS.observe("fanout.seconds", time.perf_counter() - start)
+
+
+    # called from the bus reader thread with traffic that another worker relayed through the broker
+    def onBusMessage(self, msg):
+        if self.loop is not None:  # the asyncio engine's connections may only be used from the event loop
+            self.loop.call_soon_threadsafe(self.handleBusMessage, msg)
+        else:
+            self.handleBusMessage(msg)
+
+    def handleBusMessage(self, msg):
+        if msg["op"] == "deliver":  # a channel broadcast from another worker
+            self.tellLocal(msg["channel"], msg["obj"])
+        elif msg["op"] == "direct":  # a private message for a client of this worker
+            with self.registryLock:
+                target_sock = self.nicknames.get(msg["nick"])
+            if target_sock is not None:
+                sendObject(target_sock, msg["obj"])
+
+
+# whether name can be a channel, which keeps channel names apart from the keys private messages used to be logged under
+def isChannelName(name):
+    return not (isinstance(name, str) and name.startswith(PRIVATE_PREFIX))
+
+
+# interns a nickname or channel name so every record and index that holds it shares one string
+def internName(name):
+    return sys.intern(name) if type(name) is str else name
+
+
+# raises the open file limit as far as the system allows so the asyncio engine can hold many idle connections
+def raiseFileLimit():
+    try:
+        import resource  # only available on Unix systems
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):  # keeps the current limit when it cannot be raised
+        pass
 
 
 # main function to start the ChatServer with command line arguments
@@ -438,6 +1163,98 @@ if __name__ == "__main__":
     parser.add_argument("-d", type=int, default=0,
                         help="Debug level 0/1")  # adds the debug level argument to the parser
     parser.add_argument("-t", type=int, default=300, help="Amount of inactive seconds to time out client (0 = disabled)")
+    parser.add_argument("-e", "--engine", choices=ENGINES, default="threads",
+                        help="Serving engine: a thread per client (at most 4) or one asyncio event loop")
+    parser.add_argument("--queue-high", type=int, default=256,
+                        help="KiB queued for a client before it counts as congested")
+    parser.add_argument("--queue-low", type=int, default=64,
+                        help="KiB a congested client's queue must drain below to recover")
+    parser.add_argument("--queue-max", type=int, default=4096,
+                        help="KiB queued for a client before it is disconnected")
+    parser.add_argument("--slow-grace", type=float, default=10.0,
+                        help="Seconds a client may stay congested before it is disconnected")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port through SO_REUSEPORT (Unix only)")
+    parser.add_argument("--json-only", action="store_true",
+                        help="Keep every client on newline delimited JSON instead of offering binary frames")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Refuse clients that ask to compress their connection, which saves CPU but not bandwidth")
+    parser.add_argument("--rate-limit", action="append", default=[], type=parseLimit, metavar="BUDGET=RATE[/BURST]",
+                        help="Limits one budget to these commands per second and burst: all, say, msg, membership, "
+                             "nick or other. Clients are not rate limited unless this or --throttle is given")
+    parser.add_argument("--throttle", choices=POLICIES,
+                        help="What happens to a command over its rate limit (error by default), given alone it turns "
+                             "on the default limits for every budget")
+    parser.add_argument("--history-count", type=int, default=HISTORY_COUNT, help="Messages kept for each channel")
+    parser.add_argument("--history-kib", type=int, default=HISTORY_BYTES // 1024, help="KiB kept for each channel")
+    parser.add_argument("--history-memory", type=int, default=HISTORY_MEMORY // (1024 * 1024),
+                        help="MiB of history kept across all channels, the least recently active go first")
+    parser.add_argument("--history-replay", type=int, default=0,
+                        help="Messages sent to a client when it joins a channel, "
+                             "by default only the ones it asks for with /join <channel> n")
+    parser.add_argument("--no-history", action="store_true", help="Keep no channel history")
+    parser.add_argument("--log-dir",
+                        help="Folder for the on-disk message log, messages are only kept in memory without it")
+    parser.add_argument("--log-segment-mib", type=int, default=SEGMENT_BYTES // (1024 * 1024),
+                        help="MiB written to a log segment before the next one is started")
+    parser.add_argument("--log-retain-mib", type=int, default=RETAIN_BYTES // (1024 * 1024),
+                        help="MiB of log segments kept, the oldest are deleted first")
+    parser.add_argument("--log-retain-hours", type=float, default=RETAIN_SECONDS / 3600,
+                        help="Hours a log segment is kept after it was last written")
+    parser.add_argument("--log-no-sync", action="store_true",
+                        help="Leave writing the log to disk to the system instead of syncing every commit")
+    parser.add_argument("--event-log", metavar="FILE",
+                        help="Write the server's log events to FILE as JSON lines (worker n writes FILE.n)")
+    parser.add_argument("--event-level", choices=LEVELS, default="info",
+                        help="Lowest level of the events written to --event-log, -d 1 writes every level")
+    parser.add_argument("--event-log-mib", type=int, default=16, help="MiB written to the event log before it is rotated")
+    parser.add_argument("--event-log-backups", type=int, default=5, help="Rotated event log files kept")
+    parser.add_argument("--event-sample", action="append", default=[], type=parseSampling, metavar="EVENT=N",
+                        help="Keep only one in N of an event, for busy ones such as say and msg")
+    parser.add_argument("--backlog", type=int, default=BACKLOG,
+                        help="Connections the system holds for the server while it is accepting others")
+    parser.add_argument("--max-connections", type=int,
+                        help="Clients connected at once before new ones are told to retry later (the threaded engine stops at 4)")
+    parser.add_argument("--retry-after", type=float, default=RETRY_AFTER,
+                        help="Seconds a client turned away by --max-connections is told to wait")
+    parser.add_argument("--nagle", action="store_true",
+                        help="Let the system hold small writes back (Nagle's algorithm) instead of setting TCP_NODELAY")
+    parser.add_argument("--sndbuf-kib", type=int, help="KiB of system send buffer for each client socket")
+    parser.add_argument("--rcvbuf-kib", type=int, help="KiB of system receive buffer for each client socket")
+    parser.add_argument("--drain-seconds", type=float, default=DRAIN_SECONDS,
+                        help="Seconds a shutdown (Ctrl-C or SIGTERM) waits for clients to be written out before dropping them")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Record every frame clients send to FILE for benchmarks/replay.py (worker n writes FILE.n)")
+    parser.add_argument("--admin-token",
+                        help="Token that lets a client run /stats, the command is off without it")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve the metrics on http://127.0.0.1:PORT/metrics (worker n uses PORT+n)")
     args = parser.parse_args()  # parses the command line arguments
-    server = ChatServer(args.p, args.d, args.t)  # creates a ChatServer instance with the specified port and debug level
-    server.startServer()  # starts the ChatServer
+    policy = OutboundPolicy(args.queue_high * 1024, args.queue_low * 1024, args.queue_max * 1024, args.slow_grace)
+    encodings = (JSON_LINES,) if args.json_only else ENCODINGS
+    history = None if args.no_history else HistoryStore(args.history_count, args.history_kib * 1024,
+                                                        args.history_memory * 1024 * 1024)
+    if args.log_dir is not None and history is None:
+        parser.error("--log-dir keeps the channel history on disk, so it cannot be used with --no-history")
+    messageLog = None if args.log_dir is None else MessageLog(args.log_dir, args.log_segment_mib * 1024 * 1024,
+                                                              args.log_retain_mib * 1024 * 1024,
+                                                              args.log_retain_hours * 3600, not args.log_no_sync)
+    eventLog = EventLog(DEBUG if args.d == 1 else LEVELS[args.event_level], args.event_log, args.d == 1,
+                        args.event_log_mib * 1024 * 1024, args.event_log_backups, dict(args.event_sample))
+    admission = Admission(args.backlog, args.max_connections, args.retry_after, not args.nagle,
+                          args.sndbuf_kib and args.sndbuf_kib * 1024, args.rcvbuf_kib and args.rcvbuf_kib * 1024)
+    rateLimits = None  # clients may send commands as fast as they like unless the operator asks for limits
+    if args.rate_limit or args.throttle is not None:  # only the budgets given, or every default budget without any
+        rateLimits = RateLimits(dict(args.rate_limit) or None, args.throttle or "error")
+    makeServer = lambda: ChatServer(args.p, args.d, args.t, args.engine, policy,
+                                    encodings, args.admin_token, args.metrics_port, rateLimits,
+                                    history, args.history_replay, messageLog, eventLog,
+                                    () if args.no_compression else COMPRESSIONS,
+                                    args.drain_seconds, admission,
+                                    args.capture and TrafficCapture(args.capture))  # creates a ChatServer instance with the specified port and debug level
+    if args.workers > 1:  # for when several worker processes should share the port
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers needs a system with fork and SO_REUSEPORT")
+        runWorkers(args.workers, makeServer)
+    else:
+        makeServer().startServer()  # starts the ChatServer
@@ -0,0 +1,98 @@
+# this is the admission module that decides which new connections the ChatServer takes on and sets up their sockets
+import socket  # import socket module to accept connections and set their options
+import threading  # import threading module for the lock around the admission counters
+import time  # import time module to measure the admission rate
+
+from protocol import encodeObject, JSON_LINES
+
+BACKLOG = 1024  # connections the kernel holds for the server, so a reconnect storm waits instead of being refused
+ACCEPT_BATCH = 256  # the most connections taken in one wakeup before the accept loop looks at anything else
+RETRY_AFTER = 5.0  # seconds a client that was turned away is told to wait before connecting again
+REPORT_SECONDS = 10.0  # how often the admission rate is logged while connections are arriving
+
+
+def busyObject(retryAfter):  # the frame a client gets instead of a connection when the server is full
+    return {"type": "busy", "error": f"The server is full. Try again in {retryAfter:g} seconds.",
+            "retryAfter": retryAfter}
+
+
+class Admission:
+    """The limits on new connections and the socket options they get.
+
+    backlog is the listen backlog. Once maxConnections clients are connected, or the engine's own
+    limit is reached, a new connection gets a busy frame, sent in JSON lines before any handshake,
+    and is closed. Accepted sockets get TCP_NODELAY unless noDelay is False, and sendBuffer and
+    receiveBuffer bytes of kernel buffer when they are given. The connections admitted and refused
+    are counted so the rate can be logged.
+    """
+
+    def __init__(self, backlog=BACKLOG, maxConnections=None, retryAfter=RETRY_AFTER, noDelay=True,
+                 sendBuffer=None, receiveBuffer=None):
+        self.backlog = backlog
+        self.maxConnections = maxConnections  # None leaves only the engine's own limit
+        self.retryAfter = retryAfter
+        self.noDelay = noDelay
+        self.sendBuffer = sendBuffer
+        self.receiveBuffer = receiveBuffer
+        self.busyFrame = encodeObject(busyObject(retryAfter), JSON_LINES)
+        self.admitted = 0  # connections taken on since the last report
+        self.refused = 0  # connections turned away since the last report
+        self.reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def admit(self, connected, limit=None):  # whether one more connection fits next to connected ones
+        full = [cap for cap in (self.maxConnections, limit) if cap is not None]
+        with self._lock:
+            if full and connected >= min(full):
+                self.refused += 1
+                return False
+            self.admitted += 1
+            return True
+
+    def tune(self, sock):  # sets the socket options of an accepted connection
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.noDelay else 0)
+            if self.sendBuffer is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendBuffer)
+            if self.receiveBuffer is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBuffer)
+        except OSError:  # the client may already be gone, which the connection finds out on its own
+            pass
+
+    def refuse(self, sock):  # sends the busy frame on an accepted socket and closes it
+        try:
+            sock.setblocking(False)  # the frame fits in an empty send buffer, so nothing here waits on the client
+            sock.send(self.busyFrame)
+            sock.shutdown(socket.SHUT_WR)
+            sock.recv(4096)  # takes the hello if it is already here, closing over unread bytes would reset the connection
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+    def report(self, now=None):  # (admitted, refused, seconds) since the last report once REPORT_SECONDS have passed
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            seconds = now - self.reported
+            if seconds < REPORT_SECONDS:
+                return None
+            counts = (self.admitted, self.refused, seconds)
+            self.admitted = self.refused = 0
+            self.reported = now
+        return counts if counts[0] or counts[1] else None
+
+
+def acceptPending(listener, limit=ACCEPT_BATCH):  # every connection waiting on a non-blocking listener, up to limit
+    accepted = []
+    while len(accepted) < limit:
+        try:
+            sock, address = listener.accept()
+        except (BlockingIOError, InterruptedError):  # nothing more is waiting
+            break
+        except ConnectionAbortedError:  # the client gave up while it was waiting
+            continue
+        except OSError:  # out of file descriptors, the rest wait in the backlog until a client leaves
+            break
+        sock.setblocking(True)  # the connection's reader and writer threads block on it
+        accepted.append((sock, address))
+    return accepted
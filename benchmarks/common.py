@@ -0,0 +1,45 @@
+# helpers shared by the benchmark scripts, run them from the project folder with python3 -m benchmarks.<name>
+import time  # import time module to measure how long each benchmark step takes
+
+from protocol import JSON_LINES
+
+
+class SinkSocket:
+    """A stand-in for a client socket that counts what the server sends to it and throws it away."""
+
+    def __init__(self, encoding=JSON_LINES):
+        self.encoding = encoding
+        self.replies = None
+        self.compression = None
+        self.frames = 0
+        self.bytesSent = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def sendall(self, data):
+        self.frames += 1
+        self.bytesSent += len(data)
+
+    def recv(self, size):
+        return b""
+
+    def close(self):
+        pass
+
+
+def populateChannel(server, channel, size, sockClass=SinkSocket, prefix="user"):  # registers size fake clients on server and joins them all to channel
+    socks = []
+    for i in range(size):
+        sock = sockClass()
+        user = server.registerClient(sock)
+        server.Nicknames(sock, user, [f"{prefix}{i}"])
+        server.Join(sock, user, [channel])
+        socks.append((sock, user))
+    return socks
+
+
+def cpuPerCall(func, repeat):  # runs func repeat times and returns the CPU seconds spent on each call
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - start) / repeat
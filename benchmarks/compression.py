@@ -0,0 +1,92 @@
+# compares the bandwidth and CPU of connections with and without stream compression for typical chat traffic
+# run from the project folder with: python3 -m benchmarks.compression
+import argparse  # import argparse module to handle command line arguments
+import random  # import random module to make up the chat traffic
+import time
+import zlib
+
+from protocol import Deflater, Inflater, encodeObject, COMPRESSION_DICTIONARY, COMPRESSION_LEVEL, JSON_LINES, BINARY
+
+FIRST_FRAMES = 20  # frames at the start of a connection that are measured on their own
+WORDS = ("are we still on for tonight the build is green again can someone review my change "
+         "lunch in five minutes i pushed a fix for the flaky test thanks see you tomorrow").split()
+
+
+def chatTraffic(count, seed, nicknames=40, channels=5):  # the frames a client in a few busy channels receives
+    pick = random.Random(seed)
+    users = [f"user{i:03d}" for i in range(nicknames)]
+    rooms = [f"#room{i}" for i in range(channels)]
+    frames = []
+    for i in range(count):
+        roll = pick.random()
+        if roll < 0.85:
+            frames.append({"type": "message", "channel": pick.choice(rooms), "user": pick.choice(users),
+                           "message": " ".join(pick.choices(WORDS, k=pick.randint(3, 12)))})
+        elif roll < 0.93:
+            frames.append({"type": "event", "event": pick.choice(("a user joined a channel", "a user left the channel")),
+                           "channel": pick.choice(rooms), "user": pick.choice(users)})
+        elif roll < 0.97:
+            frames.append({"type": "message", "from": pick.choice(users),
+                           "message": " ".join(pick.choices(WORDS, k=pick.randint(3, 12)))})
+        elif roll < 0.99:
+            frames.append({"type": "event", "event": "channel users", "channel": pick.choice(rooms),
+                           "users": pick.sample(users, 20)})
+        else:
+            frames.append({"type": "event", "event": "list of channels",
+                           "channels": {room: pick.randint(1, 500) for room in rooms}})
+    return frames
+
+
+class PlainDeflater(Deflater):
+    """The same stream compression without the primed dictionary, to see what the dictionary is worth."""
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self._stream = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def measure(frames, encoding, makeDeflater, perWrite):  # bytes on the wire and CPU microseconds per frame
+    encoded = [encodeObject(frame, encoding) for frame in frames]
+    raw = sum(len(frame) for frame in encoded)
+    if makeDeflater is None:
+        return raw, raw, sum(len(frame) for frame in encoded[:FIRST_FRAMES]), 0.0, 0.0
+    fresh = makeDeflater()  # the start of a connection, where the dictionary matters most
+    first = sum(len(fresh.compress(frame)) for frame in encoded[:FIRST_FRAMES])
+    writes = [b"".join(encoded[i:i + perWrite]) for i in range(0, len(encoded), perWrite)]
+    deflater = makeDeflater()
+    start = time.process_time()
+    compressed = [deflater.compress(write) for write in writes]
+    deflateTime = time.process_time() - start
+    inflater = Inflater()
+    if isinstance(deflater, PlainDeflater):
+        inflater._stream = zlib.decompressobj(-zlib.MAX_WBITS)
+    start = time.process_time()
+    for chunk in compressed:
+        for _ in inflater.inflate(chunk):
+            pass
+    inflateTime = time.process_time() - start
+    wire = sum(len(chunk) for chunk in compressed)
+    return raw, wire, first, deflateTime / len(frames) * 1e6, inflateTime / len(frames) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=20000, help="Frames sent to one client")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the made up traffic")
+    args = parser.parse_args()
+    frames = chatTraffic(args.frames, args.seed)
+    modes = {"none": None, "zlib": PlainDeflater, "zlib+dict": Deflater}
+
+    print(f"dictionary {len(COMPRESSION_DICTIONARY)} bytes, {args.frames} frames of chat traffic")
+    # one frame per write is the threaded engine and a quiet connection, 16 is a busy asyncio loop pass
+    print(f"{'encoding':>8} {'mode':>10} {'frames/write':>12} {'wire bytes':>11} {'ratio':>6} "
+          f"{'first ' + str(FIRST_FRAMES):>9} {'deflate us':>11} {'inflate us':>11}")
+    for encoding in (JSON_LINES, BINARY):
+        for name, makeDeflater in modes.items():
+            for perWrite in ((1,) if makeDeflater is None else (1, 16)):
+                raw, wire, first, deflateTime, inflateTime = measure(frames, encoding, makeDeflater, perWrite)
+                print(f"{encoding:>8} {name:>10} {perWrite:>12} {wire:>11} {raw / wire:>6.2f} {first:>9} "
+                      f"{deflateTime:>11.2f} {inflateTime:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
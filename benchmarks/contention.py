@@ -0,0 +1,81 @@
+# measures how channel traffic scales with the number of threads when every thread talks in its own channel
+# run from the project folder with: python3 -m benchmarks.contention
+import argparse  # import argparse module to handle command line arguments
+import threading  # import threading module to run one busy channel per thread
+import time  # import time module to time each run and to stand in for a blocking socket write
+
+from ChatServer import ChatServer
+from benchmarks.common import SinkSocket, populateChannel
+
+
+class BlockingSink(SinkSocket):
+    """A SinkSocket whose writes block for a moment like a write to a real socket, without holding the GIL."""
+
+    delay = 0.0
+
+    def sendall(self, data):
+        super().sendall(data)
+        if self.delay:
+            time.sleep(self.delay)
+
+
+class GlobalLockServer(ChatServer):
+    """The old design, where every command ran under one server wide lock."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.globalLock = threading.Lock()
+
+    def takingCommands(self, sock, user, obj):
+        with self.globalLock:
+            super().takingCommands(sock, user, obj)
+
+
+def run(serverClass, threads, members, messages):  # returns the messages per second said across all channels
+    server = serverClass(0, 0, 0)
+    speakers = []
+    for t in range(threads):
+        channel = f"#bench{t}"
+        socks = populateChannel(server, channel, members, BlockingSink, prefix=f"user{t}-")
+        speakers.append((channel, socks[0][1]))
+    start = threading.Barrier(threads + 1)
+
+    def speak(channel, user):
+        sock = SinkSocket()
+        start.wait()
+        for _ in range(messages):
+            server.takingCommands(sock, user, {"command": "say", "args": [channel, "hello"]})
+
+    workers = [threading.Thread(target=speak, args=speaker) for speaker in speakers]
+    for worker in workers:
+        worker.start()
+    began = time.perf_counter()
+    start.wait()
+    for worker in workers:
+        worker.join()
+    return threads * messages / (time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Numbers of busy channels to measure, one thread per channel")
+    parser.add_argument("--members", type=int, default=10, help="Members in each channel")
+    parser.add_argument("--messages", type=int, default=100, help="Messages said by each thread")
+    parser.add_argument("--send-delay", type=float, default=50,
+                        help="Microseconds each write blocks for, 0 measures the pure CPU cost")
+    args = parser.parse_args()
+    BlockingSink.delay = args.send_delay / 1e6
+
+    print(f"{'threads':>8} {'global lock msg/s':>18} {'scale':>6} {'per-channel msg/s':>18} {'scale':>6}")
+    baseOld = baseNew = None
+    for threads in args.threads:
+        old = run(GlobalLockServer, threads, args.members, args.messages)
+        new = run(ChatServer, threads, args.members, args.messages)
+        baseOld = baseOld or old
+        baseNew = baseNew or new
+        print(f"{threads:>8} {old:>18.0f} {old / baseOld:>5.2f}x {new:>18.0f} {new / baseNew:>5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
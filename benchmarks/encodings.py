@@ -0,0 +1,46 @@
+# compares the size and the encode and parse cost of JSON lines and binary frames for typical chat traffic
+# run from the project folder with: python3 -m benchmarks.encodings
+import argparse  # import argparse module to handle command line arguments
+import time
+
+from protocol import encodeObject, FrameReader, BinaryFrameReader, JSON_LINES, BINARY
+
+TRAFFIC = {  # typical frames, keyed by a short name for the report
+    "say command": {"type": "command", "command": "say", "args": ["#general", "are we still on for tonight?"]},
+    "channel message": {"type": "message", "channel": "#general", "user": "alice",
+                        "message": "are we still on for tonight?"},
+    "private message": {"type": "message", "from": "alice", "message": "ping me when you are back"},
+    "join event": {"type": "event", "event": "a user joined a channel", "channel": "#general", "user": "bob"},
+    "list reply": {"type": "event", "event": "list of channels",
+                   "channels": {f"#room{i}": i for i in range(20)}},
+}
+
+
+def measure(obj, encoding, repeat):  # returns bytes per frame and microseconds to encode and to parse one frame
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frame = encodeObject(obj, encoding)
+    encodeTime = (time.perf_counter() - start) / repeat
+    reader = FrameReader() if encoding == JSON_LINES else BinaryFrameReader()
+    stream = frame * repeat
+    start = time.perf_counter()
+    for piece in reader.feed(stream):
+        reader.decode(piece)
+    parseTime = (time.perf_counter() - start) / repeat
+    return len(frame), encodeTime * 1e6, parseTime * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=50000, help="Frames encoded and parsed per measurement")
+    args = parser.parse_args()
+
+    print(f"{'frame':>16} {'encoding':>8} {'bytes':>6} {'encode us':>10} {'parse us':>9}")
+    for name, obj in TRAFFIC.items():
+        for encoding in (JSON_LINES, BINARY):
+            size, encodeTime, parseTime = measure(obj, encoding, args.repeat)
+            print(f"{name:>16} {encoding:>8} {size:>6} {encodeTime:>10.2f} {parseTime:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# measures the CPU cost of broadcasting one channel message as the channel grows
+# run from the project folder with: python3 -m benchmarks.fanout
+import argparse  # import argparse module to handle command line arguments
+
+from ChatServer import ChatServer
+from protocol import sendObject
+from benchmarks.common import populateChannel, cpuPerCall
+
+
+def perRecipientBroadcast(server, channel, obj):  # the old tellAll that encodes the message again for every recipient
+    for sock in server.channels.get(channel, ()):
+        sendObject(sock, obj)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000, 2000],
+                        help="Channel sizes to measure")
+    parser.add_argument("--messages", type=int, default=200, help="Messages broadcast per measurement")
+    args = parser.parse_args()
+
+    obj = {"type": "message", "channel": "#bench", "user": "user0", "message": "hello " * 10}
+    print(f"{'members':>8} {'per-recipient us/msg':>22} {'encode-once us/msg':>20} {'speedup':>8}")
+    for size in args.sizes:
+        server = ChatServer(0, 0, 0)
+        populateChannel(server, "#bench", size)
+        old = cpuPerCall(lambda: perRecipientBroadcast(server, "#bench", obj), args.messages)
+        new = cpuPerCall(lambda: server.tellAll("#bench", obj), args.messages)
+        print(f"{size:>8} {old * 1e6:>22.1f} {new * 1e6:>20.1f} {old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# compares the throughput of the bytes based frame reader with the old str based receiveLine
+# run from the project folder with: python3 -m benchmarks.framing
+import argparse  # import argparse module to handle command line arguments
+import json
+import time
+
+from protocol import WrappedSocket, encodeObject, receiveLine
+
+
+class ReplaySocket:
+    """A stand-in for a socket that hands back a fixed stream of bytes in reads of at most size bytes."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return bytes(chunk)
+
+    def recv_into(self, buffer):
+        chunk = self.data[self.offset:self.offset + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+
+class LegacySocket:  # the old WrappedSocket with a str buffer and 1024 byte reads
+    def __init__(self, raw_sock):
+        self.raw_sock = raw_sock
+        self._buffer = ""
+
+
+def legacyReceiveLine(sock):  # the old receiveLine that decodes every chunk and splits a str buffer
+    while True:
+        if "\n" in sock._buffer:
+            line, sock._buffer = sock._buffer.split("\n", 1)
+            return line.strip()
+        chunk = sock.raw_sock.recv(1024).decode()
+        if not chunk:
+            return None
+        sock._buffer += chunk
+
+
+def readAll(sock, receive):  # reads every line in the stream and returns how many there were
+    count = 0
+    while receive(sock) is not None:
+        count += 1
+    return count
+
+
+def measure(data, makeSock, receive):  # returns the lines per second and megabytes per second for one reader
+    sock = makeSock(ReplaySocket(data))
+    start = time.perf_counter()
+    count = readAll(sock, receive)
+    elapsed = time.perf_counter() - start
+    return count / elapsed, len(data) / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=100000, help="Frames in each stream")
+    parser.add_argument("--buffer", type=int, default=65536, help="Receive buffer size of the new reader")
+    args = parser.parse_args()
+
+    streams = {
+        "small messages": {"type": "message", "channel": "#chat", "user": "alice", "message": "hello there"},
+        "1 KiB messages": {"type": "message", "channel": "#chat", "user": "alice", "message": "x" * 1000},
+        "non-ascii text": {"type": "message", "channel": "#chat", "user": "zoë", "message": "héllo wörld € " * 8},
+    }
+    print(f"{'stream':>16} {'reader':>8} {'lines/s':>12} {'MB/s':>8}")
+    for name, obj in streams.items():
+        frame = encodeObject(obj)
+        if name == "non-ascii text":
+            frame = (json.dumps(obj, ensure_ascii=False) + "\n").encode()
+        data = frame * args.frames
+        results = [
+            ("old", lambda raw: LegacySocket(raw), legacyReceiveLine),
+            ("new", lambda raw: WrappedSocket(raw, bufferSize=args.buffer), receiveLine),
+        ]
+        for reader, makeSock, receive in results:
+            try:
+                lines, mbps = measure(data, makeSock, receive)
+                print(f"{name:>16} {reader:>8} {lines:>12.0f} {mbps:>8.1f}")
+            except UnicodeDecodeError:  # the old reader fails when a character is split across two reads
+                print(f"{name:>16} {reader:>8} {'decode error':>12} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
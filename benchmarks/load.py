@@ -0,0 +1,229 @@
+# starts a ChatServer on localhost and drives it with many headless clients over the real protocol
+# run from the project folder with: python3 -m benchmarks.load --clients 1000 --output results.json
+import argparse  # import argparse module to handle command line arguments
+import asyncio  # import asyncio module so one process can hold thousands of client connections
+import json  # import json module to write the results
+import os  # import os module to find ChatServer.py
+import random  # import random module to pick the private message targets
+import signal  # import signal module to stop the server with Ctrl-C
+import socket  # import socket module to find a free port
+import subprocess  # import subprocess module to run the server being measured
+import sys
+import time  # import time module to time every request and delivery
+
+from ChatServer import raiseFileLimit
+from clientlib import AsyncChatClient
+from protocol import JSON_LINES, ENCODINGS
+
+SCENARIOS = ("join", "flood", "mesh", "poll")
+CONNECT_CONCURRENCY = 256  # connections opened at the same time, so a storm does not overflow the listen backlog
+DELIVERY_TIMEOUT = 30.0  # seconds to wait for the last deliveries of a scenario before giving up on them
+
+
+def loadClient(args, latencies):  # a headless client that records how long each message took to arrive
+    def onMessage(obj):
+        if obj.get("type") == "message":  # every message carries the time it was said
+            latencies.append(time.perf_counter() - float(obj["message"].split(" ", 1)[0]))
+    return AsyncChatClient([args.encoding], onMessage=onMessage)
+
+
+def percentiles(latencies):  # p50, p99 and p999 of the latencies in milliseconds
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    pick = lambda fraction: round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+    return {"p50": pick(0.5), "p99": pick(0.99), "p999": pick(0.999), "max": round(ordered[-1] * 1000, 3)}
+
+
+def serverMemory(pid):  # the server's resident and peak resident memory in KiB, None where /proc is not available
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status)
+        return {"rss_kb": int(fields["VmRSS"].split()[0]), "peak_rss_kb": int(fields["VmHWM"].split()[0])}
+    except (OSError, KeyError):
+        return None
+
+
+async def openClients(args, prefix, count, channel=None):  # connects count clients, names them and joins channel
+    latencies = []
+    clients = [loadClient(args, latencies) for _ in range(count)]
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    setupTimes = []
+
+    async def setUp(i, client):
+        async with limit:
+            start = time.perf_counter()
+            await client.connect(args.host, args.port)
+            await client.nick(f"{prefix}{i}")
+            if channel is not None:
+                await client.join(channel)
+            setupTimes.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(setUp(i, client) for i, client in enumerate(clients)))
+    return clients, latencies, setupTimes
+
+
+async def waitFor(check):  # waits until check() is true or the delivery timeout passes
+    deadline = time.perf_counter() + DELIVERY_TIMEOUT
+    while not check() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def paced(count, rate, send):  # calls send(i) count times at rate calls per second
+    start = time.perf_counter()
+    for i in range(count):
+        send(i)
+        delay = start + (i + 1) / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif i % 100 == 0:  # lets the clients read while the sender is behind
+            await asyncio.sleep(0)
+
+
+async def joinStorm(args):  # every client connects, picks a nickname and joins one channel at the same time
+    start = time.perf_counter()
+    clients, _, setupTimes = await openClients(args, "join", args.clients, "#storm")
+    duration = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return {"clients": args.clients, "operations": len(setupTimes), "seconds": duration,
+            "per_second": len(setupTimes) / duration, "latency_ms": percentiles(setupTimes)}
+
+
+async def flood(args):  # a few clients say messages as fast as the rate allows in one channel everyone is in
+    clients, latencies, _ = await openClients(args, "flood", args.clients, "#hot")
+    await asyncio.sleep(0.5)  # lets the join events settle
+    senders = clients[:args.senders]
+    expected = args.messages * len(clients)
+    start = time.perf_counter()
+    await paced(args.messages, args.rate,
+                lambda i: senders[i % len(senders)].send("say", "#hot", f"{time.perf_counter()} flood {i}"))
+    await waitFor(lambda: len(latencies) >= expected)
+    duration = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return {"clients": len(clients), "messages": args.messages, "deliveries": len(latencies),
+            "expected_deliveries": expected, "seconds": duration, "per_second": len(latencies) / duration,
+            "latency_ms": percentiles(latencies)}
+
+
+async def mesh(args):  # clients send private messages to random other clients
+    clients, latencies, _ = await openClients(args, "mesh", args.clients)
+    pick = random.Random(args.seed)
+    pairs = [pick.sample(clients, 2) for _ in range(args.messages)]
+    start = time.perf_counter()
+    await paced(args.messages, args.rate,
+                lambda i: pairs[i][0].send("msg", pairs[i][1].nickname, f"{time.perf_counter()} mesh {i}"))
+    await waitFor(lambda: len(latencies) >= args.messages)
+    duration = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return {"clients": len(clients), "messages": args.messages, "deliveries": len(latencies),
+            "seconds": duration, "per_second": len(latencies) / duration, "latency_ms": percentiles(latencies)}
+
+
+async def poll(args):  # clients join channels and keep asking for /list and /who in a closed loop
+    channels = [f"#poll{i}" for i in range(args.poll_channels)]
+    clients, _, _ = await openClients(args, "poll", args.clients)
+    for i, client in enumerate(clients):
+        await client.join(channels[i % len(channels)])
+    pollers = clients[:args.pollers]
+    timings = []
+    stop = time.perf_counter() + args.poll_seconds
+
+    async def keepPolling(i, client):
+        while time.perf_counter() < stop:
+            began = time.perf_counter()
+            await client.listChannels()
+            timings.append(time.perf_counter() - began)
+            began = time.perf_counter()
+            await client.who(channels[i % len(channels)])
+            timings.append(time.perf_counter() - began)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(keepPolling(i, client) for i, client in enumerate(pollers)))
+    duration = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return {"clients": len(clients), "pollers": len(pollers), "operations": len(timings), "seconds": duration,
+            "per_second": len(timings) / duration, "latency_ms": percentiles(timings)}
+
+
+RUNNERS = {"join": joinStorm, "flood": flood, "mesh": mesh, "poll": poll}
+
+
+def freePort():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def startServer(args):  # runs the server being measured and waits until it accepts connections
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ChatServer.py")
+    server = subprocess.Popen([sys.executable, script, "-p", str(args.port), "-e", args.engine, "-t", "0"]
+                              + args.server_args, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+def commitId():  # the commit being measured, so results from different commits can be told apart
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=500, help="Clients connected in each scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("-e", "--engine", choices=("threads", "asyncio"), default="asyncio",
+                        help="Engine of the server, the threaded engine only serves 4 clients at once")
+    parser.add_argument("--encoding", choices=ENCODINGS, default=JSON_LINES, help="Frame encoding the clients ask for")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages sent in the flood and mesh scenarios")
+    parser.add_argument("--rate", type=float, default=500, help="Messages per second sent in the flood and mesh")
+    parser.add_argument("--senders", type=int, default=10, help="Clients that say the flood messages")
+    parser.add_argument("--pollers", type=int, default=50, help="Clients that poll /list and /who")
+    parser.add_argument("--poll-channels", type=int, default=20, help="Channels the poll scenario spreads clients over")
+    parser.add_argument("--poll-seconds", type=float, default=5.0, help="How long the pollers keep polling")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the private message targets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port for the server, a free one is picked by default")
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[],
+                        help="Extra arguments for ChatServer.py, must come last")
+    parser.add_argument("--output", help="File for the JSON results, printed when left out")
+    args = parser.parse_args()
+    args.port = args.port or freePort()
+    raiseFileLimit()  # the clients need as many sockets as the server
+
+    server = startServer(args)
+    results = {"commit": commitId(), "engine": args.engine, "encoding": args.encoding,
+               "clients": args.clients, "scenarios": {}}
+    try:
+        for name in args.scenarios:
+            print(f"running {name}...", file=sys.stderr)
+            result = asyncio.run(RUNNERS[name](args))
+            result["server_memory"] = serverMemory(server.pid)
+            results["scenarios"][name] = result
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait(10)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
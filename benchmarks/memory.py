@@ -0,0 +1,84 @@
+# measures the memory the server holds for each idle connection of the asyncio engine
+# run from the project folder with: python3 -m benchmarks.memory
+import argparse  # import argparse module to handle command line arguments
+import asyncio  # import asyncio module since the connections flush their replies on the event loop
+import gc
+import tracemalloc  # import tracemalloc module to count the bytes allocated for the connections
+
+from ChatServer import ChatServer
+from connections import AsyncConnection, OutboundPolicy
+from ratelimit import RateLimits
+
+
+class IdleSocket:
+    """Stands in for the transport's socket when the server sets its options."""
+
+    def setsockopt(self, *args):
+        pass
+
+
+class IdleTransport:
+    """A transport that never receives or sends anything, so only the server's own state is measured."""
+
+    socket = IdleSocket()
+
+    def __init__(self, number):
+        self.peername = ("10.0.0.1", number)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_extra_info(self, name):
+        return self.peername if name == "peername" else self.socket
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+async def bytesPerConnection(count, channels):  # tracemalloc bytes per idle connection, with and without a nickname and channel
+    server = ChatServer(0, 0, 300, "asyncio", rateLimits=RateLimits())
+    policy = OutboundPolicy()
+    transports = [IdleTransport(i) for i in range(count)]  # the stand-ins are made before measuring
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    connections = []
+    for transport in transports:
+        connection = AsyncConnection(server, policy)
+        connection.connection_made(transport)
+        connections.append(connection)
+    connected = tracemalloc.get_traced_memory()[0]
+    for i, connection in enumerate(connections):  # the same clients once they have a nickname and sit in a channel
+        server.Nicknames(connection, connection.user, [f"user{i}"])
+        server.Join(connection, connection.user, [f"#room{i % channels}"])
+        if i % 1000 == 999:
+            await asyncio.sleep(0)  # lets the connections flush their replies
+    await asyncio.sleep(0)
+    joined = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (connected - start) / count, (joined - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[10000, 100000], help="Idle connections to hold")
+    parser.add_argument("--per-channel", type=int, default=20, help="Clients in each channel once they have joined")
+    args = parser.parse_args()
+
+    print(f"{'connections':>11} {'bytes/connection':>17} {'with nick+channel':>18}")
+    for count in args.counts:
+        connected, joined = asyncio.run(bytesPerConnection(count, max(1, count // args.per_channel)))
+        print(f"{count:>11} {connected:>17.0f} {joined:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
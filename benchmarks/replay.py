@@ -0,0 +1,331 @@
+# replays traffic recorded with ChatServer.py --capture against a local server and reports its throughput and latency
+# run from the project folder with: python3 -m benchmarks.replay traffic.cap --speed 10 --output results.json
+import argparse  # import argparse module to handle command line arguments
+import asyncio  # import asyncio module so one process can recreate every captured connection
+import collections  # import collections module to group the latencies by command
+import json  # import json module to write the results
+import signal  # import signal module to stop the server with Ctrl-C
+import sys
+import time  # import time module to pace the replay and time every request
+import zlib  # import zlib module to catch a corrupt compressed stream
+
+from ChatServer import raiseFileLimit
+from capture import readCapture, OPENED, CLOSED
+from protocol import FrameReader, Deflater, Inflater, encodeObject, switchReader, ENCODINGS, COMPRESSIONS, \
+    JSON_LINES, HANDSHAKE_TIMEOUT, RECV_BUFFER_SIZE
+from benchmarks.load import percentiles, serverMemory, startServer, freePort, commitId
+
+FINISH_WAIT = 2.0  # seconds a connection waits for the answer to its last frame, or to be closed after a quit
+REPLIES = {  # command -> the event names, or other frame types, that answer it, an error answers every command
+    "nick": {"your name was changed"},
+    "list": {"list of channels"},
+    "who": {"channel users"},
+    "watch": {"watching"},
+    "unwatch": {"info"},
+    "join": {"you joined a channel"},
+    "say": {"message"},  # the sender's own copy of what it said
+    "msg": {"info"},
+    "leave": {"you left a channel", "info"},
+    "quit": {"info"},
+    "help": {"info"},
+    "history": {"channel history"},
+    "stats": {"server stats"},
+}
+
+
+class ReplayResults:
+    """What the replayed connections measured, shared by all of them since they run on one event loop."""
+
+    def __init__(self):
+        self.connections = 0
+        self.refused = 0  # connections the server turned away or that could not connect
+        self.lost = 0  # connections the server closed while they still had frames to send
+        self.frames = 0  # frames sent, hellos included
+        self.commands = 0
+        self.mismatched = 0  # frames encoded again because the server agreed on another encoding or compression
+        self.unanswered = 0  # frames the server sent nothing back for before the next frame was due
+        self.errors = 0  # error frames, a change between two builds means the traffic was handled differently
+        self.inbound = 0  # every frame the server sent, replies and messages alike
+        self.lag = []  # seconds each frame was sent after its captured time, once scaled by the speed
+        self.latencies = []  # seconds from sending each frame to the server's answer to it
+        self.byCommand = collections.defaultdict(list)  # command -> latencies
+
+    def report(self, duration):
+        return {"connections": self.connections, "refused": self.refused, "lost": self.lost,
+                "frames": self.frames, "commands": self.commands, "mismatched": self.mismatched,
+                "unanswered": self.unanswered, "error_replies": self.errors,
+                "inbound": self.inbound, "seconds": duration, "per_second": self.commands / duration,
+                "latency_ms": percentiles(self.latencies), "send_lag_ms": percentiles(self.lag),
+                "commands_latency_ms": {command: dict(percentiles(latencies), count=len(latencies))
+                                        for command, latencies in sorted(self.byCommand.items())}}
+
+
+def commandsOf(obj):  # the commands a command or batch frame carries
+    if obj.get("type") == "command":
+        return [obj.get("command")]
+    if obj.get("type") == "batch" and isinstance(obj.get("commands"), list):
+        return [entry.get("command") for entry in obj["commands"] if isinstance(entry, dict)]
+    return []
+
+
+def answers(sent, obj, nickname):  # whether obj is the server's answer to the frame sent, and not a broadcast
+    if obj.get("type") == "error":  # errors only ever go to the client whose command failed
+        return True
+    if sent.get("type") == "batch":  # the answer holds the id of each command it ran, in order, quit left out
+        if obj.get("type") != "batch" or not isinstance(obj.get("results"), list):
+            return False
+        ids = [result.get("id") if isinstance(result, dict) else None for result in obj["results"]]
+        expected = [entry.get("id") if isinstance(entry, dict) else None for entry in sent.get("commands", [])]
+        return ids == expected[:len(ids)]
+    command = sent.get("command")
+    kind = obj.get("event") if obj.get("type") == "event" else obj.get("type")
+    if kind not in REPLIES.get(command, ()):
+        return False
+    if command == "say":  # every member of the channel gets the message, the answer is the sender's own copy
+        args = sent.get("args") if isinstance(sent.get("args"), list) else []
+        return obj.get("user") == nickname and obj.get("channel") == (args[0] if args else None)
+    return True
+
+
+class ReplayClient:
+    """One captured connection recreated on its own socket.
+
+    Every frame goes out as it was captured, in its captured encoding, and a captured hello goes
+    out as it was, so the server agrees on what it agrees on for a real client. When a build agrees
+    on another encoding or compression than the captured client got, the frames after the hello are
+    encoded again to fit and counted as mismatched. A frame's latency is the time to the server's
+    answer to it: the batch frame with the ids of its commands for a batch, or the reply the command
+    is answered with, so messages and events other clients cause are not taken for it. Frames that
+    get no answer before the next one is sent are counted as unanswered instead. At --speed 0 the frames go out back to back, so mostly the last
+    frame of each connection gets a latency and the replay measures throughput.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.encoding = JSON_LINES  # what the frames sent from now on must be in
+        self.compression = None
+        self.busy = False  # set when the server turned the connection away
+        self.nickname = None  # the nickname the server last confirmed, to tell the answer to a /say
+        self.closed = asyncio.Event()
+        self._reader = FrameReader()
+        self._stream = None
+        self._writer = None
+        self._deflater = None
+        self._inflater = None
+        self._answer = None  # the future for the server's answer to a hello, while one is awaited
+        self._sent = None  # (when, frame, commands) of the frame waiting for its answer
+        self._answered = asyncio.Event()  # set once the last frame sent got its answer
+        self._quitting = False  # set once a quit was sent, after which the server closes the connection
+
+    async def connect(self, host, port):
+        self._stream, self._writer = await asyncio.open_connection(host, port)
+        asyncio.get_running_loop().create_task(self._listen())
+
+    async def hello(self, frame):  # sends a captured hello and follows the server's answer
+        self._answer = asyncio.get_running_loop().create_future()
+        await self._write(frame.data)
+        try:  # the server switches right after its answer, so nothing can be sent until it is in
+            await asyncio.wait_for(self._answer, HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError("The server did not answer the hello")
+
+    async def send(self, frame):  # sends a captured frame, encoded again if the connection agreed on something else
+        data = frame.data
+        if frame.encoding != self.encoding or frame.compression != self.compression:
+            data = encodeObject(frame.obj, self.encoding)
+            self.results.mismatched += 1
+        commands = commandsOf(frame.obj)
+        if self._sent is not None:
+            self.results.unanswered += 1
+        self._sent = None
+        if frame.obj.get("type") in ("command", "batch"):  # the server answers nothing else
+            self._sent = (time.perf_counter(), frame.obj, commands)
+        self._answered.clear()
+        self._quitting = self._quitting or "quit" in commands
+        await self._write(data)
+        self.results.commands += len(commands)
+
+    async def _write(self, data):
+        if self.closed.is_set():
+            raise ConnectionError("The server closed the connection")
+        self._writer.write(self._deflater.compress(data) if self._deflater is not None else data)
+        self.results.frames += 1
+        await self._writer.drain()
+
+    async def _listen(self):  # reads frames until the connection closes
+        try:
+            while True:
+                data = await self._stream.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                if self._answer is not None and not self._answer.done():
+                    frames = self._reader.feed(data, single=True)  # the frames after it are in what it agreed on
+                    if not frames:
+                        continue
+                    self._agree(self._reader.decode(frames[0]))
+                    data = self._reader.take()
+                frames = self._split(data)
+                for frame in frames:
+                    obj = self._reader.decode(frame)
+                    if obj is not None:
+                        self._received(obj)
+        except (OSError, ValueError, zlib.error):  # a reset connection or a frame that breaks the protocol
+            pass
+        finally:
+            if self._sent is not None:
+                self.results.unanswered += 1
+                self._sent = None
+            self.closed.set()
+            if self._answer is not None and not self._answer.done():
+                self._answer.set_exception(ConnectionError("The server closed the connection"))
+
+    def _agree(self, obj):  # switches to what the server's answer to the hello agreed on
+        self._received(obj)
+        if not isinstance(obj, dict) or obj.get("type") != "hello":
+            self._answer.set_exception(ConnectionError("The server did not answer the hello"))
+            return
+        if obj.get("encoding") in ENCODINGS:
+            self._reader = switchReader(self._reader, obj["encoding"])
+            self.encoding = obj["encoding"]
+        if obj.get("compression") in COMPRESSIONS:  # everything after the answer is compressed both ways
+            self._deflater = Deflater()
+            self._inflater = Inflater(self._reader.maxFrameLength)
+            self.compression = obj["compression"]
+        self._answer.set_result(obj)
+
+    def _split(self, data):  # the complete frames in data, decompressing it first if needed
+        if self._inflater is not None:
+            return [frame for piece in self._inflater.inflate(data) for frame in self._reader.feed(piece)]
+        return self._reader.feed(data)
+
+    def _received(self, obj):
+        self.results.inbound += 1
+        if not isinstance(obj, dict):
+            return
+        if obj.get("type") == "busy":
+            self.busy = True
+        elif obj.get("type") == "error":
+            self.results.errors += 1
+        elif obj.get("event") == "your name was changed":
+            self.nickname = obj.get("nickname")
+        elif obj.get("type") == "batch":
+            self.results.errors += sum(1 for result in obj.get("results", []) for reply in result.get("replies", [])
+                                       if isinstance(reply, dict) and reply.get("type") == "error")
+        if self._sent is not None and answers(self._sent[1], obj, self.nickname):
+            sent, _, commands = self._sent
+            latency = time.perf_counter() - sent
+            self.results.latencies.append(latency)
+            for command in commands:
+                self.results.byCommand[command].append(latency)
+            self._sent = None
+            self._answered.set()
+
+    async def finish(self):  # waits until the server has handled the last frame, so it counts in the time taken
+        done = self.closed if self._quitting else self._answered
+        if self._sent is not None or self._quitting:
+            try:
+                await asyncio.wait_for(done.wait(), FINISH_WAIT)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def replayConnection(args, frames, results):  # recreates one captured connection from its queue of frames
+    client = ReplayClient(results)
+    try:
+        await client.connect(args.host, args.port)
+    except OSError:
+        results.refused += 1
+        return
+    kind, frame, due = await frames.get()
+    try:
+        while kind != CLOSED:
+            start = time.perf_counter()
+            if due is not None:
+                results.lag.append(max(0.0, start - due))
+            if frame.obj.get("type") == "hello":
+                await client.hello(frame)
+            else:
+                await client.send(frame)
+            kind, frame, due = await frames.get()
+        await client.finish()
+    except ConnectionError:  # the server closed the connection before the client was done
+        if not client.busy:
+            results.lost += 1
+    finally:
+        client.close()
+        if client.busy:  # includes a connection turned away before it sent anything
+            results.refused += 1
+        else:
+            results.connections += 1
+
+
+async def replay(args, records):  # hands every captured frame to its connection at its time scaled by the speed
+    results = ReplayResults()
+    queues = {}  # captured connection number -> the frames waiting for its client
+    tasks = []
+    first = records[0][0]
+    start = time.perf_counter()
+    for stamp, number, kind, frame in records:
+        due = None
+        if args.speed > 0:
+            due = start + (stamp - first) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == OPENED:
+            frames = queues[number] = asyncio.Queue()
+            tasks.append(asyncio.create_task(replayConnection(args, frames, results)))
+        elif number in queues:  # connections that opened before the capture started are left out
+            queues[number].put_nowait((kind, frame, due))
+            if kind == CLOSED:
+                del queues[number]
+    for frames in queues.values():  # connections still open when the capture ended
+        frames.put_nowait((CLOSED, None, None))
+    await asyncio.gather(*tasks)
+    return results.report(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", help="File written by ChatServer.py --capture")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="How many times faster than it was captured the traffic is sent, 0 for as fast as possible")
+    parser.add_argument("-e", "--engine", choices=("threads", "asyncio"), default="asyncio",
+                        help="Engine of the server, the threaded engine only serves 4 clients at once")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port for the server, a free one is picked by default")
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[],
+                        help="Extra arguments for ChatServer.py, must come last")
+    parser.add_argument("--output", help="File for the JSON results, printed when left out")
+    args = parser.parse_args()
+    args.port = args.port or freePort()
+    records = list(readCapture(args.capture))
+    if not records:
+        parser.error(f"{args.capture} holds no traffic")
+    raiseFileLimit()  # the clients need as many sockets as the server
+
+    server = startServer(args)
+    try:
+        print(f"replaying {len(records)} records...", file=sys.stderr)
+        result = asyncio.run(replay(args, records))
+        result["server_memory"] = serverMemory(server.pid)
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait(10)
+    results = {"commit": commitId(), "engine": args.engine, "capture": args.capture, "speed": args.speed,
+               "captured_seconds": records[-1][0] - records[0][0], "replay": result}
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
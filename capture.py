@@ -0,0 +1,152 @@
+# this is the capture module that records the frames clients send to the server so the traffic can be replayed later
+import itertools  # import itertools module to number the captured connections
+import queue  # import queue module to hand records to the writer thread
+import struct  # import struct module to pack the header of each record
+import threading  # import threading module for the writer thread
+import time  # import time module to stamp each record
+
+import json  # import json module to read back the frames captured in JSON lines
+
+from protocol import encodeObject, decodeBinary, BINARY, JSON_LINES, ZLIB
+
+MAGIC = b"CHATCAP2"  # the first bytes of every capture file, changed whenever the records change
+QUEUE_SIZE = 100000  # records waiting for the writer thread before new ones are dropped
+WRITE_BATCH = 1024  # the most records written before the file is flushed
+OPENED = 0  # a client connected
+FRAME = 1  # a client sent a frame, which follows the header as it was framed on the wire
+CLOSED = 2  # a client disconnected
+REDACTED_COMMANDS = ("stats",)  # commands whose arguments are secrets, they are captured without them
+_ENCODINGS = (JSON_LINES, BINARY)  # the encoding of a frame is kept as its index in here
+_COMPRESSIONS = (None, ZLIB)  # and so is the compression of the stream it arrived on
+# each record is the time, the connection's number and the kind of record, a FRAME record is followed
+# by the frame's encoding and compression and then the frame itself, length prefixed, before compression
+_RECORD = struct.Struct("!dIB")
+_FRAME = struct.Struct("!BBI")
+
+
+class CapturedFrame:
+    """One frame a client sent: the bytes of the frame in the encoding it was sent in, before
+    compression, the compression of the stream it arrived on, and the object it holds."""
+
+    __slots__ = ("encoding", "compression", "data", "obj")
+
+    def __init__(self, encoding, compression, data):
+        self.encoding = encoding
+        self.compression = compression
+        self.data = data
+        self.obj = decodeBinary(data[4:]) if encoding == BINARY else json.loads(data)
+
+
+class TrafficCapture:
+    """Every connection and every frame clients send, written to path for benchmarks/replay.py.
+
+    The handlers only queue the object with the encoding and compression the connection was using
+    when it arrived; a background thread encodes it back into that frame and writes it, so capturing
+    never makes a client wait on the disk. The arguments of REDACTED_COMMANDS are left out, so an
+    admin token never reaches the file. Connections are numbered in the order they arrive. When the
+    queue is full new records are dropped and counted instead of waiting for room.
+    """
+
+    def __init__(self, path, queueSize=QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0  # records lost because the queue was full
+        self._numbers = {}  # connection -> its number in the capture
+        self._next = itertools.count(1)
+        self._queue = queue.Queue(queueSize)
+        self._writer = None
+        self._counterLock = threading.Lock()
+
+    def open(self):  # starts the writer thread, called in the process that does the capturing
+        if self._writer is None:
+            captureFile = open(self.path, "wb")
+            captureFile.write(MAGIC)
+            self._writer = threading.Thread(target=self._drain, args=(captureFile,), daemon=True)
+            self._writer.start()
+
+    def opened(self, sock):
+        number = self._numbers[sock] = next(self._next)
+        self._put((time.time(), number, OPENED, None))
+
+    def record(self, sock, obj):  # queues an object received from sock, before it is run and can switch the encoding
+        number = self._numbers.get(sock)
+        if number is not None and isinstance(obj, dict):
+            self._put((time.time(), number, FRAME, (redacted(obj), sock.encoding, sock.compression)))
+
+    def closed(self, sock):
+        number = self._numbers.pop(sock, None)
+        if number is not None:
+            self._put((time.time(), number, CLOSED, None))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._counterLock:
+                self.dropped += 1
+
+    def _drain(self, captureFile):  # writer thread that encodes and writes the queued records
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while item is not None and len(batch) < WRITE_BATCH:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            parts = []
+            for entry in batch:
+                if entry is not None:
+                    stamp, number, kind, frame = entry
+                    parts.append(_RECORD.pack(stamp, number, kind))
+                    if kind == FRAME:
+                        obj, encoding, compression = frame
+                        data = encodeObject(obj, encoding)
+                        parts.append(_FRAME.pack(_ENCODINGS.index(encoding), _COMPRESSIONS.index(compression),
+                                                 len(data)))
+                        parts.append(data)
+            captureFile.write(b"".join(parts))
+            captureFile.flush()
+            if batch[-1] is None:  # close was called
+                break
+        captureFile.close()
+
+    def close(self):  # writes the records still queued and stops the writer thread
+        if self._writer is None:
+            return
+        self._queue.put(None)  # waits for room, so the records before it are not lost
+        self._writer.join()
+        self._writer = None
+
+
+def redacted(obj):  # a copy of a received object without the arguments of REDACTED_COMMANDS
+    obj = dict(obj)
+    if obj.get("command") in REDACTED_COMMANDS:
+        obj["args"] = []
+    commands = obj.get("commands")
+    if isinstance(commands, list):  # the commands of a batch
+        obj["commands"] = [dict(entry, args=[]) if isinstance(entry, dict) and entry.get("command") in REDACTED_COMMANDS
+                           else entry for entry in commands]
+    return obj
+
+
+def readCapture(path):  # yields (time, connection, kind, CapturedFrame or None) for every record of a capture file
+    with open(path, "rb") as captureFile:
+        data = captureFile.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a capture file this version can read")
+    position = len(MAGIC)
+    while position + _RECORD.size <= len(data):
+        stamp, number, kind = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        frame = None
+        if kind == FRAME:
+            if position + _FRAME.size > len(data):
+                break  # the file ends in the middle of a record, the server was stopped while writing
+            encoding, compression, size = _FRAME.unpack_from(data, position)
+            end = position + _FRAME.size + size
+            if end > len(data):
+                break
+            frame = CapturedFrame(_ENCODINGS[encoding], _COMPRESSIONS[compression], data[position + _FRAME.size:end])
+            position = end
+        yield stamp, number, kind, frame
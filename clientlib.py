@@ -0,0 +1,431 @@
+# this is the client library that talks to a ChatServer without any terminal input or output, for bots, tools and the ChatClient
+import asyncio  # import asyncio module so one process can run many client sessions on one event loop
+import itertools  # import itertools module to number the requests sent to the server
+import queue  # import queue module to hand inbound messages to a thread that is not running the event loop
+import threading  # import threading module to run the event loop of the sync wrapper in the background
+import zlib  # import zlib module to catch a corrupt compressed stream
+
+from protocol import FrameReader, Deflater, Inflater, encodeObject, switchReader, ENCODINGS, \
+    JSON_LINES, HANDSHAKE_TIMEOUT, RECV_BUFFER_SIZE
+
+REQUEST_TIMEOUT = 10.0  # seconds the sync wrapper waits for the server to answer a call
+QUIT_TIMEOUT = 1.0  # seconds quit waits for the server to close the connection before dropping it
+
+
+class ChatError(Exception):
+    """An error reply from the server, such as a nickname that is taken or a channel that does not exist."""
+
+
+class ServerBusy(ChatError):
+    """The server was full and turned the connection away, retryAfter is how many seconds it asked to wait."""
+
+    def __init__(self, message, retryAfter):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class AsyncChatClient:
+    """One connection to a ChatServer driven from asyncio.
+
+    Every command is sent as a batch frame of one with its own id, so the server's replies to it come
+    back together under that id and the call that sent it gets them, even while other calls are in
+    flight. Everything else the server sends, such as channel messages, private messages and join
+    events, is inbound and goes to onMessage when it is given, or else waits for async iteration:
+
+        async for obj in client:
+            ...
+
+    connect waits for the answer to the hello handshake, since the server switches to the encoding it
+    picked right after answering, and raises ConnectionError when no answer comes. compressions are
+    the stream compressions offered in the hello, such as protocol.ZLIB; none are by default.
+    """
+
+    def __init__(self, encodings=ENCODINGS, onMessage=None, onClose=None, compressions=()):
+        self.encodings = encodings  # the frame encodings offered to the server, most preferred first
+        self.compressions = compressions  # the stream compressions offered to the server, most preferred first
+        self.onMessage = onMessage  # called with each inbound object instead of queueing it
+        self.onClose = onClose  # called once the connection has closed
+        self.encoding = JSON_LINES  # every connection starts on JSON lines until the handshake agrees on another
+        self.compression = None  # the stream compression the server agreed to, None for plain bytes
+        self.nickname = None
+        self.closed = asyncio.Event()
+        self._reader = FrameReader()
+        self._stream = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self._waiting = {}  # request id -> future for its replies
+        self._inbound = asyncio.Queue()  # inbound objects waiting for the iterator, None once the connection closed
+        self._listener = None
+        self._deflater = None
+        self._inflater = None
+        self._early = []  # frames that arrived right behind the hello reply
+
+    async def connect(self, host, port, timeout=HANDSHAKE_TIMEOUT):  # connects and agrees on a frame encoding
+        self._stream, self._writer = await asyncio.open_connection(host, port)
+        hello = {"type": "hello", "encodings": list(self.encodings)}
+        if self.compressions:
+            hello["compression"] = list(self.compressions)
+        self._writer.write(encodeObject(hello))
+        try:  # the server switches right after its answer, so the client cannot carry on without it
+            hello = await asyncio.wait_for(self._readHello(), timeout)
+        except asyncio.TimeoutError:
+            self._writer.close()
+            raise ConnectionError("The server did not answer the hello")
+        except ConnectionError:
+            self._writer.close()
+            raise
+        if isinstance(hello, dict) and hello.get("type") == "busy":  # the server is full and closes the connection
+            self._writer.close()
+            raise ServerBusy(hello.get("error"), hello.get("retryAfter"))
+        if not isinstance(hello, dict) or hello.get("type") != "hello":
+            self._writer.close()
+            raise ConnectionError("The server did not answer the hello")
+        if hello.get("encoding") in self.encodings:
+            self._reader = switchReader(self._reader, hello["encoding"])
+            self.encoding = hello["encoding"]
+        if hello.get("compression") in self.compressions:  # everything after the reply is compressed both ways
+            self._deflater = Deflater()
+            self._inflater = Inflater(self._reader.maxFrameLength)
+            self.compression = hello["compression"]
+        self._early = self._split(self._reader.take())  # the bytes after the reply are in what it agreed on
+        self._listener = asyncio.get_running_loop().create_task(self._listen())
+        return self.encoding
+
+    async def _readHello(self):  # reads the first frame, which is the answer to the hello
+        while True:
+            data = await self._stream.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("The server closed the connection")
+            frames = self._reader.feed(data, single=True)  # the frames after it may be in another encoding
+            if frames:
+                return self._reader.decode(frames[0])
+
+    async def _listen(self):  # reads frames until the connection closes, matching batch results to their requests
+        try:
+            frames = self._early
+            while True:
+                for frame in frames:
+                    obj = self._reader.decode(frame)
+                    if obj is not None:
+                        self._dispatch(obj)
+                data = await self._stream.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                frames = self._split(data)
+        except (OSError, ValueError, zlib.error):  # a reset connection or a frame that breaks the protocol ends the session
+            pass
+        finally:
+            self._closed()
+
+    def _split(self, data):  # the complete frames in data, decompressing it first if needed
+        if self._inflater is not None:
+            return [frame for piece in self._inflater.inflate(data) for frame in self._reader.feed(piece)]
+        return self._reader.feed(data)
+
+    def _dispatch(self, obj):
+        if isinstance(obj, dict) and obj.get("type") == "batch":
+            for result in obj.get("results", []):
+                future = self._waiting.pop(result.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(result.get("replies", []))
+        elif self.onMessage is not None:
+            self.onMessage(obj)
+        else:
+            self._inbound.put_nowait(obj)
+
+    def _closed(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The connection to the server was closed"))
+        self._waiting.clear()
+        self._inbound.put_nowait(None)
+        if self._writer is not None:
+            self._writer.close()
+        if self.onClose is not None:
+            self.onClose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):  # the next inbound object, until the connection closes
+        obj = await self._inbound.get()
+        if obj is None:
+            self._inbound.put_nowait(None)  # any other iterator stops as well
+            raise StopAsyncIteration
+        return obj
+
+    def send(self, command, *args):  # sends a command without waiting for its replies
+        if self.closed.is_set():
+            raise ConnectionError("The connection to the server is closed")
+        self._write(encodeObject({"type": "command", "command": command, "args": list(args)}, self.encoding))
+
+    async def request(self, command, *args):  # sends a command and returns the list of replies to it
+        return (await self.batch([(command, args)]))[0]
+
+    async def batch(self, commands):  # sends (command, args) pairs in one frame and returns the replies of each
+        if self.closed.is_set():
+            raise ConnectionError("The connection to the server is closed")
+        loop = asyncio.get_running_loop()
+        entries = []
+        futures = []
+        for command, args in commands:
+            requestId = next(self._ids)
+            future = self._waiting[requestId] = loop.create_future()
+            entries.append({"id": requestId, "command": command, "args": list(args)})
+            futures.append(future)
+        self._write(encodeObject({"type": "batch", "commands": entries}, self.encoding))
+        return list(await asyncio.gather(*futures))
+
+    def _write(self, frame):
+        self._writer.write(frame if self._deflater is None else self._deflater.compress(frame))
+
+    async def call(self, command, *args, event=None):  # request that raises ChatError on an error reply
+        replies = await self.request(command, *args)
+        for reply in replies:
+            if reply.get("type") == "error":
+                raise ChatError(reply.get("error"))
+        return next((reply for reply in replies if event is None or reply.get("event") == event), None)
+
+    async def nick(self, nickname):
+        await self.call("nick", nickname)
+        self.nickname = nickname
+
+    async def listChannels(self):  # every channel and its number of users
+        reply = await self.call("list", event="list of channels")
+        return {} if reply is None else reply["channels"]
+
+    async def who(self, channel):  # the nicknames in channel
+        reply = await self.call("who", channel, event="channel users")
+        return [] if reply is None else reply["users"]
+
+    async def listPage(self, sort="name", after=None, limit=None):  # one page of channels, and the cursor of the next
+        reply = await self.call("list", *_paging(sort=sort, after=after, limit=limit), event="list of channels")
+        return ({}, None) if reply is None else (reply["channels"], reply.get("next"))
+
+    async def whoPage(self, channel, after=None, limit=None, sort=None):  # one page of nicknames, and the cursor of the next
+        reply = await self.call("who", channel, *_paging(sort=sort, after=after, limit=limit), event="channel users")
+        return ([], None) if reply is None else (reply["users"], reply.get("next"))
+
+    async def join(self, channel, replay=None):  # joins channel and returns the recent messages the server replayed
+        replies = await self.request("join", channel, *([] if replay is None else [str(replay)]))
+        return self._history(replies)
+
+    async def history(self, channel, count=None, since=None):  # recent messages of channel, oldest first
+        page = f"since={since}" if since is not None else None if count is None else str(count)
+        replies = await self.request("history", channel, *([] if page is None else [page]))
+        return self._history(replies)
+
+    def _history(self, replies):  # the messages after the channel history header, raising ChatError on an error
+        for reply in replies:
+            if reply.get("type") == "error":
+                raise ChatError(reply.get("error"))
+        return [reply for reply in replies if reply.get("type") == "message"]
+
+    async def leave(self, channel=None):  # leaves channel, or every channel when it is left out
+        await self.call("leave", *([] if channel is None else [channel]))
+
+    async def say(self, channel, message):
+        await self.call("say", channel, message)
+
+    async def msg(self, nickname, message):
+        await self.call("msg", nickname, message)
+
+    async def help(self):
+        reply = await self.call("help")
+        return None if reply is None else reply.get("info")
+
+    async def stats(self, token):  # the server's metrics, for admins only
+        reply = await self.call("stats", token, event="server stats")
+        return None if reply is None else reply["stats"]
+
+    async def watch(self, channel="*"):  # the snapshot of channel, or of every channel, whose changes arrive as inbound presence events
+        return await self.call("watch", channel, event="watching")
+
+    async def unwatch(self, channel=None):  # stops the presence events of channel, or of everything
+        await self.call("unwatch", *([] if channel is None else [channel]))
+
+    async def quit(self, timeout=QUIT_TIMEOUT):  # asks the server to disconnect and waits for it to close
+        if self.closed.is_set():
+            return
+        self.send("quit")
+        try:
+            await asyncio.wait_for(self.closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.close()
+
+    def close(self):  # drops the connection without telling the server
+        if self._listener is not None:
+            self._listener.cancel()
+        self._closed()
+
+
+class PresenceView:
+    """The members of watched channels, kept up to date from a /watch snapshot and the presence events after it.
+
+    Feed it the snapshot from watch and every inbound object, other objects are ignored. users maps
+    each watched channel to its set of nicknames and channels maps every channel to its number of
+    users when everything is watched. Events that are not newer than the snapshot are skipped.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.channels = {}
+        self.versions = {}  # channel or * -> version of the snapshot it was built from
+
+    def apply(self, obj):  # applies a snapshot or a presence event, returns True if it changed anything
+        if not isinstance(obj, dict) or obj.get("type") != "event":
+            return False
+        if obj.get("event") == "watching":
+            self.versions[obj["channel"]] = obj["version"]
+            if "channels" in obj:
+                self.channels = dict(obj["channels"])
+            else:
+                self.users[obj["channel"]] = set(obj["users"])
+            return True
+        if obj.get("event") != "presence":
+            return False
+        channel = obj["channel"]
+        changed = False
+        if "*" in self.versions and obj["version"] > self.versions["*"]:
+            self.channels[channel] = obj["users"]
+            changed = True
+        if channel in self.users and obj["version"] > self.versions.get(channel, 0):
+            members = self.users[channel]
+            if obj["change"] == "joined":
+                members.add(obj["user"])
+            elif obj["change"] == "left":
+                members.discard(obj["user"])
+            elif obj["change"] == "renamed":
+                members.discard(obj["old"])
+                members.add(obj["user"])
+            changed = True
+        return changed
+
+
+def _paging(**options):  # the name=value arguments of /list and /who for the options that are set
+    return [f"{name}={value}" for name, value in options.items() if value is not None]
+
+
+class ChatClientSession:
+    """A blocking wrapper around AsyncChatClient that runs its event loop in a background thread.
+
+    Each call waits up to timeout seconds for the server. Inbound objects go to onMessage, which is
+    called from the background thread, or else wait in a queue for receive and messages.
+    """
+
+    def __init__(self, encodings=ENCODINGS, onMessage=None, onClose=None, timeout=REQUEST_TIMEOUT, compressions=()):
+        self.timeout = timeout
+        self._messages = queue.Queue()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = self._run(self._makeClient(encodings, onMessage or self._messages.put, onClose, compressions))
+
+    async def _makeClient(self, encodings, onMessage, onClose, compressions):  # made on the loop so its event belongs to it
+        return AsyncChatClient(encodings, onMessage, self._wrapClose(onClose), compressions)
+
+    def _wrapClose(self, onClose):
+        def closed():
+            self._messages.put(None)  # wakes a thread waiting in receive
+            if onClose is not None:
+                onClose()
+        return closed
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(self.timeout)
+
+    @property
+    def encoding(self):
+        return self.client.encoding
+
+    @property
+    def compression(self):
+        return self.client.compression
+
+    @property
+    def nickname(self):
+        return self.client.nickname
+
+    def connect(self, host, port):
+        return self._run(self.client.connect(host, port))
+
+    def send(self, command, *args):
+        self._loop.call_soon_threadsafe(self.client.send, command, *args)
+
+    def request(self, command, *args):
+        return self._run(self.client.request(command, *args))
+
+    def batch(self, commands):
+        return self._run(self.client.batch(commands))
+
+    def nick(self, nickname):
+        return self._run(self.client.nick(nickname))
+
+    def listChannels(self):
+        return self._run(self.client.listChannels())
+
+    def who(self, channel):
+        return self._run(self.client.who(channel))
+
+    def listPage(self, sort="name", after=None, limit=None):
+        return self._run(self.client.listPage(sort, after, limit))
+
+    def whoPage(self, channel, after=None, limit=None, sort=None):
+        return self._run(self.client.whoPage(channel, after, limit, sort))
+
+    def join(self, channel, replay=None):
+        return self._run(self.client.join(channel, replay))
+
+    def history(self, channel, count=None, since=None):
+        return self._run(self.client.history(channel, count, since))
+
+    def leave(self, channel=None):
+        return self._run(self.client.leave(channel))
+
+    def say(self, channel, message):
+        return self._run(self.client.say(channel, message))
+
+    def msg(self, nickname, message):
+        return self._run(self.client.msg(nickname, message))
+
+    def help(self):
+        return self._run(self.client.help())
+
+    def stats(self, token):
+        return self._run(self.client.stats(token))
+
+    def watch(self, channel="*"):
+        return self._run(self.client.watch(channel))
+
+    def unwatch(self, channel=None):
+        return self._run(self.client.unwatch(channel))
+
+    def receive(self, timeout=None):  # the next inbound object, None once the connection has closed
+        return self._messages.get(timeout=timeout)
+
+    def messages(self):  # yields inbound objects until the connection closes
+        while True:
+            obj = self._messages.get()
+            if obj is None:
+                return
+            yield obj
+
+    def quit(self):  # asks the server to disconnect, waits for it and stops the background loop
+        try:
+            self._run(self.client.quit())
+        finally:
+            self._stop()
+
+    def close(self):  # drops the connection and stops the background loop
+        try:
+            self._loop.call_soon_threadsafe(self.client.close)
+        finally:
+            self._stop()
+
+    def _stop(self):
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(self.timeout)
@@ -0,0 +1,329 @@
+# this is the connections module that holds the server side connection objects used by the ChatServer engines
+import asyncio  # import the asyncio module to run many client connections over non-blocking sockets in one thread
+import collections  # import the collections module for the deque that holds each client's outbound queue
+import socket  # import the socket module to shut down sockets of clients that are dropped
+import threading  # import the threading module for the writer thread that drains each client's outbound queue
+import time  # import the time module to track how long a client has been congested
+
+from protocol import WrappedSocket, FrameReader, Deflater, Inflater, switchReader, decodeFrame, JSON_LINES, \
+    MAX_FRAME_LENGTH  # the threaded connection builds on the socket wrapper from protocol.py
+
+from eventlog import WARNING
+
+NO_CHANNELS = frozenset()  # the channels of every client that is in none, shared instead of an empty set each
+
+
+class ClientRecord:
+    """What the server knows about one connected client.
+
+    channels is the shared NO_CHANNELS until the client joins a channel and goes back to it once the
+    client has left them all, so idle clients do not each hold an empty set. limiter is the client's
+    ClientLimiter, None without rate limits, and lastActivity is when it last sent a command. awaiting
+    is the future of the broker's answer a command of the asyncio engine is waiting for, None otherwise,
+    and request is the message it asked the broker. batch is the batch frame that was held back part way through and the results of the commands of
+    it that already ran, None otherwise.
+    """
+
+    __slots__ = ("nickname", "channels", "limiter", "lastActivity", "awaiting", "request", "batch")
+
+    def __init__(self, limiter, now):
+        self.nickname = None
+        self.channels = NO_CHANNELS
+        self.limiter = limiter
+        self.lastActivity = now
+        self.awaiting = None
+        self.request = None
+        self.batch = None
+
+    def join(self, channel):  # called under the channel's lock
+        if not self.channels:
+            self.channels = set()
+        self.channels.add(channel)
+
+    def leave(self, channel):  # called under the channel's lock
+        if channel in self.channels:
+            self.channels.discard(channel)
+            if not self.channels:
+                self.channels = NO_CHANNELS
+
+
+class OutboundPolicy:
+    """Limits for the outbound queue of every client connection.
+
+    A queue holding more than highWater bytes counts as congested until it drains below lowWater.
+    A client is disconnected when its queue passes maxQueued bytes, when it stays congested for
+    more than grace seconds, or when a single write to it has been blocked for more than grace seconds.
+    """
+
+    def __init__(self, highWater=256 * 1024, lowWater=64 * 1024, maxQueued=4 * 1024 * 1024, grace=10.0):
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.maxQueued = maxQueued
+        self.grace = grace
+
+
+class ThreadedConnection(WrappedSocket):
+    """A client socket for the threaded engine whose writes go through a bounded outbound queue.
+
+    sendall only appends to the queue, so it never blocks and is safe to call while holding the
+    server lock. A writer thread owned by the connection drains the queue onto the socket. Once the
+    connection agrees on compression each frame is compressed as it is queued, under the queue's
+    lock, so the compressed stream keeps the order of the queue.
+    """
+
+    def __init__(self, raw_sock, policy, **readerOptions):
+        super().__init__(raw_sock, **readerOptions)
+        self.policy = policy  # the outbound queue limits shared by all connections
+        self.closed = False  # flips to True once the connection is shutting down
+        self.queuedBytes = 0  # the number of bytes waiting in the queue or being written
+        self.congestedSince = None  # when the queue went over the high watermark, None while below it
+        self.writeStarted = None  # when the write in progress started, None while the writer is idle
+        self._queue = collections.deque()  # frames waiting to be written to the socket
+        self._ready = threading.Condition()  # wakes the writer thread when frames are queued
+        # the writer is a daemon so a client that never reads cannot keep the server process alive
+        self._writer = threading.Thread(target=self._drain, daemon=True)
+        self._writer.start()
+
+    def sendall(self, data):  # queues the data for the writer thread instead of writing it here
+        with self._ready:
+            if self.closed:
+                return
+            if self._deflater is not None:
+                data = self._deflater.compress(data)
+            self._queue.append(data)
+            self.queuedBytes += len(data)
+            self.bytesOut += len(data)
+            if self.queuedBytes > self.policy.highWater and self.congestedSince is None:
+                self.congestedSince = time.time()
+            self._ready.notify()
+        if self.queuedBytes > self.policy.maxQueued:  # the client has fallen too far behind
+            self.abort()
+
+    def setCompression(self, compression):  # frames queued from now on are compressed
+        with self._ready:
+            super().setCompression(compression)
+
+    def _drain(self):  # writer thread loop that moves queued frames onto the socket
+        while True:
+            with self._ready:
+                while not self._queue and not self.closed:
+                    self._ready.wait()
+                if not self._queue:  # closed and nothing left to write
+                    break
+                data = b"".join(self._queue)  # writes everything that is queued in one call
+                self._queue.clear()
+            self.writeStarted = time.time()
+            try:
+                self.raw_sock.sendall(data)
+            except OSError:  # the client went away, nothing more can be written
+                break
+            finally:
+                self.writeStarted = None
+            with self._ready:
+                self.queuedBytes -= len(data)
+                if self.queuedBytes <= self.policy.lowWater:
+                    self.congestedSince = None
+        self._shutdown()
+
+    def isSlow(self, now):  # checks whether the client has been over its outbound limits for too long
+        if self.queuedBytes > self.policy.maxQueued:
+            return True
+        started = self.writeStarted
+        if started is not None and now - started > self.policy.grace:
+            return True
+        congested = self.congestedSince
+        return congested is not None and now - congested > self.policy.grace
+
+    def abort(self):  # drops the connection right away without writing what is still queued
+        with self._ready:
+            self.closed = True
+            self._queue.clear()
+            self._ready.notify()
+        self._shutdown()
+
+    def close(self):  # closes the connection once the writer thread has written what is queued
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+    def _shutdown(self):  # wakes the reader thread blocked in recv and releases the socket
+        with self._ready:
+            self.queuedBytes = 0  # nothing more will be written, so a shutdown does not wait for it
+        try:
+            self.raw_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.raw_sock.close()
+
+
+class AsyncConnection(asyncio.Protocol):
+    """One client connection served by the asyncio event loop.
+
+    The object stands in for a WrappedSocket so the ChatServer command handlers can call
+    sendObject(sock, ...) on it without knowing which engine is running. Writes are collected and
+    handed to the transport on the next pass of the event loop, so a handler holding the server
+    lock never writes to a socket, and the transport's buffer limits act as the outbound queue.
+    """
+
+    __slots__ = ("server", "policy", "transport", "user", "closed", "congestedSince", "_reader", "encoding", "handshaking",
+                 "replies",
+                 "_held", "_pending", "_pendingBytes", "bytesIn", "bytesOut", "compression", "_deflater", "_inflater")
+
+    def __init__(self, server, policy, maxFrameLength=MAX_FRAME_LENGTH):
+        self.server = server  # the ChatServer that owns the command handlers
+        self.policy = policy  # the outbound queue limits shared by all connections
+        self.transport = None  # set once the event loop hands us the accepted connection
+        self.user = None  # the user dictionary registered with the server for this connection
+        self.closed = False  # flips to True once the connection is shutting down
+        self.congestedSince = None  # when the transport paused writing, None while it is below the limits
+        self._reader = FrameReader(maxFrameLength)  # splits received bytes into lines
+        self.encoding = JSON_LINES  # every connection starts on JSON lines until a handshake agrees on another encoding
+        self.handshaking = True  # until the first frame has been handled, which is the only one that can be a hello
+        self.replies = None  # collects the objects sent to this connection while the server runs one of its batches
+        self._held = ()  # received objects waiting behind one that was held back, a deque once there are any
+        self._pending = []  # frames waiting for the next flush onto the transport
+        self._pendingBytes = 0
+        self.bytesIn = 0  # the number of bytes received on this connection
+        self.bytesOut = 0  # the number of bytes written to the transport, after compression
+        self.compression = None  # the stream compression agreed on during the handshake, None for plain bytes
+        self._deflater = None
+        self._inflater = None
+
+    def connection_made(self, transport):  # called by the event loop when a new client is accepted
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.policy.highWater, low=self.policy.lowWater)
+        address = transport.get_extra_info("peername")
+        if not self.server.admitConnection(len(self.server.clients), address):  # the server is full
+            self.closed = True
+            transport.write(self.server.admission.busyFrame)
+            transport.close()  # closes once the busy frame has been written
+            return
+        self.server.admission.tune(transport.get_extra_info("socket"))
+        self.user = self.server.registerClient(self)  # adds the client to the server's dictionaries
+        self.server.logging("accept", "Accepted connection from {address}", address=address)
+
+    def data_received(self, data):  # called by the event loop whenever bytes arrive from the client
+        self.bytesIn += len(data)
+        try:
+            if self.handshaking:  # a hello switches the encoding, so the bytes after the first frame wait until it ran
+                frames = self._reader.feed(data, single=True)
+                if not frames:
+                    return
+                self._received(frames[0])
+                self.handshaking = False
+                data = self._reader.take()  # the reader the first frame left in place gets the rest
+            if self._inflater is not None:
+                frames = [frame for piece in self._inflater.inflate(data) for frame in self._reader.feed(piece)]
+            else:
+                frames = self._reader.feed(data)
+            for frame in frames:  # handles every complete frame that has arrived
+                self._received(frame)
+        except Exception as e:  # handles any errors that occur while processing the command
+            self.server.logging("client error", "There is a client error: {error}", WARNING, error=e)
+            self.server.quitProcess(self)
+
+    def _received(self, frame):  # decodes one frame with the reader that split it and runs it
+        if self.closed:
+            return
+        obj = decodeFrame(self._reader, frame)
+        if obj is None:  # skip empty lines
+            return
+        if self.server.capture is not None:
+            self.server.capture.record(self, obj)
+        if self._held:  # keeps the commands in order behind the one that is waiting
+            self._held.append(obj)
+            return
+        delay = self.server.handleIncoming(self, self.user, obj)
+        if delay:
+            self._hold(obj, delay)
+
+    # stops reading and hands obj in again once the rate limits allow it, after delay seconds,
+    # or once delay is a future that is done, which is how a command waits for the channel broker
+    def _hold(self, obj, delay):
+        if not self._held:
+            self._held = collections.deque()
+        self._held.appendleft(obj)
+        self.transport.pause_reading()
+        if isinstance(delay, asyncio.Future):
+            delay.add_done_callback(lambda future: self._release())
+        else:
+            asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):  # runs the held objects in order until one is held back again
+        try:
+            while self._held and not self.closed:
+                obj = self._held.popleft()
+                delay = self.server.handleIncoming(self, self.user, obj)
+                if delay:
+                    self._hold(obj, delay)
+                    return
+        except Exception as e:  # handles any errors that occur while processing the command
+            self.server.logging("client error", "There is a client error: {error}", WARNING, error=e)
+            self.server.quitProcess(self)
+            return
+        if not self._held:
+            self._held = ()  # lets go of the deque once everything held back has run
+        if not self.closed:
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):  # called by the event loop when the connection is closed
+        self.closed = True
+        self.server.quitProcess(self)  # makes sure the client is removed from the server's dictionaries
+
+    def setEncoding(self, encoding):  # switches both directions of the connection to encoding
+        self._reader = switchReader(self._reader, encoding)
+        self.encoding = encoding
+
+    def setCompression(self, compression):  # compresses both directions of the connection from now on
+        self._flush()  # what was queued before, such as the handshake reply, goes out uncompressed
+        self._deflater = Deflater()
+        self._inflater = Inflater(self._reader.maxFrameLength)
+        self.compression = compression
+
+    def pause_writing(self):  # called by the transport when its buffer goes over the high watermark
+        self.congestedSince = time.time()
+
+    def resume_writing(self):  # called by the transport when its buffer drains below the low watermark
+        self.congestedSince = None
+
+    def sendall(self, data):  # queues the data to be written on the next pass of the event loop
+        if self.closed:
+            return
+        if not self._pending:  # schedules one flush for everything queued during this pass of the loop
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._pending.append(data)
+        self._pendingBytes += len(data)
+        if self.queuedBytes > self.policy.maxQueued:  # the client has fallen too far behind
+            self.abort()
+
+    def _flush(self):  # writes everything that was queued since the last flush in one call
+        if self._pending and not self.transport.is_closing():
+            data = b"".join(self._pending)
+            if self._deflater is not None:  # one compressed block for everything sent in this pass of the loop
+                data = self._deflater.compress(data)
+            self.bytesOut += len(data)
+            self.transport.write(data)
+        self._pending.clear()
+        self._pendingBytes = 0
+
+    @property
+    def queuedBytes(self):  # the number of bytes waiting to be written to the client
+        return self._pendingBytes + self.transport.get_write_buffer_size()
+
+    def isSlow(self, now):  # checks whether the client has been over its outbound limits for too long
+        if self.queuedBytes > self.policy.maxQueued:
+            return True
+        congested = self.congestedSince
+        return congested is not None and now - congested > self.policy.grace
+
+    def abort(self):  # drops the connection right away without writing what is still queued
+        self.closed = True
+        self._pending.clear()
+        self._pendingBytes = 0
+        self.transport.abort()
+
+    def close(self):  # closes the connection once any queued data has been written
+        if not self.closed:
+            self.closed = True
+            self._flush()
+            self.transport.close()
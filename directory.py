@@ -0,0 +1,251 @@
+# this is the channel directory module that keeps /list and /who answers ready instead of rebuilding them for every poll
+import bisect  # import bisect module to find where a page starts from its cursor
+import collections  # import collections module for the cache of answered pages
+import itertools  # import itertools module to number joins in the order they happen
+import threading  # import threading module so client threads can change and read the directory at the same time
+
+from protocol import encodeObject
+
+LIST_SORTS = ("name", "size")  # /list pages by channel name, or the largest channels first
+WHO_SORTS = ("joined", "name")  # /who pages in the order members joined, or by nickname
+PAGE_CACHE = 1024  # the most answered pages kept, a page is answered again from the cache until the directory changes
+MAX_PAGE = 1000  # the most channels or nicknames in one page when the client asks for a limit
+ALL = "*"  # watching this instead of a channel name follows every channel
+WATCH_LIMIT = 64  # the most channels one connection may watch at once
+
+
+class CachedPage:
+    """One answer to /list or /who, or one /watch event, with its frame encoded once for each encoding that asked for it."""
+
+    def __init__(self, version, obj):
+        self.version = version
+        self.obj = obj
+        self.frames = {}  # encoding -> frame
+
+    def frame(self, encoding):
+        frame = self.frames.get(encoding)
+        if frame is None:
+            frame = self.frames[encoding] = encodeObject(self.obj, encoding)
+        return frame
+
+
+class ChannelDirectory:
+    """The nicknames in every channel, kept up to date as members join and leave.
+
+    Every change bumps version, and the channel's own version for /who. Each member keeps the number
+    of its join, also across a rename, so /who can page in join order. The sorted lists that pages
+    are cut from are built the first time they are asked for after a change, and each page is kept
+    with its encoded frames, so polling an unchanged directory costs a dictionary lookup.
+
+    Connections can also watch a channel, or ALL for every channel: they get a snapshot and then a
+    presence event for every change, handed to deliver(sock, page) while the directory's lock is
+    held so that nothing reaches a watcher out of order. Each carries the version of the change, and
+    the snapshot carries the version it was taken at. Apart from whatever deliver takes to queue the
+    frame, no other lock is taken while the directory's lock is held.
+    """
+
+    def __init__(self, deliver=None):
+        self.deliver = deliver  # sends a CachedPage to a watching connection
+        self.version = 0
+        self._members = {}  # channel -> {nickname: join number}
+        self._joins = itertools.count()  # numbers every join, so members sort in the order they joined
+        self._versions = {}  # channel -> version of its member list
+        self._sorted = {}  # ("list", sort) or ("who", channel, sort) -> (version, items, keys)
+        self._pages = collections.OrderedDict()  # page key -> CachedPage, least recently used first
+        self._watchers = {}  # channel or ALL -> set of watching connections
+        self._watching = {}  # connection -> set of the channels it watches
+        self._lock = threading.Lock()
+
+    def addChannel(self, channel):
+        with self._lock:
+            if channel not in self._members:
+                self._members[channel] = {}
+                self._changed(channel, "created")
+
+    def join(self, channel, nickname):
+        with self._lock:
+            members = self._members.setdefault(channel, {})
+            if nickname not in members:
+                members[nickname] = next(self._joins)
+                self._changed(channel, "joined", user=nickname)
+
+    def leave(self, channel, nickname):
+        with self._lock:
+            members = self._members.get(channel)
+            if members is not None and nickname in members:
+                del members[nickname]
+                self._changed(channel, "left", user=nickname)
+                if not members:
+                    self._changed(channel, "emptied")
+
+    def rename(self, channel, old, new):
+        with self._lock:
+            members = self._members.get(channel)
+            if members is not None and old in members:
+                members[new] = members.pop(old)  # keeps its place in the join order
+                self._changed(channel, "renamed", user=new, old=old)
+
+    def _changed(self, channel, change, **fields):
+        self.version += 1
+        self._versions[channel] = self.version
+        if not self._watchers:
+            return
+        watchers = self._watchers.get(channel, set()) | self._watchers.get(ALL, set())
+        if watchers:
+            delta = CachedPage(self.version, presenceObject(channel, change, self.version,
+                                                            len(self._members[channel]), fields))
+            for sock in watchers:  # one frame per encoding is shared by every watcher
+                self.deliver(sock, delta)
+
+    def watch(self, sock, channel):  # sends sock a snapshot of channel, or of ALL, and its changes from then on
+        with self._lock:  # False if the channel does not exist, raises ValueError over WATCH_LIMIT
+            if channel != ALL and channel not in self._members:
+                return False
+            watching = self._watching.setdefault(sock, set())
+            if channel not in watching and len(watching) >= WATCH_LIMIT:
+                raise ValueError(channel)
+            watching.add(channel)
+            self._watchers.setdefault(channel, set()).add(sock)
+            if channel == ALL:
+                counts = {name: len(members) for name, members in self._members.items()}
+                snapshot = watchingObject(channel, self.version, channels=counts)
+            else:
+                snapshot = watchingObject(channel, self.version, users=sorted(self._members[channel]))
+            self.deliver(sock, CachedPage(self.version, snapshot))  # under the lock, so no change comes before it
+            return True
+
+    def unwatch(self, sock, channel=None):  # stops sending sock the changes of channel, or of everything it watches
+        with self._lock:  # returns the channels that were being watched
+            watching = self._watching.get(sock, set())
+            stopped = set(watching) if channel is None else watching & {channel}
+            for name in stopped:
+                watchers = self._watchers[name]
+                watchers.discard(sock)
+                if not watchers:
+                    del self._watchers[name]
+            watching -= stopped
+            if not watching:
+                self._watching.pop(sock, None)
+            return stopped
+
+    def listPage(self, sort="name", after=None, limit=None):  # the CachedPage of /list for these options
+        with self._lock:
+            key = ("list", sort, after, limit)
+            page = self._cached(key, self.version)
+            if page is None:
+                version, items, keys = self._sortedList(sort)
+                channels, more = pageOf(items, keys, cursorKey(sort, after), limit)
+                page = self._store(key, listObject(dict(channels), version, len(items),
+                                                   cursorOf(sort, channels[-1]) if more else None))
+            return page
+
+    def whoPage(self, channel, after=None, limit=None, sort="joined"):  # the CachedPage of /who for channel,
+        with self._lock:  # None if it does not exist, raises ValueError on a cursor from another sort
+            version = self._versions.get(channel)
+            if version is None:
+                return None
+            key = ("who", channel, sort, after, limit)
+            page = self._cached(key, version)
+            if page is None:
+                cached = self._sorted.get(("who", channel, sort))
+                if cached is None or cached[0] != version:
+                    items = sortChannels(self._members[channel], sort)
+                    cached = self._sorted[("who", channel, sort)] = (version, items,
+                                                                     [sortKey(sort, item) for item in items])
+                _, items, keys = cached
+                users, more = pageOf(items, keys, cursorKey(sort, after), limit)
+                page = self._store(key, whoObject(channel, [nickname for nickname, _ in users], version, len(items),
+                                                  cursorOf(sort, users[-1]) if more else None))
+            return page
+
+    def _sortedList(self, sort):
+        cached = self._sorted.get(("list", sort))
+        if cached is None or cached[0] != self.version:
+            items = sortChannels({channel: len(members) for channel, members in self._members.items()}, sort)
+            cached = self._sorted[("list", sort)] = (self.version, items, [sortKey(sort, item) for item in items])
+        return cached
+
+    def _cached(self, key, version):
+        page = self._pages.get(key)
+        if page is None or page.version != version:
+            return None
+        self._pages.move_to_end(key)
+        return page
+
+    def _store(self, key, obj):
+        page = self._pages[key] = CachedPage(obj["version"], obj)
+        self._pages.move_to_end(key)
+        while len(self._pages) > PAGE_CACHE:
+            self._pages.popitem(last=False)
+        return page
+
+
+def sortKey(sort, item):  # the key a (channel, count) or (nickname, join number) pair is ordered by
+    name, number = item
+    if sort == "size":
+        return (-number, name)
+    return number if sort == "joined" else name
+
+
+def sortChannels(counts, sort):  # the (channel, count) or (nickname, join number) pairs of counts in the order of sort
+    return sorted(counts.items(), key=lambda item: sortKey(sort, item))
+
+
+def cursorOf(sort, item):  # the cursor a client sends back to get the page after item
+    if sort == "size":
+        return f"{item[1]}:{item[0]}"
+    return str(item[1]) if sort == "joined" else item[0]
+
+
+def cursorKey(sort, cursor):  # turns a cursor back into a sort key, raises ValueError on a cursor from another sort
+    if cursor is None or sort not in ("size", "joined"):
+        return cursor
+    if sort == "joined":
+        return int(cursor)
+    count, _, channel = cursor.partition(":")
+    return (-int(count), channel)
+
+
+def pageOf(items, keys, after, limit):  # the items after the key after, at most limit of them, and whether there are more
+    start = bisect.bisect_right(keys, after) if after is not None else 0
+    end = len(items) if limit is None else start + limit
+    return items[start:end], end < len(items)
+
+
+def listObject(channels, version, total, cursor):
+    return {"type": "event", "event": "list of channels", "channels": channels, "version": version,
+            "total": total, "next": cursor}
+
+
+def whoObject(channel, users, version, total, cursor):
+    return {"type": "event", "event": "channel users", "channel": channel, "users": users, "version": version,
+            "total": total, "next": cursor}
+
+
+def presenceObject(channel, change, version, users, fields):  # one change to a watched channel
+    obj = {"type": "event", "event": "presence", "channel": channel, "change": change, "version": version,
+           "users": users}  # users is the number of members after the change
+    obj.update(fields)
+    return obj
+
+
+def watchingObject(channel, version, **snapshot):  # the snapshot a watch starts with
+    obj = {"type": "event", "event": "watching", "channel": channel, "version": version}
+    obj.update(snapshot)
+    return obj
+
+
+def parsePaging(args, sorts):  # reads sort=, after= and limit= options, raises ValueError on anything else
+    options = {"sort": sorts[0], "after": None, "limit": None}
+    for arg in args:
+        name, equals, value = arg.partition("=")
+        if not equals or name not in options:
+            raise ValueError(arg)
+        options[name] = value
+    if options["sort"] not in sorts:
+        raise ValueError(options["sort"])
+    if options["limit"] is not None:
+        options["limit"] = min(int(options["limit"]), MAX_PAGE)
+        if options["limit"] < 1:
+            raise ValueError(options["limit"])
+    return options["sort"], options["after"], options["limit"]
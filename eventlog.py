@@ -0,0 +1,138 @@
+# this is the event log module that writes the server's log lines from a background thread so handlers never wait on output
+import json  # import json module to write each event as one JSON line
+import os  # import os module to rotate the log file
+import queue  # import queue module to hand events to the writer thread
+import sys  # import sys module to print to the terminal
+import threading  # import threading module for the writer thread and the counters
+import time  # import time module to stamp each event
+
+from colorama import Fore
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+OFF = float("inf")  # the threshold of a log with nowhere to write, every event is below it
+QUEUE_SIZE = 10000  # events waiting for the writer thread before new ones are dropped
+FILE_BYTES = 16 * 1024 * 1024  # the log file is rotated once it holds this many bytes
+FILE_BACKUPS = 5  # rotated files kept as path.1 to path.5, the oldest is deleted
+WRITE_BATCH = 256  # the most events written before the file is flushed
+
+
+class EventLog:
+    """Server events at or above level, written to the terminal and/or a rotating file of JSON lines.
+
+    log only checks the level, applies the sampling and queues the event with its template and
+    fields; the template is filled in and written by a background thread, so a disabled level costs
+    one comparison and a slow terminal or disk never holds up a handler. sampling maps an event name
+    to N so that only one in every N of those events is kept. When the queue is full new events are
+    dropped and counted instead of waiting for room.
+    """
+
+    def __init__(self, level=INFO, path=None, console=False, maxBytes=FILE_BYTES, backups=FILE_BACKUPS,
+                 sampling=None, queueSize=QUEUE_SIZE):
+        self.path = path  # the JSON lines file, None to write no file
+        self.console = console  # print the events to the terminal as well
+        self.threshold = level if console or path else OFF
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.sampling = dict(sampling or {})
+        self.dropped = 0  # events lost because the queue was full
+        self.sampledOut = 0  # events skipped by the sampling
+        self._seen = {}  # event name -> how many of it have been logged, for the sampling
+        self._counterLock = threading.Lock()
+        self._queue = queue.Queue(queueSize)
+        self._file = None
+        self._writer = None
+
+    def open(self):  # starts the writer thread, called in the process that does the logging
+        if self.threshold is OFF or self._writer is not None:
+            return
+        if self.path is not None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._writer = threading.Thread(target=self._drain, daemon=True)
+        self._writer.start()
+
+    def enabled(self, level):  # whether events at level are written, to skip building costly fields
+        return level >= self.threshold
+
+    def log(self, level, event, template, fields):  # queues an event whose text is template filled in with fields
+        if level < self.threshold:
+            return
+        every = self.sampling.get(event)
+        if every is not None and every > 1:
+            with self._counterLock:
+                seen = self._seen[event] = self._seen.get(event, 0) + 1
+                if seen % every != 1:
+                    self.sampledOut += 1
+                    return
+        try:
+            self._queue.put_nowait((time.time(), level, event, template, fields))
+        except queue.Full:
+            with self._counterLock:
+                self.dropped += 1
+
+    def _drain(self):  # writer thread that formats and writes the queued events
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while item is not None and len(batch) < WRITE_BATCH:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            for entry in batch:
+                if entry is not None:
+                    self._write(*entry)
+            if self._file is not None:
+                self._file.flush()
+                if self._file.tell() >= self.maxBytes:
+                    self._rotate()
+            if batch[-1] is None:  # close was called
+                break
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, stamp, level, event, template, fields):
+        try:
+            text = template.format(**fields)
+        except (KeyError, IndexError, ValueError):  # a template that does not fit its fields still gets logged
+            text = template
+        if self.console:
+            print(Fore.BLUE + "server log: ", text, file=sys.stdout)
+        if self._file is not None:
+            record = {"time": round(stamp, 6), "level": LEVEL_NAMES.get(level, level), "event": event, "text": text}
+            record.update(fields)
+            every = self.sampling.get(event)
+            if every is not None and every > 1:
+                record["sampled"] = every  # each line stands for this many events
+            self._file.write(json.dumps(record, default=str) + "\n")
+
+    def _rotate(self):  # moves path to path.1, path.1 to path.2 and so on, and starts an empty file
+        self._file.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):  # writes the events still queued and stops the writer thread
+        if self._writer is None:
+            return
+        self._queue.put(None)  # waits for room, so the events before it are not lost
+        self._writer.join()
+        self._writer = None
+
+
+def parseSampling(text):  # turns EVENT=N from the command line into (event, N)
+    event, _, every = text.partition("=")
+    if not event or not every.isdigit() or int(every) < 1:
+        raise ValueError(f"expected EVENT=N with N at least 1, got {text!r}")
+    return event, int(every)
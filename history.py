@@ -0,0 +1,104 @@
+# this is the history module that keeps the recent messages of every channel so joining users can catch up
+import collections  # import collections module for the ring of messages and the channels in order of activity
+import itertools  # import itertools module to read a slice of the ring without copying all of it
+import threading  # import threading module so client threads can record and read history at the same time
+
+HISTORY_COUNT = 200  # the most messages kept for one channel
+HISTORY_BYTES = 256 * 1024  # the most bytes of frames kept for one channel
+HISTORY_MEMORY = 64 * 1024 * 1024  # the most bytes of frames kept across every channel
+HISTORY_PAGE = 100  # the most messages sent for one /history command
+ENTRY_OVERHEAD = 64  # bytes charged for each message on top of its frame, for the tuple and its sequence number
+
+
+class ChannelHistory:
+    """The ring of recent messages of one channel, as (sequence number, frame) pairs, oldest first."""
+
+    def __init__(self):
+        self.entries = collections.deque()
+        self.bytes = 0
+        self.nextSeq = 1  # the sequence number of the next message, it keeps counting after messages are dropped
+
+
+class HistoryStore:
+    """Recent messages of every channel, stored as binary frames that are ready to send.
+
+    Each channel keeps at most maxCount messages and maxBytes bytes, dropping its oldest messages
+    first. When all channels together hold more than maxMemory bytes, the channels that have gone
+    longest without a message lose their history first.
+    """
+
+    def __init__(self, maxCount=HISTORY_COUNT, maxBytes=HISTORY_BYTES, maxMemory=HISTORY_MEMORY):
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+        self.maxMemory = maxMemory
+        self.totalBytes = 0
+        self.log = None  # the MessageLog every recorded message is also appended to, in sequence order
+        self._channels = collections.OrderedDict()  # channel -> ChannelHistory, least recently active first
+        self._lock = threading.Lock()  # only the log's queue lock is taken while it is held
+
+    def record(self, channel, frame):  # adds a message frame to channel and returns its sequence number
+        size = len(frame) + ENTRY_OVERHEAD
+        with self._lock:
+            history = self._channels.get(channel)
+            if history is None:
+                history = self._channels[channel] = ChannelHistory()
+            else:
+                self._channels.move_to_end(channel)  # the channel is now the most recently active one
+            seq = history.nextSeq
+            history.nextSeq += 1
+            history.entries.append((seq, frame))
+            if self.log is not None:  # appended under the lock so the log sees each channel's messages in order
+                self.log.append(channel, frame, seq)
+            history.bytes += size
+            self.totalBytes += size
+            while history.entries and (len(history.entries) > self.maxCount or history.bytes > self.maxBytes):
+                self._dropOldest(history)
+            if self.totalBytes > self.maxMemory:
+                for idle in list(self._channels.values()):  # empties the least recently active channels first
+                    if self.totalBytes <= self.maxMemory:
+                        break
+                    while idle.entries and idle is not history:  # the channel keeps counting its sequence numbers
+                        self._dropOldest(idle)
+            return seq
+
+    def restore(self, channel, entries, nextSeq):  # fills channel with (seq, frame) entries read back from the log
+        with self._lock:
+            history = self._channels.get(channel)
+            if history is None:
+                history = self._channels[channel] = ChannelHistory()
+            history.nextSeq = max(history.nextSeq, nextSeq)
+            for seq, frame in entries:
+                history.entries.append((seq, frame))
+                history.bytes += len(frame) + ENTRY_OVERHEAD
+                self.totalBytes += len(frame) + ENTRY_OVERHEAD
+            while history.entries and (len(history.entries) > self.maxCount or history.bytes > self.maxBytes):
+                self._dropOldest(history)
+
+    def _dropOldest(self, history):
+        _, frame = history.entries.popleft()
+        size = len(frame) + ENTRY_OVERHEAD
+        history.bytes -= size
+        self.totalBytes -= size
+
+    def last(self, channel, count):  # the newest count messages of channel, oldest first
+        with self._lock:
+            history = self._channels.get(channel)
+            if history is None or count <= 0:
+                return []
+            return list(itertools.islice(reversed(history.entries), count))[::-1]
+
+    def since(self, channel, seq, limit=HISTORY_PAGE):  # up to limit messages after seq, and whether there are more
+        with self._lock:
+            history = self._channels.get(channel)
+            if history is None:
+                return [], False
+            entries = history.entries
+            start = 0
+            if entries:  # the sequence numbers are consecutive, so the position is found without a search
+                start = min(max(0, seq + 1 - entries[0][0]), len(entries))
+            page = list(itertools.islice(entries, start, start + limit))
+            return page, start + limit < len(entries)
+
+    def __len__(self):  # the number of channels with history
+        with self._lock:
+            return sum(1 for history in self._channels.values() if history.entries)
@@ -0,0 +1,256 @@
+# this is the message log module that keeps channel and private messages on disk so they survive a restart
+import bisect  # import bisect module to find the index entry to start reading from
+import collections  # import collections module for the queue of records waiting for the writer thread
+import mmap  # import mmap module so reads come straight out of the segment files
+import os  # import os module to list, sync and delete the segment files
+import struct  # import struct module to pack the header of each record
+import threading  # import threading module for the writer thread and the lock around the index
+import time  # import time module to stamp each record and to age segments
+
+from metrics import METRICS
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # a segment is sealed and a new one started once it holds this many bytes
+RETAIN_BYTES = 1024 * 1024 * 1024  # the oldest segments are deleted while the log holds more than this
+RETAIN_SECONDS = 7 * 24 * 3600  # segments that were last written longer ago than this are deleted
+INDEX_INTERVAL = 64  # every 64th record of a channel is indexed, plus its first record in each segment
+SEGMENT_SUFFIX = ".seg"
+# each record is its length, the channel's sequence number, the time, the length of the channel name,
+# then the channel name and the frame; the length counts everything after itself
+_RECORD = struct.Struct("!IQdH")
+
+
+class Segment:
+    """One segment file, named after the position in the whole log of its first record."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.size = os.path.getsize(path)  # the bytes that have been committed
+        self.records = 0
+        self.written = os.path.getmtime(path)  # when a record was last written, for the age limit
+        self.keys = set()  # the channels with a record in this segment, so their first record is indexed
+        self._map = None
+
+    def view(self):  # an mmap covering everything committed so far, remapped as the segment grows
+        if self._map is None or len(self._map) < self.size:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as segmentFile:
+                self._map = mmap.mmap(segmentFile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class MessageLog:
+    """An append-only log of message frames in segment files under folder.
+
+    append only queues the record, and a writer thread writes everything queued in one write and
+    one fsync, so a burst of messages shares one commit and the caller never waits for the disk.
+    Each channel has a sparse index from its sequence numbers to where the records are, and reads
+    walk the segments through mmap from the nearest index entry, copying only the frames they return.
+    Segments are sealed at segmentBytes, and the oldest are deleted once the log is over retainBytes
+    or they are older than retainSeconds. Nothing is read or written until open is called, so a log
+    made before the worker processes fork is only opened by the worker that uses it.
+    """
+
+    def __init__(self, folder, segmentBytes=SEGMENT_BYTES, retainBytes=RETAIN_BYTES,
+                 retainSeconds=RETAIN_SECONDS, sync=True):
+        self.folder = folder
+        self.segmentBytes = segmentBytes
+        self.retainBytes = retainBytes
+        self.retainSeconds = retainSeconds
+        self.sync = sync  # fsync every commit, turning it off leaves flushing to the operating system
+        self.segments = []  # oldest first, the last one is being written
+        self.index = {}  # channel -> sorted list of (sequence number, segment base, position)
+        self.lastSeq = {}  # channel -> sequence number of its newest record
+        self.dropped = 0  # records that could not be written
+        self._lock = threading.Lock()  # guards the segments, the index and lastSeq
+        self._queue = collections.deque()
+        self._ready = threading.Condition()
+        self._closing = False
+        self._file = None
+        self._writer = None
+
+    def open(self):  # reads the segments already in the folder and starts the writer thread
+        os.makedirs(self.folder, exist_ok=True)
+        self._recover()
+        with self._lock:
+            self._retain()
+        self._file = open(self.segments[-1].path, "ab")
+        self._writer = threading.Thread(target=self._drain, daemon=True)
+        self._writer.start()
+
+    def _recover(self):  # rebuilds the index from the segments already in the folder
+        names = sorted(name for name in os.listdir(self.folder) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(os.path.join(self.folder, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            self.segments.append(segment)
+            if segment.size:
+                good = self._scan(segment)
+                if good < segment.size:  # a record was cut short by a crash, so the tail is dropped
+                    with open(segment.path, "r+b") as segmentFile:
+                        segmentFile.truncate(good)
+                    segment.close()
+                    segment.size = good
+        if not self.segments:
+            self._newSegment(0)
+
+    def _scan(self, segment):  # indexes every record of segment and returns where the last whole record ends
+        view = segment.view()
+        position = 0
+        while position + _RECORD.size <= segment.size:
+            length, seq, _, keyLength = _RECORD.unpack_from(view, position)
+            end = position + 4 + length
+            if length < _RECORD.size - 4 + keyLength or end > segment.size:
+                break
+            start = position + _RECORD.size
+            self._indexRecord(segment, bytes(view[start:start + keyLength]).decode(), seq, position)
+            position = end
+        return position
+
+    def _indexRecord(self, segment, key, seq, position):
+        if seq % INDEX_INTERVAL == 0 or key not in segment.keys:
+            self.index.setdefault(key, []).append((seq, segment.base, position))
+            segment.keys.add(key)
+        self.lastSeq[key] = seq
+        segment.records += 1
+
+    def _newSegment(self, base):
+        path = os.path.join(self.folder, f"{base:020d}{SEGMENT_SUFFIX}")
+        open(path, "ab").close()
+        self.segments.append(Segment(path, base))
+
+    def append(self, key, frame, seq=None):  # queues frame for the channel key, seq None numbers it after the last
+        with self._ready:
+            if self._closing:
+                return
+            self._queue.append((key, seq, time.time(), frame))
+            self._ready.notify()
+
+    def _drain(self):  # writer thread that commits everything queued in one write and one fsync
+        while True:
+            with self._ready:
+                while not self._queue and not self._closing:
+                    self._ready.wait()
+                if not self._queue:  # closing and nothing left to write
+                    break
+                batch = list(self._queue)
+                self._queue.clear()
+            try:
+                self._commit(batch)
+            except OSError:  # a full or failing disk loses the batch but not the server
+                self.dropped += len(batch)
+        self._file.close()
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        segment = self.segments[-1]
+        position = segment.size
+        chunks = []
+        placed = []
+        numbered = {}  # the last sequence number given to each key in this batch
+        for key, seq, said, frame in batch:
+            if seq is None:  # numbered here, after the last record of the key
+                seq = numbered[key] = numbered.get(key, self.lastSeq.get(key, 0)) + 1
+            keyBytes = key.encode()
+            chunks.append(_RECORD.pack(_RECORD.size - 4 + len(keyBytes) + len(frame), seq, said, len(keyBytes)))
+            chunks.append(keyBytes)
+            chunks.append(frame)
+            placed.append((key, seq, position))
+            position += _RECORD.size + len(keyBytes) + len(frame)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        with self._lock:
+            for key, seq, recordPosition in placed:
+                self._indexRecord(segment, key, seq, recordPosition)
+            segment.size = position
+            segment.written = time.time()
+            if segment.size >= self.segmentBytes:
+                self._rotate()
+        if METRICS.enabled:
+            METRICS.observe("log.commit.seconds", time.perf_counter() - start)
+            METRICS.observe("log.commit.records", len(batch))
+
+    def _rotate(self):  # seals the segment being written, starts the next one and applies the retention limits
+        sealed = self.segments[-1]
+        self._file.close()
+        self._newSegment(sealed.base + sealed.records)
+        self._file = open(self.segments[-1].path, "ab")
+        self._retain()
+
+    def _retain(self):  # deletes the oldest sealed segments while the log is too big or they are too old
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            total = sum(segment.size for segment in self.segments)
+            if total <= self.retainBytes and now - oldest.written <= self.retainSeconds:
+                break
+            self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+            for key in oldest.keys:  # the entries of a segment are always at the front of each channel's index
+                entries = self.index.get(key, [])
+                keep = next((i for i, entry in enumerate(entries) if entry[1] != oldest.base), len(entries))
+                del entries[:keep]
+                if not entries:  # lastSeq is kept so the key goes on counting where it left off
+                    del self.index[key]
+
+    def read(self, key, fromSeq, limit):  # up to limit (seq, frame) records of key from fromSeq on, and whether there are more
+        with self._lock:
+            entries = self.index.get(key)
+            if not entries:
+                return [], False
+            at = max(0, bisect.bisect_right(entries, (fromSeq, float("inf"))) - 1)  # the last entry at or before fromSeq
+            _, base, position = entries[at]
+            keyBytes = key.encode()
+            found = []
+            for segment in self.segments:
+                if segment.base < base:
+                    continue
+                if segment.base > base:
+                    position = 0
+                if not segment.size:
+                    continue
+                view = segment.view()
+                while position < segment.size:
+                    length, seq, _, keyLength = _RECORD.unpack_from(view, position)
+                    start = position + _RECORD.size
+                    position += 4 + length
+                    if seq < fromSeq or view[start:start + keyLength] != keyBytes:
+                        continue
+                    if len(found) == limit:
+                        return found, True
+                    found.append((seq, bytes(view[start + keyLength:position])))
+            return found, False
+
+    def last(self, key, count):  # the newest count records of key, oldest first
+        with self._lock:
+            newest = self.lastSeq.get(key)
+        if newest is None or count <= 0:
+            return []
+        return self.read(key, max(1, newest - count + 1), count)[0]
+
+    def channels(self):  # the keys that have records
+        with self._lock:
+            return list(self.lastSeq)
+
+    def totalBytes(self):
+        with self._lock:
+            return sum(segment.size for segment in self.segments)
+
+    def close(self):  # writes what is still queued and stops the writer thread
+        if self._writer is None:
+            return
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+        self._writer.join()
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
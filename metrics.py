@@ -0,0 +1,130 @@
+# this is the metrics module that counts what the ChatServer does and times how long it takes
+import threading  # import threading module so client threads can record into the same metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # serves the metrics to a local scraper
+
+HISTOGRAM_BUCKETS = 32  # power of two buckets in each histogram, enough for microseconds up to over an hour
+
+
+class Histogram:
+    """Counts observed values in power of two buckets.
+
+    Values are divided by scale first, so with a scale of one microsecond bucket i holds the times
+    up to 2**i microseconds. Recording is a bit_length and an increment, and percentiles are read
+    back as the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+
+    def observe(self, value):
+        index = min(int(value / self.scale).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.largest:
+            self.largest = value
+
+    def upperBound(self, index):  # the largest value that falls in bucket index
+        return (1 << index) * self.scale
+
+    def percentile(self, fraction):  # estimates the value that fraction of the observations are at or below
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.buckets):
+            seen += bucketCount
+            if seen >= rank:
+                return min(self.upperBound(index), self.largest)
+        return self.largest
+
+    def summary(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99), "max": self.largest}
+
+
+class Metrics:
+    """The counters and histograms of one server process.
+
+    Nothing is recorded until enabled is set, so the call sites check enabled before they read the
+    clock and the cost while it is off is one attribute lookup. Names are dotted strings such as
+    command.say.seconds or fanout.recipients, and a histogram whose name ends in .seconds uses microsecond
+    buckets while the others count whole numbers.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}  # name -> count
+        self.histograms = {}  # name -> Histogram
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(1e-6 if name.endswith(".seconds") else 1.0)
+            histogram.observe(value)
+
+    def snapshot(self):  # the counters and a summary of each histogram as plain values
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    def render(self, gauges):  # the metrics and gauges in the Prometheus text format
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE chat_{metricName(name)}_total counter")
+                lines.append(f"chat_{metricName(name)}_total {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                metric = "chat_" + metricName(name)
+                lines.append(f"# TYPE {metric} histogram")
+                seen = 0
+                for index, bucketCount in enumerate(histogram.buckets):
+                    seen += bucketCount
+                    if bucketCount:  # empty buckets are left out, the counts are cumulative either way
+                        lines.append(f'{metric}_bucket{{le="{histogram.upperBound(index):g}"}} {seen}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.total:g}")
+                lines.append(f"{metric}_count {histogram.count}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE chat_{metricName(name)} gauge")
+            lines.append(f"chat_{metricName(name)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def metricName(name):  # turns a dotted metric name into one a Prometheus scraper accepts
+    return name.replace(".", "_").replace("-", "_")
+
+
+METRICS = Metrics()  # the metrics of this process, shared by the server and the protocol functions
+
+
+def serveMetrics(port, gauges):  # serves METRICS and the gauges returned by gauges() on localhost:port in a thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.render(gauges()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # keeps scrapes out of the server's output
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)  # only reachable from the same machine
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
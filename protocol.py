@@ -1,46 +1,435 @@
 # this is the protocol module that defines the necessary functions for sending and receiving JSON objects over the socket connection
 import json  # import the json module to handle JSON conversions from JSON strings to Python objects and vice versa
+import collections  # import the collections module for the deque of frames that have been received but not read yet
+import socket  # import the socket module to catch the timeout while waiting for the handshake reply
+import struct  # import the struct module to pack the headers of binary frames
+import threading  # import the threading module to tell the thread running a batch apart from the others
+import time  # import the time module to time sends and decodes while metrics are enabled
+import zlib  # import the zlib module to compress the byte stream of connections that agree to it
+
+from metrics import METRICS  # the process wide metrics, which only record once the server enables them
+
+RECV_BUFFER_SIZE = 65536  # the default number of bytes read from the socket in one call
+MAX_FRAME_LENGTH = 1024 * 1024  # the default longest frame a peer may send before it is treated as an error
+
+JSON_LINES = "json"  # newline delimited JSON text, what every peer understands
+BINARY = "binary"  # length prefixed frames with a compact body, used once both peers agree to it
+ENCODINGS = (BINARY, JSON_LINES)  # the encodings this module supports, most preferred first
+ZLIB = "zlib"  # a raw deflate stream primed with COMPRESSION_DICTIONARY, flushed after every write
+COMPRESSIONS = (ZLIB,)  # the stream compressions this module supports, most preferred first
+COMPRESSION_LEVEL = 6  # the zlib level, higher levels cost more CPU for little gain on short chat frames
+# seconds a client waits for the answer to its hello, the server switches encodings as soon as it has answered,
+# so a client that stopped waiting could no longer read it and gives up on the connection instead
+HANDSHAKE_TIMEOUT = 5.0
+
+# the shapes of the common frames that the binary encoding sends as a schema id plus their string values,
+# as (fixed fields, string fields, name of a trailing list of strings); id 0 is any other frame sent as compact JSON
+SCHEMAS = [
+    None,
+    ({"type": "message"}, ("channel", "user", "message"), None),
+    ({"type": "message"}, ("from", "message"), None),
+    ({"type": "info"}, ("info",), None),
+    ({"type": "error"}, ("error",), None),
+    ({"type": "command"}, ("command",), "args"),
+    ({"type": "command"}, ("command",), None),
+    ({"type": "event"}, ("event", "channel"), None),
+    ({"type": "event"}, ("event", "nickname"), None),
+    ({"type": "event"}, ("event", "channel", "user"), None),
+]
+_SCHEMA_IDS = {  # finds the schema of a frame from its type and the order of its keys
+    (fixed["type"], tuple(fixed) + fields + ((listKey,) if listKey else ())): schemaId
+    for schemaId, (fixed, fields, listKey) in enumerate(SCHEMAS[1:], start=1)
+}
+_FRAME_LENGTH = struct.Struct("!I")  # every binary frame starts with the length of its payload
+_FIELD_LENGTHS = {}  # cached structs for the list of field lengths, keyed by the number of fields
+
+
+NO_BYTES = b""  # the partial frame of every reader that is not in the middle of one
+
+
+class FrameTooLong(ValueError):  # raised when a peer sends more than the maximum frame length without a newline
+    pass
+
+
+class FrameReader:
+    """Splits newline delimited frames out of received bytes.
+
+    Bytes are only decoded once a whole frame has arrived, so a multi-byte character split across
+    two reads is decoded correctly. Bytes after the last newline are kept until the rest arrives.
+    With single only the first frame is split off and everything after it is kept, so the first
+    frame can switch the connection to another encoding before the bytes behind it are looked at.
+    """
+
+    __slots__ = ("maxFrameLength", "_partial")
+
+    def __init__(self, maxFrameLength=MAX_FRAME_LENGTH):
+        self.maxFrameLength = maxFrameLength
+        self._partial = NO_BYTES  # the start of a frame whose newline has not arrived yet, a bytearray while there is one
+
+    def feed(self, data, length=None, single=False):  # returns every complete frame in data[:length] as a decoded string
+        if length is None:
+            length = len(data)
+        buffered = bool(self._partial)
+        if buffered:  # the start of the first frame is left over from an earlier read
+            self._partial += memoryview(data)[:length]
+            data, length = self._partial, len(self._partial)
+        if single:
+            end = data.find(b"\n", 0, length)  # only the first frame
+        else:
+            end = data.rfind(b"\n", 0, length)  # everything up to the last newline is a run of whole frames
+        if end < 0:
+            frames, start = [], 0
+        else:
+            with memoryview(data) as view:  # decodes the whole run at once straight out of the buffer
+                frames = [line.strip() for line in str(view[:end], "utf-8").split("\n")]
+            start = end + 1
+        if buffered:
+            del self._partial[:start]
+            if not self._partial:  # lets go of the buffer once it has been used up
+                self._partial = NO_BYTES
+        elif start < length:
+            self._partial = bytearray(memoryview(data)[start:length])
+        if len(self._partial) > self.maxFrameLength:
+            raise FrameTooLong(f"Frame is longer than {self.maxFrameLength} bytes.")
+        return frames
+
+    def decode(self, frame):  # turns one frame into a Python object, None for an empty line
+        return json.loads(frame) if frame else None
+
+    def take(self):  # returns the bytes kept for later frames and forgets them, to hand them to another reader
+        partial, self._partial = bytes(self._partial), NO_BYTES
+        return partial
+
+
+class BinaryFrameReader:
+    """Splits length prefixed binary frames out of received bytes."""
+
+    __slots__ = ("maxFrameLength", "_partial")
+
+    def __init__(self, maxFrameLength=MAX_FRAME_LENGTH, partial=NO_BYTES):
+        self.maxFrameLength = maxFrameLength
+        self._partial = bytearray(partial) if partial else NO_BYTES  # bytes of frames that have not fully arrived yet
+
+    def feed(self, data, length=None):  # returns the payload of every complete frame in data[:length]
+        buf = self._partial or bytearray()
+        buf += memoryview(data)[:length]
+        frames = []
+        start = 0
+        while len(buf) - start >= _FRAME_LENGTH.size:
+            size, = _FRAME_LENGTH.unpack_from(buf, start)
+            if size > self.maxFrameLength:
+                raise FrameTooLong(f"Frame is longer than {self.maxFrameLength} bytes.")
+            end = start + _FRAME_LENGTH.size + size
+            if end > len(buf):  # the rest of this frame has not arrived yet
+                break
+            frames.append(bytes(buf[start + _FRAME_LENGTH.size:end]))
+            start = end
+        del buf[:start]
+        self._partial = buf or NO_BYTES  # lets go of the buffer once it has been used up
+        return frames
+
+    def decode(self, frame):  # turns one frame payload into a Python object
+        return decodeBinary(frame)
+
+    def take(self):  # returns the bytes kept for later frames and forgets them, to hand them to another reader
+        partial, self._partial = bytes(self._partial), NO_BYTES
+        return partial
+
+
+def switchReader(reader, encoding):  # returns a reader for encoding that keeps the bytes the old reader had not used
+    if encoding == BINARY:
+        return BinaryFrameReader(reader.maxFrameLength, reader._partial)
+    newReader = FrameReader(reader.maxFrameLength)
+    if reader._partial:
+        newReader._partial = bytearray(reader._partial)
+    return newReader
+
+
+class Deflater:
+    """Compresses the outgoing bytes of one connection as a single deflate stream.
+
+    Every call flushes with Z_SYNC_FLUSH, so the peer can decompress each write as soon as it
+    arrives while later writes still refer back to the earlier ones and the primed dictionary.
+    """
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self._stream = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+
+    def compress(self, data):
+        return self._stream.compress(data) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Inflater:
+    """Decompresses the incoming deflate stream of one connection.
+
+    The output comes in pieces of at most maxLength bytes, so a small burst of compressed bytes
+    cannot expand into more memory than the frame reader is willing to hold.
+    """
+
+    def __init__(self, maxLength=MAX_FRAME_LENGTH):
+        self.maxLength = maxLength
+        self._stream = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+
+    def inflate(self, data):  # yields the decompressed pieces of data, raises zlib.error on a corrupt stream
+        piece = self._stream.decompress(data, self.maxLength)
+        while piece:
+            yield piece
+            piece = self._stream.decompress(self._stream.unconsumed_tail, self.maxLength)
+
 
 class WrappedSocket:
-    def __init__(self, raw_sock):
+    def __init__(self, raw_sock, bufferSize=RECV_BUFFER_SIZE, maxFrameLength=MAX_FRAME_LENGTH):
         self.raw_sock = raw_sock
-        # The buffer is now safely initialized on this standard Python object
-        self._buffer = ""
+        self.bufferSize = bufferSize  # how many bytes are read from the socket in one call
+        self._reader = FrameReader(maxFrameLength)  # splits the received bytes into frames
+        self._frames = collections.deque()  # complete frames that were received but not read yet
+        self._chunk = None  # the receive buffer, allocated on the first read
+        self.encoding = JSON_LINES  # every connection starts on JSON lines until a handshake agrees on another encoding
+        self.handshaking = True  # until the first frame has been handled, which is the only one that can be a hello
+        self._splitFirst = False  # set once the first frame has been split off and the bytes after it are held back
+        self.replies = None  # collects the objects sent to this connection while the server runs one of its batches
+        self.bytesIn = 0  # the number of bytes received on this connection
+        self.bytesOut = 0  # the number of bytes sent on this connection
+        self.compression = None  # the stream compression agreed on during the handshake, None for plain bytes
+        self._deflater = None
+        self._inflater = None
 
         # Delegate I/O methods to the raw socket
 
     def recv(self, size):
         return self.raw_sock.recv(size)
 
+    def recv_into(self, buffer):
+        return self.raw_sock.recv_into(buffer)
+
     def sendall(self, data):
+        if self._deflater is not None:
+            data = self._deflater.compress(data)
+        self.bytesOut += len(data)
         return self.raw_sock.sendall(data)
 
     def close(self):
         return self.raw_sock.close()
 
-def sendObject(sock, obj):  # function to send a JSON object over a socket
+    def readFrames(self):  # reads once from the socket and queues every complete frame, False once the peer has closed
+        if self._splitFirst:  # the first frame has been handled, so the bytes after it go to the reader it left in place
+            self._splitFirst = self.handshaking = False
+            self._queueFrames(self._reader.take())
+            if self._frames:
+                return True
+        if self._chunk is None:
+            self._chunk = bytearray(self.bufferSize)
+        size = self.recv_into(self._chunk)  # reads straight into the reused buffer without a new bytes object
+        if not size:
+            return False
+        self.bytesIn += size
+        if self.handshaking:  # a hello switches the encoding, so nothing after the first frame is split yet
+            self._frames.extend(self._reader.feed(self._chunk, size, single=True))
+            self._splitFirst = bool(self._frames)
+        else:
+            self._queueFrames(self._chunk, size)
+        return True
+
+    def _queueFrames(self, data, length=None):  # queues the complete frames in data[:length], decompressing it first if needed
+        if self._inflater is not None:
+            for piece in self._inflater.inflate(memoryview(data)[:length]):
+                self._frames.extend(self._reader.feed(piece))
+        else:
+            self._frames.extend(self._reader.feed(data, length))
+
+    def setEncoding(self, encoding):  # switches both directions of the connection to encoding
+        self._reader = switchReader(self._reader, encoding)
+        self.encoding = encoding
+
+    def setCompression(self, compression):  # compresses both directions of the connection from now on
+        self._deflater = Deflater()
+        self._inflater = Inflater(self._reader.maxFrameLength)
+        self.compression = compression
+
+
+def encodeObject(obj, encoding=JSON_LINES):  # function to turn a JSON object into the bytes of a single frame
+    if encoding == BINARY:
+        return encodeBinary(obj)
     data = json.dumps(obj) + "\n"  # convert the object to a string and adds a newline character
-    sock.sendall(data.encode())  # send the encoded data over the socket
+    return data.encode()  # the encoded frame is immutable, so it can be shared by many sends
+
+
+def encodeBinary(obj):  # function to turn a JSON object into a length prefixed binary frame
+    schemaId = _SCHEMA_IDS.get((obj.get("type"), tuple(obj)))
+    if schemaId is not None:
+        fixed, fields, listKey = SCHEMAS[schemaId]
+        values = [obj[key] for key in fields]
+        if listKey:
+            values += obj[listKey]
+        try:
+            parts = [value.encode() for value in values]
+            lengths = [len(part) for part in parts]
+            header = bytes((schemaId, len(parts))) + _fieldLengths(len(parts)).pack(*lengths)
+            return b"".join([_FRAME_LENGTH.pack(len(header) + sum(lengths)), header] + parts)
+        except (AttributeError, ValueError, struct.error):  # a value that is not a string, or too many or too long
+            pass
+    body = json.dumps(obj, separators=(",", ":")).encode()  # any other frame is sent as compact JSON
+    return _FRAME_LENGTH.pack(len(body) + 1) + b"\x00" + body
+
+
+def binaryFrameObject(frame):  # function to turn a whole binary frame, length included, back into a JSON object
+    return decodeBinary(frame[_FRAME_LENGTH.size:])
+
+
+def decodeBinary(payload):  # function to turn the payload of a binary frame back into a JSON object
+    schemaId = payload[0]
+    if schemaId == 0:
+        return json.loads(payload[1:])
+    fixed, fields, listKey = SCHEMAS[schemaId]
+    count = payload[1]
+    lengths = _fieldLengths(count).unpack_from(payload, 2)
+    position = 2 + 2 * count
+    values = []
+    for length in lengths:
+        values.append(payload[position:position + length].decode())
+        position += length
+    obj = dict(fixed)
+    obj.update(zip(fields, values))
+    if listKey:
+        obj[listKey] = values[len(fields):]
+    return obj
+
+
+def _fieldLengths(count):  # returns the struct that packs count field lengths
+    lengths = _FIELD_LENGTHS.get(count)
+    if lengths is None:
+        lengths = _FIELD_LENGTHS[count] = struct.Struct(f"!{count}H")
+    return lengths
+
+
+class BatchReplies(list):
+    """The objects a batch handler sends to its own connection, collected for the batch response.
+
+    Only sends made on the thread that runs the batch are collected. Broadcasts and bus messages
+    that other threads send to the same connection meanwhile go straight to the socket.
+    """
+    __slots__ = ("thread",)
+
+    def __init__(self):
+        super().__init__()
+        self.thread = threading.get_ident()  # the thread running the batch
+
+
+def collecting(sock):  # returns the replies of the batch this thread runs for sock, None when it runs none
+    replies = sock.replies
+    if replies is not None and replies.thread == threading.get_ident():
+        return replies
+    return None
+
+
+def sendObject(sock, obj):  # function to send a JSON object over a socket
+    replies = collecting(sock)
+    if replies is not None:  # this thread runs a batch for this connection, so the reply goes into the batch response
+        replies.append(obj)
+        return
+    if METRICS.enabled:  # times the encode and the hand off to the connection
+        start = time.perf_counter()
+        sock.sendall(encodeObject(obj, sock.encoding))
+        METRICS.observe("send.seconds", time.perf_counter() - start)
+        return
+    sock.sendall(encodeObject(obj, sock.encoding))  # send the data encoded the way the connection agreed on
+
+
+def sendBatch(sock, commands):  # function to send (id, command, args) tuples as one batch frame
+    sendObject(sock, {"type": "batch", "commands": [
+        {"id": requestId, "command": command, "args": list(args)} for requestId, command, args in commands
+    ]})
+
+
+def sendFrame(sock, frame):  # function to send a frame that was already encoded by encodeObject
+    sock.sendall(frame)  # the same frame can be sent to every recipient of a broadcast without encoding it again
+
+
+def offerEncodings(sock, encodings=ENCODINGS, timeout=HANDSHAKE_TIMEOUT,
+                   compressions=()):  # client side of the encoding handshake
+    if list(encodings) == [JSON_LINES] and not compressions:  # nothing to agree on
+        return JSON_LINES
+    hello = {"type": "hello", "encodings": list(encodings)}
+    if compressions:  # only offered when asked for, so the hello stays the same for older servers
+        hello["compression"] = list(compressions)
+    sendObject(sock, hello)  # the hello itself is always a JSON line
+    sock.raw_sock.settimeout(timeout)
+    try:
+        reply = receiveObject(sock)
+    except socket.timeout:
+        raise ConnectionError("The server did not answer the hello.")
+    finally:
+        sock.raw_sock.settimeout(None)
+    if not isinstance(reply, dict) or reply.get("type") != "hello":  # such as the busy frame of a full server
+        raise ConnectionError(reply.get("error", "The server did not answer the hello.") if isinstance(reply, dict)
+                              else "The server closed the connection.")
+    if reply.get("encoding") in encodings:
+        sock.setEncoding(reply["encoding"])
+    if reply.get("compression") in compressions:
+        sock.setCompression(reply["compression"])
+    return sock.encoding
+
+
+def acceptEncodings(sock, hello, encodings=ENCODINGS, compressions=COMPRESSIONS):  # server side of the encoding handshake
+    offered = hello.get("encodings", [])
+    chosen = next((encoding for encoding in offered if encoding in encodings), JSON_LINES)
+    offeredCompressions = hello.get("compression", [])
+    compression = next((name for name in offeredCompressions if name in compressions), None)
+    reply = {"type": "hello", "encoding": chosen}
+    if compression is not None:
+        reply["compression"] = compression
+    sendObject(sock, reply)  # the reply is encoded before the switch, as a plain JSON line
+    sock.setEncoding(chosen)
+    if compression is not None:
+        sock.setCompression(compression)
+    return chosen
 
 
 def receiveLine(sock):  # function to receive a line of text from the socket until a newline character is encountered
-    while True:
-        # if we already have a complete line, extract it
-        if "\n" in sock._buffer:
-            line, sock._buffer = sock._buffer.split("\n", 1)
-            return line.strip()
-
-        # need more data
-        chunk = sock.recv(1024).decode()  # Calls WrappedSocket.recv
-        if not chunk:
+    while not sock._frames:  # need more data
+        if not sock.readFrames():  # Calls WrappedSocket.readFrames
             return None
-
-        sock._buffer += chunk
+    return sock._frames.popleft()  # returns the oldest complete line, or frame payload once the connection is binary
 
 
 def receiveObject(sock):  # function to receive a JSON object from the socket
     line = receiveLine(
         sock)  # calls the recv_line function to retrieve the line of text that was decoded and added to the buffer from the socket
-    if line is None or line.strip() == "":  # for when there is no line received or the line is empty
+    if line is None or line == "":  # for when there is no line received or the line is empty
         return None  # return None to indicate that no object was received
-    return json.loads(line)  # convert the JSON string to a Python object
+    return decodeFrame(sock._reader, line)  # convert the frame to a Python object
+
+
+def decodeFrame(reader, frame):  # decodes one received frame with reader, timing it while metrics are enabled
+    if METRICS.enabled:
+        start = time.perf_counter()
+        obj = reader.decode(frame)
+        METRICS.observe("receive.seconds", time.perf_counter() - start)
+        return obj
+    return reader.decode(frame)
+
+
+# the deflate dictionary both peers prime their streams with, the frames every chat session sends in both encodings,
+# so even the first frames of a connection compress well; changing it breaks compatibility, so a change needs a new name
+_DICTIONARY_SAMPLES = [
+    {"type": "command", "command": "help", "args": []},
+    {"type": "command", "command": "who", "args": ["#"]},
+    {"type": "command", "command": "join", "args": ["#"]},
+    {"type": "command", "command": "msg", "args": ["", ""]},
+    {"type": "info", "info": "Message sent to "},
+    {"type": "error", "error": "You are not in channel '"},
+    {"type": "event", "event": "list of channels", "channels": {"#": 1}},
+    {"type": "event", "event": "channel users", "channel": "#", "users": [""]},
+    {"type": "event", "event": "channel history", "channel": "#", "count": 1, "first": 1, "last": 1, "more": False},
+    {"type": "event", "event": "your name was changed", "nickname": ""},
+    {"type": "event", "event": "you joined a channel", "channel": "#"},
+    {"type": "event", "event": "you left a channel", "channel": "#"},
+    {"type": "event", "event": "a user left the channel", "channel": "#", "user": ""},
+    {"type": "event", "event": "a user joined a channel", "channel": "#", "user": ""},
+    {"type": "message", "from": "", "message": ""},
+    {"type": "batch", "results": [{"id": 1, "replies": []}]},
+    {"type": "command", "command": "say", "args": ["#", ""]},
+    {"type": "message", "channel": "#", "user": "", "message": ""},  # zlib finds the last bytes of the dictionary fastest
+]
+COMPRESSION_DICTIONARY = b"".join(encodeObject(sample, encoding)
+                                  for encoding in (BINARY, JSON_LINES) for sample in _DICTIONARY_SAMPLES)
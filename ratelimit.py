@@ -0,0 +1,117 @@
+# this is the rate limit module that keeps one client from flooding the ChatServer with commands
+import argparse  # import argparse module to report a bad --rate-limit the way argparse reports its own errors
+import math  # import math module to turn away an infinite rate
+
+COMMAND_CLASSES = {  # the budget each command is charged to, commands that are not listed are charged to other
+    "say": "say",
+    "msg": "msg",
+    "join": "membership",
+    "leave": "membership",
+    "nick": "nick",
+}
+UNLIMITED = ("quit",)  # commands that are never held back, so a client can always leave
+# (commands per second, burst) for each budget, all is charged for every command on top of its own budget
+DEFAULT_LIMITS = {
+    "all": (20.0, 40),
+    "say": (5.0, 10),
+    "msg": (5.0, 10),
+    "membership": (2.0, 5),
+    "nick": (0.5, 3),
+    "other": (10.0, 20),
+}
+POLICIES = ("queue", "drop", "error")  # what happens to a command that is over its limit
+
+
+class TokenBucket:
+    """Holds up to burst tokens and gains rate tokens per second, each command spends one."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None  # when the tokens were last topped up
+
+    def delay(self, now):  # seconds until a token is available, 0 when one is available now
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimits:
+    """The command rate limits for every client connection.
+
+    limits maps a budget name from DEFAULT_LIMITS to (commands per second, burst). A command over
+    its limit is held back until it fits when policy is queue, ignored when it is drop, and answered
+    with an error when it is error. A held back command also holds back everything the client sends
+    after it, so the commands still run in order.
+    """
+
+    def __init__(self, limits=None, policy="error"):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.policy = policy
+
+    def newLimiter(self):  # the buckets for one new connection
+        return ClientLimiter(self.limits)
+
+
+class ClientLimiter:
+    """The token buckets of one connection, used only by the thread or event loop serving it.
+
+    A bucket starts full, so each one is only made the first time the client spends from it and a
+    connection that sends nothing holds none.
+    """
+
+    __slots__ = ("limits", "buckets")
+
+    def __init__(self, limits):
+        self.limits = limits  # shared by every connection of the same RateLimits
+        self.buckets = None  # budget name -> TokenBucket, made on the first command
+
+    def bucket(self, name):  # the bucket of a budget, None when the budget has no limit
+        if self.buckets is None:
+            self.buckets = {}
+        bucket = self.buckets.get(name)
+        if bucket is None and name in self.limits:
+            bucket = self.buckets[name] = TokenBucket(*self.limits[name])
+        return bucket
+
+    def check(self, command, now):  # spends the command's tokens and returns 0, or the seconds until it fits
+        if command in UNLIMITED:
+            return 0.0
+        charged = [bucket for bucket in (self.bucket("all"), self.bucket(classOf(command)))
+                   if bucket is not None]
+        delay = max((bucket.delay(now) for bucket in charged), default=0.0)
+        if delay:  # nothing is spent unless every budget has a token
+            return delay
+        for bucket in charged:
+            bucket.tokens -= 1
+        return 0.0
+
+
+def classOf(command):  # the budget a command is charged to
+    return COMMAND_CLASSES.get(command, "other")
+
+
+def parseLimit(text):  # turns NAME=RATE/BURST from the command line into (name, (rate, burst))
+    name, _, value = text.partition("=")
+    rate, _, burst = value.partition("/")
+    if name not in DEFAULT_LIMITS:
+        raise argparse.ArgumentTypeError(f"unknown budget {name!r}, pick one of {', '.join(DEFAULT_LIMITS)}")
+    try:
+        rate = float(rate)
+        burst = int(burst) if burst else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected BUDGET=RATE[/BURST] with numbers, got {text!r}")
+    # a rate of 0 would never refill the bucket, so a queued command would wait forever
+    if not 0 < rate < math.inf:
+        raise argparse.ArgumentTypeError(f"the rate of {name} must be a number of commands per second above 0")
+    if burst is None:
+        burst = max(1, int(rate * 2))
+    if burst < 1:
+        raise argparse.ArgumentTypeError(f"the burst of {name} must be at least 1")
+    return name, (rate, burst)
@@ -0,0 +1,58 @@
+# this is the timer wheel module that the ChatServer uses to find idle clients without scanning all of them
+import threading  # import the threading module so timers can be scheduled from any client thread
+
+
+class TimerWheel:
+    """A hashed timer wheel.
+
+    Each timer is hashed into the slot of the tick it is due in, so scheduling and cancelling are O(1)
+    and each tick only looks at the timers in the slots that have come due. A timer more than one turn
+    of the wheel away stays in its slot until the turn it is due in.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick  # seconds covered by one slot
+        self.slots = slots  # the number of slots in one turn of the wheel
+        self._wheel = [dict() for _ in range(slots)]  # each slot maps a key to the time it is due
+        self._slotOf = {}  # the slot each scheduled key is in, so it can be moved or cancelled
+        self._lastTick = None  # the last tick that advance has processed
+        self._lock = threading.Lock()
+
+    def schedule(self, key, deadline):  # schedules key to expire at deadline, replacing any earlier timer for it
+        with self._lock:
+            due = int(deadline // self.tick)
+            if self._lastTick is not None and due < self._lastTick:  # already past due, fires on the next advance
+                due = self._lastTick
+            slot = due % self.slots
+            old = self._slotOf.get(key)
+            if old is not None:
+                del self._wheel[old][key]
+            self._wheel[slot][key] = deadline
+            self._slotOf[key] = slot
+
+    def cancel(self, key):  # removes the timer for key if there is one
+        with self._lock:
+            slot = self._slotOf.pop(key, None)
+            if slot is not None:
+                del self._wheel[slot][key]
+
+    def advance(self, now):  # returns the keys whose timers are due by now and removes their timers
+        current = int(now // self.tick)
+        expired = []
+        with self._lock:
+            # the last processed slot is looked at again for timers that were not yet due within its tick,
+            # and the first advance looks at the whole wheel
+            last = current - self.slots if self._lastTick is None else self._lastTick
+            first = max(last, current - self.slots + 1)
+            for tick in range(first, current + 1):
+                bucket = self._wheel[tick % self.slots]
+                for key, deadline in list(bucket.items()):
+                    if deadline <= now:
+                        del bucket[key]
+                        del self._slotOf[key]
+                        expired.append(key)
+            self._lastTick = current
+        return expired
+
+    def __len__(self):
+        return len(self._slotOf)
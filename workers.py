@@ -0,0 +1,315 @@
+# this is the workers module that runs several ChatServer processes on one port and keeps their shared state in a broker
+import itertools  # import itertools module to number the requests a worker sends to the broker, and the joins
+import os  # import os module to fork the worker processes and wait for them
+import signal  # import signal module to pass Ctrl-C and SIGTERM on to the workers
+import socket  # import socket module for the Unix domain socket between the workers and the broker
+import tempfile  # import tempfile module for the folder that holds the broker's socket file
+import threading  # import threading module to serve each worker's link to the broker in its own thread
+import time  # import time module to retry connecting to the broker while it starts
+import traceback  # import traceback module to print why a worker failed
+
+from connections import OutboundPolicy, ThreadedConnection  # the bus links reuse the queued connection
+from protocol import sendObject, receiveObject
+
+BUS_TIMEOUT = 5.0  # seconds a worker waits for the broker to answer a request
+# the bus links carry every broadcast between workers, so their queues are much larger than a client's
+BUS_POLICY = OutboundPolicy(highWater=8 * 1024 * 1024, lowWater=1024 * 1024,
+                            maxQueued=256 * 1024 * 1024, grace=60.0)
+
+
+class ChannelBroker:
+    """Holds the nicknames and channel memberships of every worker and relays traffic between workers.
+
+    It runs in the parent process. Each worker keeps a link to it over a Unix domain socket, claims
+    nicknames through it, reports joins and leaves to it, and publishes channel broadcasts and private
+    messages through it so clients on other workers receive them.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener  # the Unix domain socket the workers connect to
+        self.lock = threading.Lock()  # protects the dictionaries below
+        self.workers = {}  # worker id -> link to that worker
+        self.nicknames = {}  # nickname -> id of the worker its client is on
+        self.channels = {}  # channel -> {nickname: join number} of its members, across all workers
+        self.joins = itertools.count()  # numbers every join, so /who can list members in the order they joined
+        self.joined = {}  # nickname -> set of channels it is in
+
+    def serve(self):  # accepts worker links until the listener is closed
+        while True:
+            try:
+                raw, _ = self.listener.accept()
+            except OSError:  # the listener was closed because every worker has exited
+                return
+            threading.Thread(target=self.serveWorker, args=(ThreadedConnection(raw, BUS_POLICY),),
+                             daemon=True).start()
+
+    def serveWorker(self, link):  # handles the requests of one worker until its link closes
+        hello = receiveObject(link)
+        workerId = hello["worker"]
+        with self.lock:
+            self.workers[workerId] = link
+        try:
+            while True:
+                msg = receiveObject(link)
+                if msg is None:
+                    break
+                self.handle(workerId, link, msg)
+        except OSError:
+            pass
+        finally:
+            self.dropWorker(workerId)
+            link.close()
+
+    def handle(self, workerId, link, msg):  # runs one request from a worker
+        op = msg["op"]
+        if op == "publish":  # a channel broadcast for the members on the other workers
+            self.forward(workerId, {"op": "deliver", "channel": msg["channel"], "obj": msg["obj"]})
+        elif op == "direct":  # a private message for a client that is not on the sending worker
+            with self.lock:
+                target = self.workers.get(self.nicknames.get(msg["nick"]))
+            if target is not None:
+                sendObject(target, {"op": "direct", "nick": msg["nick"], "obj": msg["obj"]})
+            self.reply(link, msg, ok=target is not None)
+        elif op == "claim":
+            self.reply(link, msg, ok=self.claim(workerId, msg["nick"], msg.get("old")))
+        elif op == "release":
+            self.release(msg["nick"])
+        elif op == "unclaim":
+            self.unclaim(workerId, msg["nick"], msg.get("old"))
+        elif op == "join":
+            with self.lock:
+                members = self.channels.setdefault(msg["channel"], {})
+                if msg.get("nick") is not None:
+                    members.setdefault(msg["nick"], next(self.joins))
+                    self.joined.setdefault(msg["nick"], set()).add(msg["channel"])
+        elif op == "leave":
+            with self.lock:
+                self.channels.get(msg["channel"], {}).pop(msg["nick"], None)
+                self.joined.get(msg["nick"], set()).discard(msg["channel"])
+        elif op == "list":
+            with self.lock:
+                channels = {channel: len(members) for channel, members in self.channels.items()}
+            self.reply(link, msg, channels=channels)
+        elif op == "who":
+            with self.lock:
+                members = self.channels.get(msg["channel"])
+                users = None if members is None else list(members.items())
+            self.reply(link, msg, users=users)
+
+    def claim(self, workerId, nick, old):  # gives nick to a client on workerId unless another client has it
+        with self.lock:
+            if nick in self.nicknames:
+                return False
+            self.nicknames[nick] = workerId
+            if old is not None and self.nicknames.get(old) == workerId:
+                del self.nicknames[old]
+                channels = self.joined.pop(old, set())
+                for channel in channels:  # the client keeps its channels, and its place in them, under its new nickname
+                    members = self.channels[channel]
+                    members[nick] = members.pop(old)
+                self.joined[nick] = channels
+            return True
+
+    # gives back a nickname whose rename was abandoned after claim succeeded, the client keeps old and its channels
+    def unclaim(self, workerId, nick, old):
+        with self.lock:
+            if self.nicknames.get(nick) != workerId:
+                return
+            del self.nicknames[nick]
+            channels = self.joined.pop(nick, set())
+            numbers = {channel: self.channels[channel].pop(nick) for channel in channels}
+            if old is not None and old not in self.nicknames:
+                self.nicknames[old] = workerId
+                for channel in channels:
+                    self.channels[channel][old] = numbers[channel]
+                self.joined[old] = channels
+
+    def release(self, nick):  # removes a nickname and its channel memberships when its client leaves
+        with self.lock:
+            self.nicknames.pop(nick, None)
+            for channel in self.joined.pop(nick, set()):
+                self.channels[channel].pop(nick, None)
+
+    def dropWorker(self, workerId):  # forgets every client of a worker whose link has closed
+        with self.lock:
+            self.workers.pop(workerId, None)
+            gone = [nick for nick, owner in self.nicknames.items() if owner == workerId]
+        for nick in gone:
+            self.release(nick)
+
+    def forward(self, fromWorker, msg):  # sends msg to every worker except the one it came from
+        with self.lock:
+            links = [link for workerId, link in self.workers.items() if workerId != fromWorker]
+        for link in links:
+            sendObject(link, msg)
+
+    def reply(self, link, msg, **fields):
+        sendObject(link, dict(op="reply", id=msg["id"], **fields))
+
+
+class BusWait(Exception):
+    """Raised by a command handler on the asyncio engine to wait for the broker's answer to a request.
+
+    future gets the answer, and the command is run again once it is done, so handlers ask the broker
+    before they change anything.
+    """
+
+    def __init__(self, future):
+        super().__init__("waiting for the channel broker")
+        self.future = future
+
+
+class BusClient:
+    """A worker's link to the ChannelBroker.
+
+    Sends never block the caller because they go through the link's outbound queue. Requests that need
+    an answer get it through a callback matched by id, which wait turns into a blocking call for the
+    threaded engine. Broadcasts and private messages relayed from other workers are handed to onMessage
+    from the link's reader thread.
+    """
+
+    def __init__(self, path, workerId, onMessage):
+        raw = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for attempt in range(50):  # the broker may still be starting
+            try:
+                raw.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+        else:
+            raise ConnectionError(f"Could not reach the channel broker at {path}")
+        self.link = ThreadedConnection(raw, BUS_POLICY)
+        self.workerId = workerId
+        self.onMessage = onMessage  # called with each message relayed from another worker
+        self._ids = itertools.count(1)
+        self._waiting = {}  # request id -> function called with the reply
+        self.send({"op": "hello", "worker": workerId})
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def send(self, msg):  # sends a message that needs no answer
+        sendObject(self.link, msg)
+
+    # sends a message and returns its id, onReply is called with the broker's answer from the reader thread,
+    # or with None if the link closes first
+    def request(self, msg, onReply):
+        requestId = next(self._ids)
+        self._waiting[requestId] = onReply
+        self.send(dict(msg, id=requestId))
+        return requestId
+
+    def forget(self, requestId):  # stops waiting for a request, its onReply is not called after this
+        self._waiting.pop(requestId, None)
+
+    def wait(self, msg):  # sends a message and blocks until the broker answers, None if it does not answer in time
+        answered = threading.Event()
+        slot = [None]
+
+        def onReply(reply):
+            slot[0] = reply
+            answered.set()
+        requestId = self.request(msg, onReply)
+        answered.wait(BUS_TIMEOUT)
+        self.forget(requestId)
+        return slot[0]
+
+    def _listen(self):  # reader thread that matches replies to requests and passes everything else on
+        while True:
+            try:
+                msg = receiveObject(self.link)
+            except OSError:
+                msg = None
+            if msg is None:
+                break
+            if msg["op"] == "reply":
+                onReply = self._waiting.pop(msg["id"], None)
+                if onReply is not None:
+                    onReply(msg)
+            else:
+                self.onMessage(msg)
+        for requestId in list(self._waiting):  # the broker is gone, so nothing waits for it any longer
+            onReply = self._waiting.pop(requestId, None)
+            if onReply is not None:
+                onReply(None)
+
+    # the requests below take ask, which sends a message and returns the broker's answer or None, wait by default
+    def claim(self, nick, old, ask=None):  # True when nick was free and now belongs to this worker's client
+        reply = (ask or self.wait)({"op": "claim", "nick": nick, "old": old})
+        if reply is None:  # the broker may still give it out after the wait, so it is given back straight away
+            self.unclaim(nick, old)
+        return reply is not None and reply["ok"]
+
+    def release(self, nick):
+        self.send({"op": "release", "nick": nick})
+
+    def unclaim(self, nick, old):  # gives back a claimed nickname the client did not take after all, it keeps old
+        self.send({"op": "unclaim", "nick": nick, "old": old})
+
+    def join(self, channel, nick):
+        self.send({"op": "join", "channel": channel, "nick": nick})
+
+    def leave(self, channel, nick):
+        self.send({"op": "leave", "channel": channel, "nick": nick})
+
+    def publish(self, channel, obj):  # sends a channel broadcast to the other workers
+        self.send({"op": "publish", "channel": channel, "obj": obj})
+
+    def direct(self, nick, obj, ask=None):  # sends a private message to a client on another worker, False if there is none
+        reply = (ask or self.wait)({"op": "direct", "nick": nick, "obj": obj})
+        return reply is not None and reply["ok"]
+
+    def listChannels(self, ask=None):  # every channel and its number of users across all workers
+        reply = (ask or self.wait)({"op": "list"})
+        return {} if reply is None else reply["channels"]
+
+    def who(self, channel, ask=None):  # {nickname: join number} of channel across all workers, None if it does not exist
+        reply = (ask or self.wait)({"op": "who", "channel": channel})
+        return None if reply is None or reply["users"] is None else dict(reply["users"])
+
+
+def runWorkers(count, makeServer):  # forks count worker processes that share the port and waits for them to exit
+    folder = tempfile.mkdtemp(prefix="chatserver-")
+    path = os.path.join(folder, "bus.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(count)  # listening before the fork so the workers can connect as soon as they start
+    children = []
+    for workerId in range(count):
+        pid = os.fork()
+        if pid == 0:  # the worker process
+            listener.close()
+            status = 0
+            try:
+                server = makeServer()
+                server.reusePort = True  # every worker listens on the same port
+                server.bus = BusClient(path, workerId, server.onBusMessage)
+                server.startServer()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+    threading.Thread(target=ChannelBroker(listener).serve, daemon=True).start()
+
+    def forward(signum):  # passes a shutdown signal on to the workers, each drains its own clients
+        for child in children:
+            try:
+                os.kill(child, signum)
+            except ProcessLookupError:  # that worker has already exited
+                pass
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: forward(signal.SIGTERM))
+    try:
+        for pid in children:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except KeyboardInterrupt:  # passes Ctrl-C on to the workers and keeps waiting for them to finish
+                    forward(signal.SIGINT)
+    finally:
+        listener.close()
+        os.unlink(path)
+        os.rmdir(folder)